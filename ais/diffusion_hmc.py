@@ -1,3 +1,4 @@
+import math
 from typing import Callable
 from typing import Optional
 
@@ -10,6 +11,7 @@ def hmc_trajectory(
     grad_U: Callable,
     epsilon: torch.Tensor,
     L: Optional[int] = 10,
+    inv_mass: Optional[torch.Tensor] = None,
 ):
     """Propose new state-velocity pair with leap-frog integrator.
 
@@ -22,17 +24,23 @@ def hmc_trajectory(
         grad_U: function to compute gradients w.r.t. U
         epsilon: step size
         L: number of leap-frog steps
+        inv_mass: inverse of a diagonal mass matrix, identity if None
 
     Returns:
         proposed state z and velocity v after the leap-frog steps
     """
     epsilon = epsilon.view(-1, 1)
+    if inv_mass is not None:
+        # z is moved by epsilon * M^{-1} v
+        position_step = epsilon * inv_mass
+    else:
+        position_step = epsilon
     z = current_z
     initial_U, initial_grad = grad_U(z)
     v = current_v - 0.5 * epsilon * initial_grad
 
     for i in range(1, L + 1):
-        z = z + epsilon * v
+        z = z + position_step * v
         if i != L:
             v = v - epsilon * grad_U(z)[1]
 
@@ -72,8 +80,8 @@ def accept_reject(
             if the chain is accepted more than this, and decrease otherwise
 
     Returns:
-        the new state z, the adapted step size epsilon, and the updated
-        accept-reject history
+        the new state z, the updated accept-reject history and the acceptance
+        probability of every chain
     """
     current_Hamil = K(current_v) + initial_U
     propose_Hamil = K(v) + final_U
@@ -84,4 +92,188 @@ def accept_reject(
 
     accept_hist.add_(accept)
 
-    return z, accept_hist
+    return z, accept_hist, prob
+
+
+def kinetic_energy(v, inv_mass=None):
+    """K(v) = v^T M^{-1} v / 2 for a diagonal mass matrix M, up to a constant."""
+    if inv_mass is None:
+        return 0.5 * torch.sum(v**2, dim=1)
+    return 0.5 * torch.sum(inv_mass * v**2, dim=1)
+
+
+class DualAveragingStepSize(object):
+    """Per-chain dual averaging of the step size, Algorithm 5 of
+    https://arxiv.org/pdf/1111.4246.pdf.
+
+    Every chain drives the log of its own step size towards the value where
+    its acceptance probability matches `target_accept`.
+    """
+
+    def __init__(
+        self, step_size, target_accept=0.65, gamma=0.05, t0=10, kappa=0.75
+    ):
+        self.target_accept = target_accept
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+        self.mu = torch.log(10 * step_size)
+        self.log_step_size_bar = torch.zeros_like(step_size)
+        self.h_bar = torch.zeros_like(step_size)
+        self.n = 0
+
+    def update(self, accept_prob):
+        """Takes the acceptance probabilities of a transition, returns step sizes."""
+        # diverging trajectories give nan
+        accept_prob = torch.nan_to_num(accept_prob, nan=0.0)
+        self.n += 1
+        eta = 1.0 / (self.n + self.t0)
+        self.h_bar = (1 - eta) * self.h_bar + eta * (self.target_accept - accept_prob)
+        log_step_size = self.mu - math.sqrt(self.n) / self.gamma * self.h_bar
+        weight = self.n ** (-self.kappa)
+        self.log_step_size_bar = (
+            weight * log_step_size + (1 - weight) * self.log_step_size_bar
+        )
+        return torch.exp(log_step_size)
+
+    def final_step_size(self):
+        return torch.exp(self.log_step_size_bar)
+
+    def state_dict(self):
+        return dict(
+            mu=self.mu,
+            log_step_size_bar=self.log_step_size_bar,
+            h_bar=self.h_bar,
+            n=self.n,
+        )
+
+    def load_state_dict(self, state):
+        self.mu = state["mu"]
+        self.log_step_size_bar = state["log_step_size_bar"]
+        self.h_bar = state["h_bar"]
+        self.n = state["n"]
+
+
+class RunningVariance(object):
+    """Per-dimension variance of all states seen so far, pooled over chains."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, z):
+        n = z.shape[0]
+        mean = z.mean(0)
+        m2 = ((z - mean) ** 2).sum(0)
+        if self.mean is None:
+            self.n, self.mean, self.m2 = n, mean, m2
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.n * n / total
+        self.n = total
+
+    def regularized_variance(self):
+        # shrink towards a small multiple of the identity, as in Stan
+        variance = self.m2 / max(self.n - 1, 1)
+        return (self.n / (self.n + 5.0)) * variance + 1e-3 * (5.0 / (self.n + 5.0))
+
+    def state_dict(self):
+        return dict(n=self.n, mean=self.mean, m2=self.m2)
+
+    def load_state_dict(self, state):
+        self.n, self.mean, self.m2 = state["n"], state["mean"], state["m2"]
+
+
+class HMCKernel(object):
+    """HMC transitions for a batch of chains, adapted during a warm-up window.
+
+    For the first `adapt_steps` transitions the step size of every chain is
+    tuned by dual averaging towards `target_accept`, after which it is fixed to
+    the averaged value. With `adapt_mass`, a diagonal mass matrix is estimated
+    from the states of the first half of the window, and dual averaging
+    restarts for the second half with the new metric.
+    """
+
+    def __init__(
+        self,
+        step_size,
+        num_leapfrog,
+        adapt_steps=0,
+        target_accept=0.65,
+        adapt_mass=False,
+    ):
+        self.step_size = step_size
+        self.num_leapfrog = num_leapfrog
+        self.adapt_steps = adapt_steps
+        self.target_accept = target_accept
+        self.inv_mass = None
+        self.n_updates = 0
+        self.dual_averaging = DualAveragingStepSize(step_size, target_accept)
+        self.variance = RunningVariance() if adapt_mass else None
+
+    def kinetic_energy(self, v):
+        return kinetic_energy(v, self.inv_mass)
+
+    def step(self, current_z, grad_U, accept_hist):
+        """One transition of all chains, returns z, accept_hist and accept probs."""
+        current_v = torch.randn_like(current_z)
+        if self.inv_mass is not None:
+            # v ~ N(0, M)
+            current_v = current_v / torch.sqrt(self.inv_mass)
+        z, v, initial_U, final_U = hmc_trajectory(
+            current_z=current_z,
+            current_v=current_v,
+            grad_U=grad_U,
+            epsilon=self.step_size,
+            L=self.num_leapfrog,
+            inv_mass=self.inv_mass,
+        )
+        z, accept_hist, prob = accept_reject(
+            current_z=current_z,
+            current_v=current_v,
+            z=z,
+            v=v,
+            accept_hist=accept_hist,
+            initial_U=initial_U,
+            final_U=final_U,
+            K=self.kinetic_energy,
+        )
+        if self.n_updates < self.adapt_steps:
+            self._adapt(z, prob)
+        return z, accept_hist, prob
+
+    def _adapt(self, z, prob):
+        self.n_updates += 1
+        self.step_size = self.dual_averaging.update(prob)
+
+        if self.variance is not None and self.n_updates <= self.adapt_steps // 2:
+            self.variance.update(z)
+            if self.n_updates == self.adapt_steps // 2:
+                self.inv_mass = self.variance.regularized_variance()
+                self.dual_averaging = DualAveragingStepSize(
+                    self.step_size, self.target_accept
+                )
+
+        if self.n_updates == self.adapt_steps:
+            self.step_size = self.dual_averaging.final_step_size()
+
+    def state_dict(self):
+        """Adaptation state, enough to continue the chains exactly after a restart."""
+        return dict(
+            step_size=self.step_size,
+            inv_mass=self.inv_mass,
+            n_updates=self.n_updates,
+            dual_averaging=self.dual_averaging.state_dict(),
+            variance=self.variance.state_dict() if self.variance is not None else None,
+        )
+
+    def load_state_dict(self, state):
+        self.step_size = state["step_size"]
+        self.inv_mass = state["inv_mass"]
+        self.n_updates = state["n_updates"]
+        self.dual_averaging.load_state_dict(state["dual_averaging"])
+        if self.variance is not None:
+            self.variance.load_state_dict(state["variance"])
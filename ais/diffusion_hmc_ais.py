@@ -1,6 +1,7 @@
 from typing import List
 from typing import Optional
 from typing import Union
+import logging
 import torch.autograd as autograd
 import numpy as np
 
@@ -16,15 +17,94 @@ parent_dir = os.path.abspath(os.path.join(current_dir, os.pardir))
 sys.path.append(parent_dir)
 
 from datasets import logit_transform
+import profiling
 
 import torch
 from tqdm import tqdm
 
 import ais.diffusion_hmc as hmc
 import ais.diffusion_utils as utils
+import ais.schedules as schedules
+import ais.shards as shards
 from torch.distributions import Independent, Normal
 
 
+def _encode_batch(batch, flow, flow_name, scaler, device):
+    """Maps a batch of test images to the latent space, the start of RAISE chains."""
+    train = False
+    batch = batch[0]
+
+    batch = batch.to(device).float()
+
+    batch = batch * 255.0 / 256.0
+    batch += torch.rand_like(batch) / 256.0
+
+    batch = scaler(batch)
+
+    if "none" not in flow_name:
+
+        # adapted from losses.py
+        with torch.no_grad(), profiling.phase("flow_encode"):
+            flow.eval()
+            current_z = (batch + 1.0) / 2.0
+            if flow_name in ["mintnet", "nice", "realnvp"]:
+                # undo rescaling, apply logit transform, pass through flow
+                current_z = logit_transform(current_z)
+                current_z, _ = flow(current_z, reverse=False)
+                # current_z = current_z.view(batch.size())
+            else:
+                current_z *= 256.0
+                # annoying, but now we need to branch to RQ-NSF flow vs [noise, copula]
+                if "noise" in flow_name or "copula" in flow_name:
+                    # apply data transform here (1/256, logit transform, mean-centering)
+                    current_z = flow.module.transform_to_noise(
+                        current_z, transform=True, train=train
+                    )
+                else:
+                    # for the RQ-NSF flow, the data is dequantized and between [0, 256]
+                    # and the flow's preprocessing module takes care of normalization
+                    current_z = flow.module.transform_to_noise(current_z)
+                # current_z = current_z.view(batch.size())
+
+    else:
+
+        current_z = batch.view((batch.shape[0], 784))
+
+    return current_z
+
+
+def _decode_samples(current_z, flow, flow_name, inverse_scaler):
+    """Maps final chain states back to image space."""
+    # adapted from losses.py
+    train = False
+    batch_size = current_z.shape[0]
+
+    with torch.no_grad(), profiling.phase("flow_decode"):
+        if "none" not in flow_name:
+            if flow_name in ["mintnet", "nice", "realnvp"]:
+                # map z -> x via flow, then rescale to [-1, 1]
+                ais_x = flow.module.sampling(current_z, rescale=True)
+            else:
+                if "noise" in flow_name or "copula" in flow_name:
+                    ais_x = flow.module.sample(
+                        current_z.view(batch_size, -1),
+                        context=None,
+                        rescale=True,
+                        transform=True,
+                        train=train,
+                    )
+                else:
+                    ais_x = flow.module.sample(
+                        current_z.view(batch_size, -1), context=None, rescale=True
+                    )
+        else:
+            ais_x = current_z.view((-1, 1, 28, 28))
+
+        ais_x = inverse_scaler(ais_x)
+
+    return ais_x
+
+
 def ais_fn(
     flow,
     flow_name,
@@ -49,10 +129,29 @@ def ais_fn(
     eps=1e-5,
     initial_step_size: Optional[int] = 0.01,
     device: Optional[torch.device] = None,
+    shard_id: int = 0,
+    num_shards: int = 1,
+    shard_dir: Optional[str] = None,
+    seed: Optional[int] = None,
+    adapt_steps: int = 0,
+    target_accept: float = 0.65,
+    adapt_mass: bool = False,
+    schedule_mode: str = "linear",
+    target_cess: float = 0.99,
+    max_adaptive_steps: int = 10000,
+    schedule_path: Optional[str] = None,
+    schedule_timeout: Optional[float] = None,
+    snapshot_interval: int = 0,
+    resume: bool = False,
+    bdmc_gap_tol: float = 0.0,
 ):
     """Compute annealed importance sampling trajectories for a batch of data.
 
-    Could be used for *both* forward and reverse chain in BDMC.
+    Could be used for *both* forward and reverse chain in BDMC. With
+    `ais_method="bdmc"` both run in one call: every batch holds `batch_size`
+    forward chains started from the base distribution and `batch_size`
+    reverse chains started from the encoded data, annealed in lockstep
+    through the same ratio and gradient functions.
 
     Sampling is carried out in the latent space of the flow.
 
@@ -65,12 +164,46 @@ def ais_fn(
       schedule: temperature schedule, i.e. `p(z)p(x|z)^t`
       n_sample: number of importance samples
       device: device to run all computation on
-      initial_step_size: step size for leap-frog integration;
-        note that this is the step size all along as I am not adapting it
+      initial_step_size: step size for leap-frog integration; it stays fixed
+        unless `adapt_steps` > 0
+      shard_id, num_shards: only run the batches with
+        `batch_idx % num_shards == shard_id`, see ais/shards.py
+      shard_dir: if given, the results are written to a shard file after
+        every finished batch
+      seed: if given, batch `batch_idx` runs with seed `seed + batch_idx`, so
+        the chains do not depend on how the batches are sharded
+      adapt_steps: number of HMC transitions at the start of every batch
+        during which the per-chain step sizes are tuned by dual averaging
+      target_accept: acceptance probability targeted by the adaptation
+      adapt_mass: also estimate a diagonal mass matrix during warm-up
+      schedule_mode: "linear" uses num_ais_steps uniform steps, "adaptive"
+        picks every step on the first batch such that the conditional ESS of
+        the incremental weights is `target_cess`, see ais/schedules.py
+      max_adaptive_steps: bound on the number of adaptive steps, enforced as a
+        minimum step of 1 / max_adaptive_steps of the annealing interval
+      schedule_path: where the adaptive schedule is saved; if the file holds a
+        schedule for the same method, eps, target_cess and max_adaptive_steps,
+        it is used for all batches
+      schedule_timeout: seconds the shards other than 0 wait for the adaptive
+        schedule before raising a TimeoutError, None waits forever
+      snapshot_interval: if > 0, the state of the running batch is saved to
+        `shard_dir` every `snapshot_interval` HMC transitions (temperatures
+        and continued steps)
+      resume: skip the batches already in the shard file of `shard_dir` and
+        continue the running batch from its last snapshot
+      bdmc_gap_tol: for BDMC, stop after the first batch at which the
+        sandwich gap between the RAISE upper and the AIS lower bound of the
+        log normalizer is below this; 0 runs all batches
 
     Returns:
-        a list where each element is a torch.Tensor that contains the
-        log importance weights for a single batch of data
+        samples, latents, initial latents and log importance weights of the
+        chains of this shard, the log normalizer estimated from them, the
+        acceptance rate and a dict with the standard error and ess of the
+        log normalizer, the mean acceptance probability at every temperature
+        and the final step sizes. For BDMC the samples and log weights are
+        those of the forward chains, and the dict also holds the bounds of
+        `shards.bdmc_stats`, the log weights of the reverse chains and the
+        sandwich gap after every batch
     """
 
     if "none" not in flow_name:
@@ -85,14 +218,48 @@ def ais_fn(
     elif ais_method == "raise":
         print("Running RAISE")
         forward = False
+    elif ais_method == "bdmc":
+        print("Running BDMC")
+        # the schedule is that of the forward chains
+        forward = True
     else:
         raise NotImplementedError
 
-    schedule = torch.linspace(
-        0.0, 1.0 - eps, num_ais_steps + 1, device=device
-    ).contiguous()
-    if not forward:
-        schedule = torch.flip(schedule, dims=(0,)).contiguous()
+    if schedule_mode == "linear":
+        schedule = schedules.linear_schedule(num_ais_steps, eps, forward, device)
+    elif schedule_mode == "adaptive":
+        if ais_method == "bdmc":
+            raise NotImplementedError("Adaptive schedules for BDMC not supported yet!")
+        schedule_settings = dict(
+            ais_method=ais_method,
+            eps=eps,
+            target_cess=target_cess,
+            max_adaptive_steps=max_adaptive_steps,
+        )
+        # realized while running the first batch if there is none yet
+        schedule = None
+        if schedule_path is not None:
+            schedule = schedules.load_schedule(
+                schedule_path, schedule_settings, device
+            )
+            if schedule is None and shard_id != 0:
+                # the shard running batch 0 adapts the schedule for everyone
+                schedule = schedules.wait_for_schedule(
+                    schedule_path,
+                    schedule_settings,
+                    device,
+                    timeout=schedule_timeout,
+                )
+            elif schedule is None and os.path.exists(schedule_path):
+                logging.warning(
+                    "Adapting a new AIS schedule, %s was adapted with other "
+                    "settings" % schedule_path
+                )
+        if schedule is not None:
+            print(f"Using adaptive schedule with {len(schedule) - 1} steps")
+    else:
+        raise NotImplementedError(f"AIS schedule {schedule_mode} not supported yet!")
+    t_start, t_end = (0.0, 1.0 - eps) if forward else (1.0 - eps, 0.0)
 
     ratio_fn = utils.get_ratio_fn_flow(
         score_model,
@@ -138,189 +305,298 @@ def ais_fn(
     def dlogp_0_fn(z):
         return -z
 
-    def normalized_kinetic(v):
-        zeros = torch.zeros_like(v)
-        return -utils.log_normal(v, zeros, zeros)
-
-    logws = []
-    samples = []
-    z_samples = []
-    accept_hists = []
-    init_zs = []
-
-    for batch in dataloader:
-
-        accept_hist = torch.zeros(size=(batch_size,), device=device)
-        logw = torch.zeros(size=(batch_size,), device=device)
+    def get_grad_U(t1):
+        @torch.enable_grad
+        def grad_U(z):
+            # assuming the base distribution is standard normal, which is true for all flows that we actually use
+            logp_0 = logp_0_fn(z)
+            dlogp_0 = dlogp_0_fn(z)
+            ratio, dratio = dratio_fn(z, t1)
+            return (-logp_0 - ratio).detach(), (-dlogp_0 - dratio).detach()
 
-        # initial sample of z
-        if forward:
-            current_z = torch.randn(size=(batch_size, 784), device=device)
-        else:
-            train = False
-            batch = batch[0]
-
-            batch = batch.to(device).float()
-
-            batch = batch * 255.0 / 256.0
-            batch += torch.rand_like(batch) / 256.0
-
-            batch = scaler(batch)
-
-            if "none" not in flow_name:
-
-                # adapted from losses.py
-                with torch.no_grad():
-                    flow.eval()
-                    current_z = (batch + 1.0) / 2.0
-                    if flow_name in ["mintnet", "nice", "realnvp"]:
-                        # undo rescaling, apply logit transform, pass through flow
-                        current_z = logit_transform(current_z)
-                        current_z, _ = flow(current_z, reverse=False)
-                        # current_z = current_z.view(batch.size())
-                    else:
-                        current_z *= 256.0
-                        # annoying, but now we need to branch to RQ-NSF flow vs [noise, copula]
-                        if "noise" in flow_name or "copula" in flow_name:
-                            # apply data transform here (1/256, logit transform, mean-centering)
-                            current_z = flow.module.transform_to_noise(
-                                current_z, transform=True, train=train
-                            )
-                        else:
-                            # for the RQ-NSF flow, the data is dequantized and between [0, 256]
-                            # and the flow's preprocessing module takes care of normalization
-                            current_z = flow.module.transform_to_noise(current_z)
-                        # current_z = current_z.view(batch.size())
+        return grad_U
+
+    # everything that has to match for finished batches and snapshots to be reused
+    run_settings = dict(
+        ais_method=ais_method,
+        batch_size=batch_size,
+        num_ais_steps=num_ais_steps,
+        num_steps_per_ais_step=num_steps_per_ais_step,
+        num_continue=num_continue,
+        num_hmc_steps=num_hmc_steps,
+        schedule_mode=schedule_mode,
+        seed=seed,
+    )
+    if (snapshot_interval > 0 or resume) and shard_dir is None:
+        raise ValueError("Snapshots and resuming AIS need a shard_dir")
+
+    results = []
+    snapshot = None
+    if shard_dir is not None:
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_file = shards.shard_path(shard_dir, shard_id, num_shards)
+        snapshot_file = shards.snapshot_path(shard_dir, shard_id, num_shards)
+        if resume and os.path.exists(shard_file):
+            finished, meta = shards.load_shard(shard_file)
+            if meta.get("run_settings") != run_settings:
+                raise ValueError(
+                    f"{shard_file} was written with {meta.get('run_settings')}, "
+                    f"cannot resume with {run_settings}"
+                )
+            results = [
+                {k: v.to(device) if torch.is_tensor(v) else v for k, v in b.items()}
+                for b in finished
+            ]
+            if schedule is None:
+                schedule = meta["schedule"].to(device)
+            num_accept_reject = meta["num_accept_reject"]
+            print(f"Resuming after {len(results)} finished batches")
+        if resume and os.path.exists(snapshot_file):
+            snapshot = shards.load_snapshot(snapshot_file, device)
+            if snapshot["run_settings"] != run_settings:
+                raise ValueError(
+                    f"{snapshot_file} was written with {snapshot['run_settings']}, "
+                    f"cannot resume with {run_settings}"
+                )
+    finished_batches = {r["batch_idx"] for r in results}
 
-            else:
+    bdmc = ais_method == "bdmc"
+    num_chains = 2 * batch_size if bdmc else batch_size
 
-                current_z = batch.view((batch.shape[0], 784))
+    def temperatures(i):
+        if not bdmc:
+            return schedule[i]
+        # forward chains follow the schedule, reverse chains run it backwards
+        return torch.cat(
+            [schedule[i].expand(batch_size), schedule[-1 - i].expand(batch_size)]
+        )
 
-        init_zs.append(current_z.detach().cpu().clone())
+    # sandwich gap after every batch of a BDMC run
+    gap_trace = []
+    stopped_early = False
 
-        num_accept_reject = 0
+    for batch_idx, batch in enumerate(dataloader):
+        if batch_idx % num_shards != shard_id or batch_idx in finished_batches:
+            continue
 
-        epsilon = torch.full(
-            size=(batch_size,), device=device, fill_value=initial_step_size
+        kernel = hmc.HMCKernel(
+            torch.full(size=(num_chains,), device=device, fill_value=initial_step_size),
+            num_hmc_steps,
+            adapt_steps=adapt_steps,
+            target_accept=target_accept,
+            adapt_mass=adapt_mass,
         )
 
-        for t0, t1 in tqdm(zip(schedule[:-1], schedule[1:])):
-
-            # update log importance weight
-            logw += ratio_fn(current_z, t0, t1)
-
-            @torch.enable_grad
-            def grad_U(z):
-                # assuming the base distribution is standard normal, which is true for all flows that we actually use
-                logp_0 = logp_0_fn(z)
-                dlogp_0 = dlogp_0_fn(z)
-                ratio, dratio = dratio_fn(z, t1)
-                return (-logp_0 - ratio).detach(), (-dlogp_0 - dratio).detach()
+        if snapshot is not None and snapshot["batch_idx"] == batch_idx:
+            current_z = snapshot["current_z"]
+            logw = snapshot["logw"]
+            accept_hist = snapshot["accept_hist"]
+            init_z = snapshot["init_z"]
+            kernel.load_state_dict(snapshot["kernel"])
+            # mean acceptance probability at every temperature
+            acceptance_trace = list(snapshot["acceptance_trace"])
+            realized = snapshot["realized"]
+            num_done = snapshot["num_done"]
+            shards.restore_rng_state(snapshot)
+            snapshot = None
+            print(f"Resuming batch {batch_idx} after {num_done} transitions")
+        else:
+            if seed is not None:
+                # independent and reproducible random stream for every batch
+                torch.manual_seed(seed + batch_idx)
+
+            accept_hist = torch.zeros(size=(num_chains,), device=device)
+            logw = torch.zeros(size=(num_chains,), device=device)
+
+            # initial sample of z
+            if bdmc:
+                current_z = torch.cat(
+                    [
+                        torch.randn(size=(batch_size, 784), device=device),
+                        _encode_batch(batch, flow, flow_name, scaler, device),
+                    ]
+                )
+            elif forward:
+                current_z = torch.randn(size=(batch_size, 784), device=device)
+            else:
+                current_z = _encode_batch(batch, flow, flow_name, scaler, device)
+
+            init_z = current_z.detach().cpu().clone()
+            acceptance_trace = []
+            realized = [t_start] if schedule is None else None
+            num_done = 0
+
+        def maybe_snapshot(num_done):
+            if snapshot_interval <= 0 or num_done % snapshot_interval != 0:
+                return
+            shards.save_snapshot(
+                snapshot_file,
+                run_settings=run_settings,
+                batch_idx=batch_idx,
+                num_done=num_done,
+                current_z=current_z,
+                logw=logw,
+                accept_hist=accept_hist,
+                init_z=init_z,
+                kernel=kernel.state_dict(),
+                acceptance_trace=acceptance_trace,
+                realized=realized,
+            )
 
+        def transition(current_z, accept_hist, t1):
+            grad_U = get_grad_U(t1)
+            acceptance = 0.0
             for _ in range(num_steps_per_ais_step):
-                # resample velocity
-                current_v = torch.randn_like(current_z)
-                z, v, initial_U, final_U = hmc.hmc_trajectory(
-                    current_z=current_z,
-                    current_v=current_v,
-                    grad_U=grad_U,
-                    epsilon=epsilon,
-                    L=num_hmc_steps,
+                with profiling.phase("ais_hmc"):
+                    current_z, accept_hist, prob = kernel.step(
+                        current_z, grad_U, accept_hist
+                    )
+                acceptance += torch.nan_to_num(prob).mean()
+            acceptance_trace.append(acceptance / num_steps_per_ais_step)
+            return current_z, accept_hist
+
+        if schedule is None:
+            pbar = tqdm()
+            min_step = abs(t_end - t_start) / max_adaptive_steps
+            num_forced = 0
+            while realized[-1] != t_end:
+                # choose the next temperature and update log importance weight
+                t1, increment, forced = schedules.next_adaptive_time(
+                    ratio_fn,
+                    current_z,
+                    logw,
+                    realized[-1],
+                    t_end,
+                    target_cess,
+                    min_step=min_step,
                 )
-                current_z, accept_hist = hmc.accept_reject(
-                    current_z=current_z,
-                    current_v=current_v,
-                    z=z,
-                    v=v,
-                    accept_hist=accept_hist,
-                    initial_U=initial_U,
-                    final_U=final_U,
-                    K=normalized_kinetic,
+                num_forced += forced
+                logw += increment
+                realized.append(t1)
+                current_z, accept_hist = transition(
+                    current_z, accept_hist, torch.tensor(t1, device=device)
                 )
-                num_accept_reject += 1
+                num_done += 1
+                maybe_snapshot(num_done)
+                pbar.update(1)
+            schedule = torch.tensor(realized, dtype=torch.float32, device=device)
+            print(f"Adaptive schedule has {len(schedule) - 1} steps")
+            if num_forced > 0:
+                logging.warning(
+                    "%d adaptive AIS steps missed the target CESS %g at the "
+                    "minimum step %g, consider a larger max_adaptive_steps"
+                    % (num_forced, target_cess, min_step)
+                )
+            if schedule_path is not None:
+                schedules.save_schedule(schedule_path, realized, schedule_settings)
+        else:
+            for i in tqdm(range(num_done, len(schedule) - 1)):
+                t0, t1 = temperatures(i), temperatures(i + 1)
 
-        t1 = schedule[-1]
+                # update log importance weight
+                logw += ratio_fn(current_z, t0, t1)
 
-        # Let's continue to run the sampler to obtain more accurate samples
-
-        @torch.enable_grad
-        def grad_U(z):
-            # assuming the base distribution is standard normal, which is true for all flows that we actually use
-            logp_0 = logp_0_fn(z)
-            dlogp_0 = dlogp_0_fn(z)
-            ratio, dratio = dratio_fn(z, t1)
-            return (-logp_0 - ratio).detach(), (-dlogp_0 - dratio).detach()
+                current_z, accept_hist = transition(current_z, accept_hist, t1)
+                num_done += 1
+                maybe_snapshot(num_done)
 
-        for _ in tqdm(range(num_continue)):
-            current_v = torch.randn_like(current_z)
-            z, v, initial_U, final_U = hmc.hmc_trajectory(
-                current_z=current_z,
-                current_v=current_v,
-                grad_U=grad_U,
-                epsilon=epsilon,
-                L=num_hmc_steps,
-            )
-            current_z, accept_hist = hmc.accept_reject(
-                current_z=current_z,
-                current_v=current_v,
-                z=z,
-                v=v,
+        # Let's continue to run the sampler to obtain more accurate samples
+        num_temperatures = len(schedule) - 1
+        grad_U = get_grad_U(temperatures(num_temperatures))
+        for _ in tqdm(range(num_done - num_temperatures, num_continue)):
+            with profiling.phase("ais_hmc"):
+                current_z, accept_hist, _ = kernel.step(current_z, grad_U, accept_hist)
+            num_done += 1
+            maybe_snapshot(num_done)
+
+        step_size = kernel.step_size
+        if bdmc:
+            # only the log weights of the reverse chains are kept
+            reverse_logw = logw[batch_size:]
+            logw, current_z = logw[:batch_size], current_z[:batch_size]
+            accept_hist, init_z = accept_hist[:batch_size], init_z[:batch_size]
+            step_size = step_size[:batch_size]
+
+        ais_x = _decode_samples(current_z, flow, flow_name, inverse_scaler)
+        num_accept_reject = num_temperatures * num_steps_per_ais_step + num_continue
+
+        results.append(
+            dict(
+                batch_idx=batch_idx,
+                logws=logw,
+                x=ais_x,
+                z=current_z,
+                init_z=init_z,
                 accept_hist=accept_hist,
-                initial_U=initial_U,
-                final_U=final_U,
-                K=normalized_kinetic,
+                step_size=step_size,
+                acceptance_trace=torch.stack(acceptance_trace)[None],
             )
-            num_accept_reject += 1
-
-        assert num_accept_reject == (
-            (len(schedule) - 1) * num_steps_per_ais_step + num_continue
         )
-
-        # adapted from losses.py
-        train = False
-
-        with torch.no_grad():
-            if "none" not in flow_name:
-                if flow_name in ["mintnet", "nice", "realnvp"]:
-                    # map z -> x via flow, then rescale to [-1, 1]
-                    ais_x = flow.module.sampling(current_z, rescale=True)
-                else:
-                    if "noise" in flow_name or "copula" in flow_name:
-                        ais_x = flow.module.sample(
-                            current_z.view(batch_size, -1),
-                            context=None,
-                            rescale=True,
-                            transform=True,
-                            train=train,
-                        )
-                    else:
-                        ais_x = flow.module.sample(
-                            current_z.view(batch_size, -1), context=None, rescale=True
-                        )
-            else:
-                ais_x = current_z.view((-1, 1, 28, 28))
-
-            ais_x = inverse_scaler(ais_x)
-
-        logws.append(logw)
-        samples.append(ais_x)
-        z_samples.append(current_z)
-        accept_hists.append(accept_hist)
-
-    init_zs = torch.cat(init_zs, dim=0)
-    logws = torch.cat(logws, dim=0)
-    samples = torch.cat(samples, dim=0)
-    z_samples = torch.cat(z_samples, dim=0)
-    accept_hists = torch.cat(accept_hists, dim=0)
-
-    assert init_zs.shape[0] == num_ais_samples
-    assert logws.shape[0] == num_ais_samples
-    assert samples.shape[0] == num_ais_samples
-    assert accept_hists.shape[0] == num_ais_samples
+        if bdmc:
+            results[-1]["reverse_logws"] = reverse_logw
+        if shard_dir is not None:
+            shards.save_shard(
+                shard_file,
+                results,
+                ais_method=ais_method,
+                num_accept_reject=num_accept_reject,
+                run_settings=run_settings,
+                schedule=schedule.cpu(),
+            )
+            # the batch is in the shard file now
+            if os.path.exists(snapshot_file):
+                os.remove(snapshot_file)
+
+        if bdmc:
+            bounds = shards.bdmc_stats(
+                torch.cat([r["logws"] for r in results]).cpu().numpy(),
+                torch.cat([r["reverse_logws"] for r in results]).cpu().numpy(),
+            )
+            gap_trace.append(bounds["sandwich_gap"])
+            print(
+                "{} chains: log normalizer in [{:.4f}, {:.4f}], gap {:.4f}".format(
+                    len(results) * batch_size,
+                    bounds["log_normalizer_lower"],
+                    bounds["log_normalizer_upper"],
+                    bounds["sandwich_gap"],
+                )
+            )
+            if bdmc_gap_tol > 0 and bounds["sandwich_gap"] < bdmc_gap_tol:
+                print(f"Sandwich gap below {bdmc_gap_tol}, stopping early")
+                stopped_early = True
+                break
+
+    if not results:
+        raise ValueError(f"AIS shard {shard_id} of {num_shards} has no batches")
+
+    init_zs = torch.cat([r["init_z"] for r in results], dim=0)
+    logws = torch.cat([r["logws"] for r in results], dim=0)
+    samples = torch.cat([r["x"] for r in results], dim=0)
+    z_samples = torch.cat([r["z"] for r in results], dim=0)
+    accept_hists = torch.cat([r["accept_hist"] for r in results], dim=0)
+    step_sizes = torch.cat([r["step_size"] for r in results], dim=0)
+    acceptance_trace = torch.cat([r["acceptance_trace"] for r in results], dim=0)
+
+    if num_shards == 1 and not stopped_early:
+        assert init_zs.shape[0] == num_ais_samples
+        assert logws.shape[0] == num_ais_samples
+        assert samples.shape[0] == num_ais_samples
+        assert accept_hists.shape[0] == num_ais_samples
 
     acceptance_rate = np.mean(accept_hists.cpu().numpy()) / num_accept_reject
     print(f"Acceptance rate: {acceptance_rate:.3f}")
 
+    stats = shards.log_normalizer_stats(logws.cpu().numpy(), forward=forward)
+    stats["acceptance_trace"] = acceptance_trace.mean(0).cpu().numpy()
+    stats["step_size"] = step_sizes.cpu().numpy()
+    stats["schedule"] = schedule.cpu().numpy()
+    if bdmc:
+        reverse_logws = torch.cat([r["reverse_logws"] for r in results], dim=0)
+        stats.update(
+            shards.bdmc_stats(logws.cpu().numpy(), reverse_logws.cpu().numpy())
+        )
+        stats["reverse_logws"] = reverse_logws.cpu().numpy()
+        stats["gap_trace"] = np.array(gap_trace)
     log_normalizer = utils.logmeanexp(
         logws.view(
             -1,
@@ -330,4 +606,12 @@ def ais_fn(
     if not forward:
         log_normalizer = -log_normalizer
 
-    return samples, z_samples, init_zs, logws, log_normalizer, acceptance_rate
+    return (
+        samples,
+        z_samples,
+        init_zs,
+        logws,
+        log_normalizer,
+        acceptance_rate,
+        stats,
+    )
@@ -26,6 +26,15 @@ def safe_repeat(x, n):
     return x.repeat(n, *[1 for _ in range(len(x.size()) - 1)])
 
 
+def _per_sample_interval(time1, time2, num_samples, conditional, eps, device):
+    """Integration bounds in model time for AIS temperatures given per sample."""
+    time1 = time1.to(device=device, dtype=torch.float32).expand(num_samples)
+    time2 = time2.to(device=device, dtype=torch.float32).expand(num_samples)
+    if not conditional:
+        return torch.clamp(1.0 - time1, min=eps), torch.clamp(1.0 - time2, min=eps)
+    return torch.clamp(time1, max=1.0 - eps), torch.clamp(time2, max=1.0 - eps)
+
+
 def get_ratio_fn_flow(
     score_model,
     flow,
@@ -62,13 +71,22 @@ def get_ratio_fn_flow(
 
     # print('I am in the correct DRE function!')
     def ratio_fn(u, time1, time2):
-        time1 = time1.item()
-        time2 = time2.item()
-
-        if not conditional:
-            times = (max(1.0 - time1, eps), max(1.0 - time2, eps))
+        # with a time per sample (e.g. forward and reverse BDMC chains in one
+        # batch), integrate over s in [0, 1] with t = start + s (end - start)
+        per_sample = time1.numel() > 1 or time2.numel() > 1
+        if per_sample:
+            start, end = _per_sample_interval(
+                time1, time2, u.shape[0], conditional, eps, device
+            )
+            times = (0.0, 1.0)
         else:
-            times = (min(time1, 1.0 - eps), min(time2, 1.0 - eps))
+            time1 = time1.item()
+            time2 = time2.item()
+
+            if not conditional:
+                times = (max(1.0 - time1, eps), max(1.0 - time2, eps))
+            else:
+                times = (min(time1, 1.0 - eps), min(time2, 1.0 - eps))
 
         with torch.no_grad():
             if use_zt:
@@ -99,10 +117,14 @@ def get_ratio_fn_flow(
             def ode_func(t, y, x, score_model):
                 score_fn = score_fn_fn(score_model)
 
-                t = torch.full((num_samples,), t, device=device)
-                t = t.detach()
-                # assume it is only time score
-                rx = score_fn(x, t)  # get timewise-scores only
+                if per_sample:
+                    t = (start + t * (end - start)).detach()
+                    rx = score_fn(x, t).reshape(-1) * (end - start)
+                else:
+                    t = torch.full((num_samples,), t, device=device)
+                    t = t.detach()
+                    # assume it is only time score
+                    rx = score_fn(x, t)  # get timewise-scores only
                 rx = np.reshape(rx.detach().cpu().numpy(), -1)
 
                 return rx
@@ -166,16 +188,27 @@ def get_torchdiffeq_dratio_fn_flow(
         )
 
     def ratio_fn(u, time):
-        time = time.item()
+        # see get_ratio_fn_flow for times given per sample
+        per_sample = time.numel() > 1
+        if per_sample:
+            start, end = _per_sample_interval(
+                torch.zeros_like(time), time, u.shape[0], conditional, eps, device
+            )
+            is_zero = bool(torch.all(start == end))
+        else:
+            time = time.item()
+            is_zero = math.isclose(time, 0.0)
 
-        if math.isclose(time, 0.0):
+        if is_zero:
             return torch.zeros(
                 (u.shape[0]), requires_grad=False, dtype=torch.float32, device=device
             ), torch.zeros_like(
                 u, requires_grad=False, dtype=torch.float32, device=device
             )
 
-        if not conditional:
+        if per_sample:
+            times = (0.0, 1.0)
+        elif not conditional:
             times = (1.0, max(1.0 - time, eps))
         else:
             times = (0.0, min(time, 1.0 - eps))
@@ -217,6 +250,9 @@ def get_torchdiffeq_dratio_fn_flow(
 
             def forward(self, t, y):
                 t_tensor = t.expand(num_samples).to(dtype=torch.float32)
+                if per_sample:
+                    t_tensor = start + t_tensor * (end - start)
+                    return self.score_fn(self.x, t_tensor).reshape(-1) * (end - start)
                 # assume it is only time score
                 return self.score_fn(self.x, t_tensor).reshape(-1)
 
@@ -0,0 +1,139 @@
+"""Annealing schedules for AIS/RAISE.
+
+Besides the uniform schedule, the next temperature can be chosen adaptively:
+starting from t0, t1 is found by bisection such that the conditional effective
+sample size (CESS, Zhou et al. 2016, https://arxiv.org/abs/1303.3123) of the
+incremental weights log w_t1 - log w_t0 = ratio_fn(z, t0, t1) matches a target.
+Steps are then long where the intermediate targets barely change and short
+where they do, but never shorter than a minimum step, which bounds the number
+of temperatures. The realized schedule is saved together with the settings it
+was adapted for, so it is computed once per checkpoint and then reused for all
+remaining batches and shards with the same settings.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from utils import atomic_savez
+
+
+def linear_schedule(num_steps, eps, forward, device=None):
+    schedule = torch.linspace(0.0, 1.0 - eps, num_steps + 1, device=device)
+    if not forward:
+        schedule = torch.flip(schedule, dims=(0,))
+    return schedule.contiguous()
+
+
+def conditional_ess(logw, increment):
+    """CESS in (0, 1] of the incremental weights, given the current weights."""
+    log_W = logw - torch.logsumexp(logw, dim=0)
+    increment = increment - torch.max(increment)
+    num = 2 * torch.logsumexp(log_W + increment, dim=0)
+    den = torch.logsumexp(log_W + 2 * increment, dim=0)
+    return torch.exp(num - den).item()
+
+
+def next_adaptive_time(
+    ratio_fn,
+    z,
+    logw,
+    t0,
+    t_end,
+    target_cess,
+    min_step=0.0,
+    max_bisections=20,
+    tol=1e-6,
+):
+    """Picks the next temperature between t0 and t_end (in either direction).
+
+    Returns t1, the incremental log weights ratio_fn(z, t0, t1), so the caller
+    does not need to evaluate the ratio again, and whether the step was forced
+    to `min_step` although it misses `target_cess`.
+    """
+    device = z.device
+
+    def increment_fn(t1):
+        return ratio_fn(
+            z, torch.tensor(t0, device=device), torch.tensor(t1, device=device)
+        )
+
+    increment = increment_fn(t_end)
+    if conditional_ess(logw, increment) >= target_cess:
+        return t_end, increment, False
+    if abs(t_end - t0) <= min_step:
+        return t_end, increment, True
+
+    # the CESS decreases with the distance to t0
+    direction = 1.0 if t_end > t0 else -1.0
+    t_min = t0 + direction * min_step
+    lo, hi = t0, t_end
+    lo_increment, hi_increment = None, increment
+    for _ in range(max_bisections):
+        mid = 0.5 * (lo + hi)
+        mid_increment = increment_fn(mid)
+        if conditional_ess(logw, mid_increment) >= target_cess:
+            lo, lo_increment = mid, mid_increment
+        else:
+            hi, hi_increment = mid, mid_increment
+        if abs(hi - lo) < tol or direction * (t_min - hi) >= 0:
+            break
+
+    if lo_increment is not None and direction * (lo - t_min) >= 0:
+        return lo, lo_increment, False
+    # only steps shorter than min_step reach the target, or not even the
+    # smallest one tried, still make progress
+    if lo_increment is None and direction * (hi - t_min) > 0:
+        return hi, hi_increment, True
+    if hi != t_min:
+        hi_increment = increment_fn(t_min)
+    return t_min, hi_increment, True
+
+
+def save_schedule(path, schedule, settings):
+    """Saves a realized schedule with the settings it was adapted for."""
+    atomic_savez(
+        path,
+        schedule=np.asarray(schedule, dtype=np.float64),
+        settings=json.dumps(settings, sort_keys=True),
+    )
+
+
+def load_schedule(path, settings, device=None):
+    """The schedule at `path`, None if there is none for these settings."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if str(data["settings"]) != json.dumps(settings, sort_keys=True):
+            return None
+        schedule = data["schedule"]
+    return torch.tensor(schedule, dtype=torch.float32, device=device)
+
+
+def wait_for_schedule(path, settings, device=None, poll_interval=10, timeout=None):
+    """Blocks until another process has written the schedule at `path`.
+
+    Raises a TimeoutError if there is no schedule for `settings` after
+    `timeout` seconds, e.g. because the process adapting it died.
+    """
+    start = time.time()
+    waiting_message_printed = False
+    while True:
+        schedule = load_schedule(path, settings, device)
+        if schedule is not None:
+            return schedule
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError(
+                f"No adaptive AIS schedule at {path} after {timeout} seconds"
+            )
+        if not waiting_message_printed:
+            logging.warning("Waiting for the adaptive AIS schedule at %s" % path)
+            waiting_message_printed = True
+        time.sleep(poll_interval)
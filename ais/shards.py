@@ -0,0 +1,231 @@
+"""Sharded AIS/RAISE runs.
+
+AIS chains are independent, so the batches of the AIS dataloader can be spread
+over several processes (torchrun ranks or separately launched jobs). Shard k of
+n runs the batches with `batch_idx % n == k`, each batch with its own seed, and
+after every finished batch rewrites its results to
+
+    <shard_dir>/shard_<k>_of_<n>.pt
+
+`merge_shards` combines whatever shard files exist into a single estimate of
+the log normalizer with its standard error, so a run where some shards died is
+still usable.
+
+With a snapshot interval, the state of the batch in progress (chain states,
+log weights, HMC adaptation, RNG state and the position in the schedule) is
+also written every few temperatures to
+
+    <shard_dir>/snapshot_<k>_of_<n>.pt
+
+so that a pre-empted shard resumes exactly where it stopped, and the batches
+already in its shard file are not run again. From the command line:
+
+    python ais/shards.py --shard_dir <workdir>/eval/ais_shards_ais_ckpt_26
+"""
+
+import glob
+import math
+import os
+import re
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from utils import atomic_save
+
+_SHARD_RE = re.compile(r"shard_(\d+)_of_(\d+)\.pt$")
+
+# per-chain results stored for every finished batch
+RESULT_KEYS = ["logws", "x", "z", "init_z", "accept_hist", "step_size"]
+# per-batch results, stored with a leading dimension of 1
+BATCH_KEYS = ["acceptance_trace"]
+# per-chain results of BDMC runs only, the log weights of the reverse chains
+BDMC_KEYS = ["reverse_logws"]
+
+
+def _keys(batch):
+    keys = RESULT_KEYS + BATCH_KEYS
+    return keys + [key for key in BDMC_KEYS if key in batch]
+
+
+def shard_path(shard_dir, shard_id, num_shards):
+    return os.path.join(shard_dir, f"shard_{shard_id}_of_{num_shards}.pt")
+
+
+def snapshot_path(shard_dir, shard_id, num_shards):
+    return os.path.join(shard_dir, f"snapshot_{shard_id}_of_{num_shards}.pt")
+
+
+def save_snapshot(path, **state):
+    """Writes the state of the running batch together with the RNG state."""
+    state["rng_state"] = torch.get_rng_state()
+    if torch.cuda.is_available():
+        state["cuda_rng_state"] = torch.cuda.get_rng_state_all()
+    atomic_save(state, path)
+
+
+def load_snapshot(path, device=None):
+    return torch.load(path, map_location=device)
+
+
+def restore_rng_state(state):
+    """Sets the RNG state stored by `save_snapshot`."""
+    torch.set_rng_state(state["rng_state"].cpu())
+    if state.get("cuda_rng_state") is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda_rng_state"]])
+
+
+def save_shard(path, batches, **meta):
+    """Writes the finished batches of a shard, replacing the previous file.
+
+    batches: list of dicts with a `batch_idx` and the tensors in RESULT_KEYS
+    and BATCH_KEYS.
+    """
+    record = dict(meta)
+    record["batch_idx"] = [b["batch_idx"] for b in batches]
+    for key in _keys(batches[0]):
+        record[key] = [b[key].detach().cpu() for b in batches]
+    atomic_save(record, path)
+
+
+def load_shard(path):
+    record = torch.load(path, map_location="cpu")
+    batches = []
+    keys = _keys(record)
+    for i, batch_idx in enumerate(record["batch_idx"]):
+        batch = {key: record[key][i] for key in keys}
+        batch["batch_idx"] = batch_idx
+        batches.append(batch)
+    return batches, {k: v for k, v in record.items() if k not in keys}
+
+
+def log_normalizer_stats(logws, forward=True):
+    """Log normalizer estimate from AIS (forward) or RAISE log weights.
+
+    The standard error follows from the delta method,
+    se(log mean w) = std(w) / (sqrt(n) mean(w)), computed relative to the
+    largest weight for stability. `ess` is the effective sample size of the
+    importance weights.
+    """
+    logws = np.asarray(logws, dtype=np.float64).reshape(-1)
+    n = len(logws)
+    w = np.exp(logws - np.max(logws))
+    mean_w = np.mean(w)
+    log_normalizer = np.log(mean_w) + np.max(logws)
+    se = np.std(w) / math.sqrt(n) / mean_w if n > 1 else np.inf
+    if not forward:
+        log_normalizer = -log_normalizer
+    return dict(
+        log_normalizer=float(log_normalizer),
+        log_normalizer_se=float(se),
+        ess=float(np.sum(w) ** 2 / np.sum(w**2)),
+        n_chains=n,
+    )
+
+
+def bdmc_stats(logws, reverse_logws):
+    """Sandwich bounds on the log normalizer from forward and reverse chains.
+
+    AIS gives a stochastic lower bound, RAISE a stochastic upper bound; their
+    difference bounds the error of either estimate.
+    """
+    lower = log_normalizer_stats(logws, forward=True)
+    upper = log_normalizer_stats(reverse_logws, forward=False)
+    return dict(
+        log_normalizer_lower=lower["log_normalizer"],
+        log_normalizer_lower_se=lower["log_normalizer_se"],
+        log_normalizer_upper=upper["log_normalizer"],
+        log_normalizer_upper_se=upper["log_normalizer_se"],
+        sandwich_gap=upper["log_normalizer"] - lower["log_normalizer"],
+    )
+
+
+def merge_shards(shard_dir, forward=True):
+    """Combines all shard files in `shard_dir`, ordered by batch index.
+
+    Returns a dict with the concatenated per-chain results, the statistics of
+    `log_normalizer_stats`, the mean acceptance probability at every
+    temperature, the annealing schedule and the ids of shards that have no
+    file yet. For BDMC runs
+    it also contains the `bdmc_stats` of the forward and reverse chains.
+    """
+    paths = [p for p in glob.glob(os.path.join(shard_dir, "shard_*.pt"))]
+    paths = [p for p in paths if _SHARD_RE.search(p)]
+    if not paths:
+        raise FileNotFoundError(f"No AIS shards found in {shard_dir}")
+
+    num_shards = {int(_SHARD_RE.search(p).group(2)) for p in paths}
+    if len(num_shards) > 1:
+        raise ValueError(f"Shards of runs with different num_shards: {num_shards}")
+    num_shards = num_shards.pop()
+
+    batches = []
+    found = set()
+    num_accept_reject = None
+    schedule = None
+    for path in paths:
+        shard_batches, meta = load_shard(path)
+        batches.extend(shard_batches)
+        found.add(int(_SHARD_RE.search(path).group(1)))
+        num_accept_reject = meta.get("num_accept_reject", num_accept_reject)
+        if meta.get("schedule") is not None:
+            if schedule is not None and not torch.equal(schedule, meta["schedule"]):
+                raise ValueError(f"Shards in {shard_dir} used different schedules")
+            schedule = meta["schedule"]
+    batches.sort(key=lambda b: b["batch_idx"])
+
+    merged = {key: torch.cat([b[key] for b in batches]) for key in _keys(batches[0])}
+    merged["acceptance_trace"] = merged["acceptance_trace"].mean(0)
+    merged["batch_idx"] = [b["batch_idx"] for b in batches]
+    merged["missing_shards"] = sorted(set(range(num_shards)) - found)
+    if schedule is not None:
+        merged["schedule"] = schedule
+    if num_accept_reject:
+        merged["acceptance_rate"] = float(
+            merged["accept_hist"].float().mean() / num_accept_reject
+        )
+    merged.update(log_normalizer_stats(merged["logws"].numpy(), forward=forward))
+    if "reverse_logws" in merged:
+        merged.update(
+            bdmc_stats(merged["logws"].numpy(), merged["reverse_logws"].numpy())
+        )
+    return merged
+
+
+def main(argv):
+    merged = merge_shards(FLAGS.shard_dir, forward=FLAGS.method != "raise")
+    if merged["missing_shards"]:
+        print(f"missing shards: {merged['missing_shards']}")
+    print(
+        "{} chains from {} batches: log normalizer {:.4f} +- {:.4f}, ess {:.1f}".format(
+            merged["n_chains"],
+            len(merged["batch_idx"]),
+            merged["log_normalizer"],
+            merged["log_normalizer_se"],
+            merged["ess"],
+        )
+    )
+    if "sandwich_gap" in merged:
+        print(
+            "log normalizer in [{:.4f}, {:.4f}], gap {:.4f}".format(
+                merged["log_normalizer_lower"],
+                merged["log_normalizer_upper"],
+                merged["sandwich_gap"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    from absl import app
+    from absl import flags
+
+    FLAGS = flags.FLAGS
+    flags.DEFINE_string("shard_dir", None, "directory with the shard files")
+    flags.DEFINE_enum(
+        "method", "ais", ["ais", "raise", "bdmc"], "direction of the chains"
+    )
+    flags.mark_flags_as_required(["shard_dir"])
+    app.run(main)
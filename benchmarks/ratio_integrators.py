@@ -0,0 +1,290 @@
+"""Accuracy, NFE, wall-clock time and memory of the density-ratio integrators.
+
+Every method of `density_ratios.integrate_time_score` integrates the exact
+time scores of `toy_marginals` (so errors are due to the integrator, not to a
+trained network) through `density_ratios.get_toy_density_ratio_fn` on fixed
+problems:
+
+- gaussians_d<dim>: the OneVP path to the Gaussians toy dataset,
+- gmms_d<dim>_k<k>: the TwoSB path between the GMMs toy datasets,
+- mnist_flow: the OneVP path from N(0, I) to the diagonal Gaussian with the
+  pixel moments of MNIST in the logit space of the Gaussian copula flow
+  (flow_ckpts/data_means.p), i.e. a 784-dimensional flow-space model with
+  log ratios of thousands of nats.
+
+The evaluation points are half from p and half from q, drawn with a fixed
+seed. Errors are against the closed-form log ratios, `log_density_ratios` of
+the toy datasets. The ratio interval is (eps1, 1 - eps2) of the toy configs,
+so the errors include the truncation at the ends of the path. Peak memory is
+the tracemalloc peak of a separate run, which covers numpy and Python
+allocations such as the solver states of scipy, plus the peak of the torch
+allocator on CUDA. Torch tensors on the CPU are not traced, so the states of
+the torchdiffeq solvers only count on CUDA.
+
+--baseline compares against a stored run with the same --n_points and --seed
+and reports larger errors or NFEs, and wall times or memory larger by more
+than --time_tolerance; those lines are marked with REGRESSION. Run from the
+repository root:
+
+    python benchmarks/ratio_integrators.py \\
+      --baseline=benchmarks/baselines/ratio_integrators.json
+    python benchmarks/ratio_integrators.py --methods=RK45,gauss_legendre_32 \\
+      --tolerances=1e-4 --out=ratio_integrators.json
+"""
+
+import contextlib
+import io
+import json
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import density_ratios
+import toy_datasets
+import toy_marginals
+from configs.gaussians.time import mlp as gaussians_config
+from configs.gmms.time import mlp as gmms_config
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+    "problems",
+    ["gaussians_d2", "gaussians_d40", "gmms_d2_k1", "gmms_d2_k4", "gmms_d20_k2"]
+    + ["mnist_flow"],
+    "gaussians_d<dim>, gmms_d<dim>_k<k> or mnist_flow",
+)
+flags.DEFINE_list(
+    "methods",
+    ["RK45", "DOP853", "LSODA", "torchdiffeq_dopri5"]
+    + ["gauss_legendre_16", "gauss_legendre_64"],
+    "methods of density_ratios.integrate_time_score",
+)
+flags.DEFINE_list(
+    "tolerances",
+    ["1e-3", "1e-6"],
+    "rtol = atol of the adaptive methods, ignored by the quadratures",
+)
+flags.DEFINE_integer("n_points", 1000, "evaluation points, half from p and q")
+flags.DEFINE_integer("repeats", 3, "timed runs per case, the median is reported")
+flags.DEFINE_integer("seed", 0, "seed of the evaluation points")
+flags.DEFINE_string("baseline", None, "json of a previous run to compare against")
+flags.DEFINE_float(
+    "error_tolerance", 1e-3, "relative slack before a larger error is a regression"
+)
+flags.DEFINE_float(
+    "time_tolerance",
+    1.5,
+    "factor before a longer time or more memory is one, on top of 10ms and 1MB",
+)
+flags.DEFINE_string("out", None, "optional json file the results are written to")
+
+
+class FlowSpaceGaussians(object):
+    """p = N(0, I) and q = the diagonal Gaussian of the copula flow moments."""
+
+    def __init__(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.path.join(root, "flow_ckpts", "data_means.p"), "rb") as fp:
+            data_stats = pickle.load(fp)
+        mean = data_stats["train_mean"].flatten().double()
+        std = data_stats["train_std"].flatten().double()
+        self.p = torch.distributions.Independent(
+            torch.distributions.Normal(torch.zeros_like(mean), torch.ones_like(std)),
+            1,
+        )
+        self.q = torch.distributions.Independent(
+            torch.distributions.Normal(mean, std), 1
+        )
+
+    def log_density_ratios(self, samples):
+        return (self.q.log_prob(samples) - self.p.log_prob(samples)).view(-1, 1)
+
+
+def get_problem(name):
+    """Returns the toy config, dataset and exact score model of a problem."""
+    if name == "mnist_flow":
+        config = gaussians_config.get_config()
+        dataset = FlowSpaceGaussians()
+        marginal = toy_marginals.AnalyticTimeMarginal(
+            toy_marginals.DiagonalGaussianMixture.from_distribution(dataset.p),
+            toy_marginals.DiagonalGaussianMixture.from_distribution(dataset.q),
+            toy_marginals.VPInterpolant(),
+        )
+        return config, dataset, toy_marginals.OracleTimeScoreModel(marginal)
+
+    fields = dict((field[0], int(field[1:])) for field in name.split("_")[1:])
+    if name.startswith("gaussians_"):
+        config = gaussians_config.get_config()
+    elif name.startswith("gmms_"):
+        config = gmms_config.get_config()
+        config.data.k = fields["k"]
+    else:
+        raise NotImplementedError(f"Problem {name} not supported yet!")
+    config.data.dim = fields["d"]
+    config.device = torch.device("cpu")
+    dataset = toy_datasets.get_dataset(config)
+    return config, dataset, toy_marginals.get_oracle_score_model(config, dataset)
+
+
+def get_points(dataset):
+    torch.manual_seed(FLAGS.seed)
+    n = FLAGS.n_points // 2
+    points = torch.cat([dataset.p.sample((n,)), dataset.q.sample((n,))])
+    return points.float()
+
+
+def get_cases():
+    """(method, rtol) pairs, the quadratures only once."""
+    cases = []
+    for method in FLAGS.methods:
+        if method.startswith("gauss_legendre_"):
+            cases.append((method, None))
+        else:
+            cases.extend((method, float(tol)) for tol in FLAGS.tolerances)
+    return cases
+
+
+def peak_memory(fn):
+    """Peak bytes allocated while running fn, see the module docstring."""
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if torch.cuda.is_available():
+        peak += torch.cuda.max_memory_allocated() - start
+    return peak
+
+
+def run_case(config, model, points, logr_true, method, tol):
+    tol = 1e-6 if tol is None else tol
+    density_ratio_fn = density_ratios.get_toy_density_ratio_fn(
+        rtol=tol,
+        atol=tol,
+        method=method,
+        eps1=config.data.eps1,
+        eps2=config.data.eps2,
+    )
+
+    def evaluate():
+        # the ratio function prints its number of function evaluations
+        with contextlib.redirect_stdout(io.StringIO()):
+            return density_ratio_fn(model, points, score_type="time")
+
+    times = []
+    for _ in range(FLAGS.repeats):
+        t0 = time.perf_counter()
+        est_logr, nfe = evaluate()
+        times.append(time.perf_counter() - t0)
+    errors = np.abs(est_logr - logr_true)
+    return dict(
+        mean_abs_error=float(np.mean(errors)),
+        max_abs_error=float(np.max(errors)),
+        mse=float(np.mean(np.square(est_logr - logr_true))),
+        nfe=int(nfe),
+        seconds=float(np.median(times)),
+        peak_bytes=int(peak_memory(evaluate)),
+    )
+
+
+def case_name(method, tol):
+    return method if tol is None else f"{method}@{tol:g}"
+
+
+def compare(result, baseline):
+    """Regressions of a case against its baseline, as a list of strings."""
+    regressions = []
+    slack = 1.0 + FLAGS.error_tolerance
+    if result["mean_abs_error"] > slack * baseline["mean_abs_error"] + 1e-12:
+        regressions.append(
+            "error %.3e > %.3e"
+            % (result["mean_abs_error"], baseline["mean_abs_error"])
+        )
+    if result["nfe"] > baseline["nfe"]:
+        regressions.append("nfe %d > %d" % (result["nfe"], baseline["nfe"]))
+    if result["seconds"] > FLAGS.time_tolerance * baseline["seconds"] + 0.01:
+        regressions.append(
+            "time %.3fs > %.3fs" % (result["seconds"], baseline["seconds"])
+        )
+    if result["peak_bytes"] > FLAGS.time_tolerance * baseline["peak_bytes"] + 2**20:
+        regressions.append(
+            "memory %.1fMB > %.1fMB"
+            % (result["peak_bytes"] / 2**20, baseline["peak_bytes"] / 2**20)
+        )
+    return regressions
+
+
+def main(argv):
+    baseline = {}
+    if FLAGS.baseline:
+        with open(FLAGS.baseline) as f:
+            stored = json.load(f)
+        # errors and times depend on the evaluation points
+        for setting in ["n_points", "seed"]:
+            if stored[setting] != getattr(FLAGS, setting):
+                raise app.UsageError(
+                    f"{FLAGS.baseline} was run with --{setting}={stored[setting]}, "
+                    f"cannot compare a run with --{setting}={getattr(FLAGS, setting)}"
+                )
+        baseline = stored["results"]
+
+    results = {}
+    num_regressions = 0
+    for problem in FLAGS.problems:
+        config, dataset, model = get_problem(problem)
+        points = get_points(dataset)
+        logr_true = dataset.log_density_ratios(points).squeeze().numpy()
+        print(
+            f"{problem}: {points.shape[0]} points of dim {points.shape[1]}, "
+            f"|log r| up to {np.max(np.abs(logr_true)):.1f}"
+        )
+        print(
+            f"{'':>26} {'mean err':>10} {'max err':>10} {'nfe':>6} "
+            f"{'seconds':>8} {'peak MB':>8}"
+        )
+        results[problem] = {}
+        for method, tol in get_cases():
+            name = case_name(method, tol)
+            result = run_case(config, model, points, logr_true, method, tol)
+            results[problem][name] = result
+            line = (
+                f"{name:>26} {result['mean_abs_error']:10.3e} "
+                f"{result['max_abs_error']:10.3e} {result['nfe']:6d} "
+                f"{result['seconds']:8.3f} {result['peak_bytes'] / 2**20:8.1f}"
+            )
+            if name in baseline.get(problem, {}):
+                regressions = compare(result, baseline[problem][name])
+                if regressions:
+                    num_regressions += 1
+                    line += "  REGRESSION: " + ", ".join(regressions)
+            print(line)
+
+    if FLAGS.baseline:
+        print(f"{num_regressions} regressions against {FLAGS.baseline}")
+    if FLAGS.out:
+        with open(FLAGS.out, "w") as f:
+            json.dump(
+                dict(
+                    n_points=FLAGS.n_points,
+                    seed=FLAGS.seed,
+                    torch=torch.__version__,
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,109 @@
+"""Measures interpreter startup and import cost for each entry point of main.py.
+
+Every measurement runs in a fresh interpreter so that nothing is cached in
+sys.modules. Run from the repository root:
+
+    python benchmarks/startup_time.py --repeats 10 --out startup.json
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+from absl import app
+from absl import flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer("repeats", 5, "number of fresh interpreters per mode")
+flags.DEFINE_list("modes", None, "subset of modes to benchmark, default all")
+flags.DEFINE_string("out", None, "optional json file the results are written to")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules imported by main.py for each mode
+MODES = {
+    "toy": ["toy_run_lib"],
+    "flow": ["run_lib_rqnsf_flow"],
+    "flow_legacy": ["run_lib_flow"],
+    "score": ["run_lib"],
+}
+
+# heavy dependencies that should only be loaded by the modes that need them
+WATCHED = [
+    "matplotlib",
+    "seaborn",
+    "wandb",
+    "tensorflow",
+    "tensorflow_gan",
+    "torchvision",
+    "jax",
+    "pandas",
+]
+
+_SNIPPET = """
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+{imports}
+t2 = time.perf_counter()
+print(json.dumps(dict(
+    main=t1 - t0,
+    mode=t2 - t1,
+    loaded=[m for m in {watched!r} if m in sys.modules],
+)))
+"""
+
+
+def run_once(modules):
+    imports = "\n".join(f"import {m}" for m in modules)
+    code = _SNIPPET.format(imports=imports, watched=WATCHED)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True
+    )
+    total = time.perf_counter() - start
+    if proc.returncode != 0:
+        return dict(error=proc.stderr.strip().splitlines()[-1])
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["total"] = total
+    return result
+
+
+def benchmark_mode(modules, repeats):
+    runs = [run_once(modules) for _ in range(repeats)]
+    if "error" in runs[0]:
+        return dict(error=runs[0]["error"])
+    summary = dict(loaded=runs[0]["loaded"])
+    for key in ["total", "main", "mode"]:
+        times = np.array([r[key] for r in runs])
+        summary[key] = dict(median=float(np.median(times)), min=float(times.min()))
+    return summary
+
+
+def main(argv):
+    modes = FLAGS.modes or list(MODES.keys())
+    results = {}
+    for mode in modes:
+        results[mode] = res = benchmark_mode(MODES[mode], FLAGS.repeats)
+        if "error" in res:
+            print(f"{mode:>12}: unavailable ({res['error']})")
+            continue
+        print(
+            f"{mode:>12}: total {res['total']['median']:.3f}s "
+            f"(main {res['main']['median']:.3f}s, "
+            f"mode imports {res['mode']['median']:.3f}s), "
+            f"loaded: {', '.join(res['loaded']) or '-'}"
+        )
+
+    if FLAGS.out is not None:
+        with open(FLAGS.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    app.run(main)
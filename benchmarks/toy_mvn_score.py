@@ -0,0 +1,129 @@
+"""Parity and speed of the spectral fast path of the MVN parameter score networks.
+
+Builds toy_param_mvn_mi and toy_full_param_mvn_mi with `model.spectral` off
+(the reference, one matrix inverse per sample) and on, with the same symmetric
+theta. Outputs and the symmetric part of the gradient of theta are compared in
+float64: at large dim the random theta has eigenvalues below -1, so
+I + t^2 theta is close to singular for some t and float32 results of either
+path are not accurate enough for a tight comparison. A forward and backward
+pass of each path is then timed in float32. Run from the repository root:
+
+    python benchmarks/toy_mvn_score.py --dims 40,80,160,320 --batch_size 1000
+"""
+
+import os
+import sys
+import time
+
+import torch
+from absl import app
+from absl import flags
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from configs.default_toy_configs import get_default_configs
+from models import toy_networks
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list("dims", ["40", "80", "160", "320"], "data dimensions")
+flags.DEFINE_integer("batch_size", 1000, "number of samples per forward pass")
+flags.DEFINE_integer("repeats", 5, "timed forward and backward passes")
+flags.DEFINE_float("rtol", 1e-8, "relative tolerance of the float64 parity check")
+flags.DEFINE_bool("time_reference", True, "also time the reference path")
+
+NETWORKS = {
+    "toy_param_mvn_mi": toy_networks.MVNParamScoreNetwork,
+    "toy_full_param_mvn_mi": toy_networks.FullMVNParamScoreNetwork,
+}
+
+
+def build(cls, dim, model_type, spectral, device):
+    config = get_default_configs()
+    config.data.dim = dim
+    config.model.type = model_type
+    config.model.spectral = spectral
+    return cls(config).to(device)
+
+
+def outputs(net, x, t, full):
+    out = net.forward_full(x, t) if full else net(x, t)
+    return list(out) if isinstance(out, tuple) else [out]
+
+
+def relative_error(a, b):
+    return ((a - b).abs().max() / b.abs().max().clamp_min(1e-12)).item()
+
+
+def timed(net, x, t, full, repeats):
+    def run():
+        net.zero_grad()
+        loss = sum(o.square().mean() for o in outputs(net, x, t, full))
+        loss.backward()
+
+    run()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(argv):
+    device = toy_networks.device
+    torch.manual_seed(0)
+    failed = False
+    for dim in map(int, FLAGS.dims):
+        x = torch.randn(FLAGS.batch_size, dim, device=device)
+        # t in (0, 1), away from 1 where forward_full divides by 1 - t^2
+        t = 0.05 + 0.9 * torch.rand(FLAGS.batch_size, 1, device=device)
+        for name, cls in NETWORKS.items():
+            modes = [("forward", False)]
+            if cls is toy_networks.FullMVNParamScoreNetwork:
+                modes.append(("forward_full", True))
+            for model_type in ["time", "joint"]:
+                fast = build(cls, dim, model_type, True, device)
+                reference = build(cls, dim, model_type, False, device)
+                reference.load_state_dict(fast.state_dict())
+                for mode, full in modes:
+                    fast.double(), reference.double()
+                    x64, t64 = x.double(), t.double()
+                    errors = []
+                    for o_fast, o_ref in zip(
+                        outputs(fast, x64, t64, full),
+                        outputs(reference, x64, t64, full),
+                    ):
+                        errors.append(relative_error(o_fast, o_ref))
+                    for net in [fast, reference]:
+                        net.zero_grad()
+                        sum(o.sum() for o in outputs(net, x64, t64, full)).backward()
+                    # the spectral path only depends on the symmetric part of theta
+                    ref_grad = reference.theta.grad
+                    ref_grad = 0.5 * (ref_grad + ref_grad.T)
+                    errors.append(relative_error(fast.theta.grad, ref_grad))
+                    error = max(errors)
+                    failed = failed or error > FLAGS.rtol
+
+                    fast.float(), reference.float()
+                    fast_time = timed(fast, x, t, full, FLAGS.repeats)
+                    line = (
+                        f"dim {dim:4d} {name:>22} {model_type:>5} {mode:>12}: "
+                        f"rel err {error:.1e}, spectral {fast_time * 1e3:8.2f}ms"
+                    )
+                    if FLAGS.time_reference:
+                        ref_time = timed(reference, x, t, full, FLAGS.repeats)
+                        line += (
+                            f", reference {ref_time * 1e3:8.2f}ms "
+                            f"({ref_time / fast_time:.1f}x)"
+                        )
+                    print(line)
+
+    if failed:
+        sys.exit(f"spectral path differs from the reference by more than {FLAGS.rtol}")
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,211 @@
+"""Gradient variance and convergence per wall-clock second of the time samplers.
+
+For a toy config, every sampler of `time_samplers` is compared on
+
+- the variance of the minibatch gradient at initialization, the trace of its
+  covariance over `grad_repeats` fresh batches, and
+- training curves: the validation MSE of the estimated log density ratios
+  (as in toy_run_lib) against steps and training seconds, averaged over seeds.
+
+The summary reports the steps and seconds each sampler needs to reach
+`target_mse`, by default the final validation MSE of the uniform sampler.
+Run from the repository root:
+
+    python benchmarks/toy_time_samplers.py --config configs.gaussians.time.c_full_mlp
+"""
+
+import contextlib
+import importlib
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import density_ratios
+import toy_datasets
+import toy_losses
+from models import utils as mutils
+from models.toy_networks import *
+from time_samplers import TIME_SAMPLERS
+from utils import get_prob_path
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    "config", "configs.gaussians.time.c_full_mlp", "module of the toy config"
+)
+flags.DEFINE_list("samplers", TIME_SAMPLERS, "time samplers to compare")
+flags.DEFINE_integer("n_iters", 2000, "training steps per run")
+flags.DEFINE_integer("eval_freq", 100, "steps between validation MSEs")
+flags.DEFINE_integer("batch_size", None, "overrides training.batch_size")
+flags.DEFINE_integer("seeds", 3, "runs per sampler")
+flags.DEFINE_integer("grad_repeats", 100, "batches for the gradient variance")
+flags.DEFINE_integer("val_size", 1000, "validation points, half from p and q")
+flags.DEFINE_float("target_mse", None, "default: final MSE of the uniform sampler")
+flags.DEFINE_string("out", None, "optional json file the results are written to")
+
+
+def get_config():
+    config = importlib.import_module(FLAGS.config).get_config()
+    config.device = torch.device("cpu")
+    if FLAGS.batch_size:
+        config.training.batch_size = FLAGS.batch_size
+    if config.data.dataset == "GaussiansforMI":
+        raise NotImplementedError("The MI configs are not supported yet!")
+    return config
+
+
+def get_step_fn(config, dataset, time_sampler, optimize_fn):
+    """The training step of toy_run_lib.train with the given time sampler."""
+    prob_path_name = config.training.prob_path
+    one_sided = prob_path_name.startswith("One")
+    if not one_sided and config.training.use_two_sb:
+        if config.training.two_sb_var == 0:
+            interpolate_fn = dataset.sample_sequence_on_the_fly_ot
+        else:
+            interpolate_fn = dataset.sample_sequence_on_the_fly_sb
+    else:
+        interpolate_fn = dataset.sample_sequence_on_the_fly
+    eps1, eps2 = config.data.eps1, config.data.eps2
+    step_fn = toy_losses.get_step_fn(
+        sde=None,
+        train=True,
+        eps1=eps1,
+        eps2=eps2,
+        eps_factor=1.0 - eps1 - eps2,
+        optimize_fn=optimize_fn,
+        reweight=config.training.reweight,
+        conditional=config.training.conditional,
+        prob_path=get_prob_path(config.data.dim, prob_path_name, config),
+        factor=dataset.factor,
+        device=config.device,
+        batch_size=config.training.batch_size,
+        full=config.training.full,
+        interpolate_fn=interpolate_fn,
+        time_sampler=time_sampler,
+    )
+    batch_fn = dataset.one_sample if one_sided else dataset.two_sample
+    return step_fn, batch_fn
+
+
+def new_state(config, seed):
+    torch.manual_seed(seed)
+    model = mutils.create_model(config, name=config.model.name)
+    optimizer = toy_losses.get_optimizer(config, model.parameters())
+    return dict(optimizer=optimizer, model=model, ema=None, step=0)
+
+
+def gradient_variance(config, dataset, time_sampler):
+    """Trace of the covariance of the minibatch gradient at initialization."""
+    step_fn, batch_fn = get_step_fn(
+        config, dataset, time_sampler, optimize_fn=lambda *args, **kwargs: None
+    )
+    state = new_state(config, seed=0)
+    grads = []
+    for _ in range(FLAGS.grad_repeats):
+        step_fn(state, batch_fn(n=config.training.batch_size))
+        grads.append(
+            torch.cat([p.grad.flatten() for p in state["model"].parameters()])
+        )
+    return torch.stack(grads).var(0).sum().item()
+
+
+def train(config, dataset, time_sampler, seed, val_fn):
+    step_fn, batch_fn = get_step_fn(
+        config, dataset, time_sampler, toy_losses.toy_optimization_manager(config)
+    )
+    state = new_state(config, seed)
+    curve = dict(step=[], seconds=[], val_mse=[])
+    seconds = 0.0
+    for step in range(1, FLAGS.n_iters + 1):
+        batch = batch_fn(n=config.training.batch_size)
+        t0 = time.perf_counter()
+        step_fn(state, batch)
+        seconds += time.perf_counter() - t0
+        if step % FLAGS.eval_freq == 0:
+            curve["step"].append(step)
+            curve["seconds"].append(seconds)
+            curve["val_mse"].append(val_fn(state["model"]))
+    return curve
+
+
+def get_val_fn(config, dataset):
+    n = FLAGS.val_size // 2
+    mesh = torch.cat([dataset.p.sample((n,)), dataset.q.sample((n,))])
+    logr_true = dataset.log_density_ratios(mesh).squeeze().numpy()
+    density_ratio_fn = density_ratios.get_toy_density_ratio_fn(
+        rtol=config.eval.rtol,
+        atol=config.eval.atol,
+        eps1=config.data.eps1,
+        eps2=config.data.eps2,
+    )
+
+    def val_fn(model):
+        # the ratio function prints its number of function evaluations
+        with contextlib.redirect_stdout(io.StringIO()):
+            est_logr, _ = density_ratio_fn(model, mesh, score_type=config.model.type)
+        return float(np.mean(np.square(est_logr - logr_true)))
+
+    return val_fn
+
+
+def first_reached(curve, target):
+    below = np.nonzero(np.asarray(curve["val_mse"]) <= target)[0]
+    if len(below) == 0:
+        return None, None
+    return curve["step"][below[0]], curve["seconds"][below[0]]
+
+
+def main(argv):
+    config = get_config()
+    torch.manual_seed(config.seed)
+    dataset = toy_datasets.get_dataset(config)
+    val_fn = get_val_fn(config, dataset)
+
+    results = {}
+    for name in FLAGS.samplers:
+        grad_var = gradient_variance(config, dataset, name)
+        curves = [
+            train(config, dataset, name, seed, val_fn) for seed in range(FLAGS.seeds)
+        ]
+        mean_curve = dict(
+            step=curves[0]["step"],
+            seconds=np.mean([c["seconds"] for c in curves], 0).tolist(),
+            val_mse=np.mean([c["val_mse"] for c in curves], 0).tolist(),
+        )
+        results[name] = dict(grad_var=grad_var, curve=mean_curve)
+        print(
+            f"{name:>11}: gradient variance {grad_var:.3e}, "
+            f"final val MSE {mean_curve['val_mse'][-1]:.3e}, "
+            f"{mean_curve['seconds'][-1]:.1f}s of training"
+        )
+
+    target = FLAGS.target_mse
+    if target is None:
+        target = results.get("uniform", next(iter(results.values())))["curve"]
+        target = target["val_mse"][-1]
+    print(f"steps and training seconds to a val MSE of {target:.3e}:")
+    for name, result in results.items():
+        steps, seconds = first_reached(result["curve"], target)
+        result.update(target_mse=target, steps_to_target=steps)
+        result["seconds_to_target"] = seconds
+        if steps is None:
+            print(f"{name:>11}: not reached")
+        else:
+            print(f"{name:>11}: {steps:6d} steps, {seconds:7.2f}s")
+
+    if FLAGS.out:
+        with open(FLAGS.out, "w") as f:
+            json.dump(dict(config=FLAGS.config, results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -50,6 +50,20 @@ def get_default_configs():
 
     training.epsilons = False
     training.resample_t = False
+    ## how training times are drawn, see time_samplers.py: uniform, stratified,
+    ## antithetic, sobol or importance (an unbiased, reweighted resample_t)
+    training.time_sampler = "uniform"
+    ## (t, epsilon) pairs per encoded data point in the epsilons losses; the flow
+    ## runs once per batch and the score network sees num_times x batch_size inputs
+    training.num_times = 1
+    # torch.distributed (gloo) data-parallel training, launch with torchrun
+    training.distributed = False
+    ## torch threads per process; <= 0 splits the cores of the node evenly
+    training.threads_per_rank = 0
+    # write checkpoints from a background thread (temp file + atomic rename)
+    training.async_checkpoint = True
+    ## number of most recent snapshot checkpoints to keep; <= 0 keeps all
+    training.keep_checkpoints = 0
 
     # sampling
     config.sampling = sampling = ml_collections.ConfigDict()
@@ -57,6 +71,11 @@ def get_default_configs():
     sampling.noise_removal = True
     sampling.probability_flow = False
     sampling.snr = 0.16
+    ## for sampling.method = "dpm_solver": order 1 (DDIM) to 3, number of steps
+    ## and "logSNR", "time_uniform" or "time_quadratic" timesteps
+    sampling.dpm_solver_order = 3
+    sampling.dpm_solver_steps = 10
+    sampling.dpm_solver_schedule = "logSNR"
 
     # evaluation
     config.eval = evaluate = ml_collections.ConfigDict()
@@ -67,21 +86,58 @@ def get_default_configs():
     evaluate.num_samples = 50000
     evaluate.enable_loss = False
     evaluate.enable_bpd = True
+    ## probability flow bpd: Hutchinson probes per function evaluation,
+    ## "hutchinson" or "exact" divergence and "scipy" or "torchdiffeq" ODE solver
+    evaluate.likelihood_num_probes = 1
+    evaluate.likelihood_divergence = "hutchinson"
+    evaluate.likelihood_integrator = "scipy"
     evaluate.bpd_dataset = "test"
     evaluate.ais = False
     evaluate.n_ais_steps = 1000
+    ## "linear" uses n_ais_steps uniform steps, "adaptive" picks the steps by
+    ## bisection on the conditional ESS of the incremental weights
+    evaluate.ais_schedule = "linear"
+    evaluate.ais_target_cess = 0.99
+    ## adaptive schedules take at most this many steps, n_ais_steps is ignored
+    evaluate.ais_max_adaptive_steps = 10000
+    ## seconds the other shards wait for shard 0 to adapt the schedule, <= 0 forever
+    evaluate.ais_schedule_timeout = 86400.0
     evaluate.n_ais_samples = 10000
     evaluate.n_steps_per_ais_step = 1
     evaluate.n_continue = 100
+    ## "ais", "raise" or "bdmc" (forward and reverse chains in one run)
     evaluate.ais_method = "ais"
+    ## stop BDMC once the sandwich gap of the log normalizer is below this, 0 never
+    evaluate.bdmc_gap_tol = 0.0
     evaluate.ais_batch_size = 100
     evaluate.n_hmc_steps = 10
     evaluate.initial_step_size = 1e-2
+    ## tune per-chain step sizes by dual averaging over the first HMC transitions
+    ## of every batch, 0 keeps initial_step_size fixed
+    evaluate.hmc_adapt_steps = 0
+    evaluate.hmc_target_accept = 0.65
+    ## also estimate a diagonal mass matrix during the warm-up
+    evaluate.hmc_adapt_mass = False
     evaluate.ais_rtol = 1e-3
     evaluate.ais_atol = 1e-3
     evaluate.mcmc_algo = "hmc"
+    ## split the AIS chains into shards, <= 0 uses one shard per torchrun rank
+    evaluate.ais_num_shards = 0
+    ## shard run by this process, < 0 uses the torchrun rank
+    evaluate.ais_shard_id = -1
+    ## save the running AIS batch every this many HMC transitions, 0 disables
+    evaluate.ais_snapshot_interval = 0
+    ## skip finished AIS batches and continue from the last snapshot
+    evaluate.ais_resume = False
     evaluate.rtol = 1e-6
     evaluate.atol = 1e-6
+    ## integrator of the density ratios: a scipy solve_ivp method,
+    ## "torchdiffeq_<method>" or "gauss_legendre_<n>", see
+    ## density_ratios.integrate_time_score
+    evaluate.ratio_method = "RK45"
+    ## cache of per-sample ratio results (see ratio_cache.py), "" disables it
+    evaluate.ratio_cache_dir = ""
+    evaluate.ratio_cache_max_gb = 4.0
 
     # data
     config.data = data = ml_collections.ConfigDict()
@@ -91,6 +147,8 @@ def get_default_configs():
     data.horizontal_flip = False
     data.centered = False
     data.uniform_dequantization = False
+    # decode MNIST once into a device-resident uint8 tensor instead of a DataLoader
+    data.preload = True
     data.logit_transform = False
     data.num_channels = 1
     data.lambda_logit = 1e-6
@@ -111,6 +169,8 @@ def get_default_configs():
     model.infinite = False
 
     model.sinh = False
+    ## update the EMA every k steps, with the product of the k decays
+    model.ema_update_every = 1
 
     # optimization
     config.optim = optim = ml_collections.ConfigDict()
@@ -126,6 +186,26 @@ def get_default_configs():
     optim.amsgrad = False
     optim.manager = "v1"
 
+    # metrics logging
+    config.metrics = metrics = ml_collections.ConfigDict()
+    ## comma-separated list out of wandb, stdout, jsonl, parquet
+    metrics.sinks = "wandb,stdout"
+    ## aggregate scalars on device for this many steps; <= 0 uses training.log_freq
+    metrics.flush_freq = 0
+
+    # profiling
+    config.profiling = profiling = ml_collections.ConfigDict()
+    ## named phase timers and counters (see profiling.py), no overhead when off
+    profiling.enabled = False
+    ## write the phase times every this many steps; <= 0 uses training.log_freq
+    profiling.flush_freq = 0
+    ## synchronize CUDA at phase boundaries for exact phase times
+    profiling.synchronize = True
+    ## capture steps [trace_start, trace_start + trace_steps) with torch.profiler
+    ## into a Chrome trace, 0 disables the capture
+    profiling.trace_start = 10
+    profiling.trace_steps = 0
+
     config.seed = 42
     config.device = (
         torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
@@ -32,6 +32,14 @@ def get_default_configs():
     # losses
     training.joint = False
     training.algo = "dsm"
+    # torch.distributed (gloo) data-parallel training, launch with torchrun
+    training.distributed = False
+    ## torch threads per process; <= 0 splits the cores of the node evenly
+    training.threads_per_rank = 0
+    # write checkpoints from a background thread (temp file + atomic rename)
+    training.async_checkpoint = True
+    ## number of most recent snapshot checkpoints to keep; <= 0 keeps all
+    training.keep_checkpoints = 0
 
     # sampling
     config.sampling = sampling = ml_collections.ConfigDict()
@@ -65,6 +73,8 @@ def get_default_configs():
     data.random_flip = False
     data.centered = False
     data.uniform_dequantization = False
+    # decode MNIST once into a device-resident uint8 tensor instead of a DataLoader
+    data.preload = True
     data.logit_transform = False
     data.num_channels = 1
     data.lambda_logit = 1e-6
@@ -94,6 +104,13 @@ def get_default_configs():
     optim.amsgrad = False
     optim.rescale_t = False
 
+    # metrics logging
+    config.metrics = metrics = ml_collections.ConfigDict()
+    ## comma-separated list out of wandb, stdout, jsonl, parquet
+    metrics.sinks = "wandb,stdout"
+    ## aggregate scalars on device for this many steps; <= 0 uses training.log_freq
+    metrics.flush_freq = 0
+
     config.seed = 42
     config.device = (
         torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
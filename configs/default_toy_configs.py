@@ -28,6 +28,16 @@ def get_default_configs():
     training.unit_factor = False
 
     training.full = False
+    ## how training times are drawn, see time_samplers.py: uniform, stratified,
+    ## antithetic, sobol or importance
+    training.time_sampler = "uniform"
+    ## minibatch coupling of px and qx for two-sided paths, see couplings.py:
+    ## independent, exact (Hungarian), sinkhorn or auto (exact up to max_exact)
+    training.coupling = "independent"
+    ## Sinkhorn regularization, relative to the mean squared distance in a batch
+    training.coupling_reg = 0.05
+    training.coupling_iters = 100
+    training.coupling_max_exact = 512
 
     training.plot_scatter = False
 
@@ -54,6 +64,24 @@ def get_default_configs():
     evaluate.bpd_dataset = "test"
     evaluate.rtol = 1e-6
     evaluate.atol = 1e-6
+    ## integrator of the density ratios: a scipy solve_ivp method,
+    ## "torchdiffeq_<method>" or "gauss_legendre_<n>", see
+    ## density_ratios.integrate_time_score
+    evaluate.ratio_method = "RK45"
+    ## cache of per-sample ratio results (see ratio_cache.py), "" disables it
+    evaluate.ratio_cache_dir = ""
+    evaluate.ratio_cache_max_gb = 4.0
+    ## multi-fidelity evaluation during toy training: a cheap val MSE at every
+    ## evaluation, the full-precision one (and the figures) only for checkpoints
+    ## whose cheap val MSE is within (1 + promote_margin) of the best so far
+    evaluate.multi_fidelity = False
+    evaluate.cheap_method = "gauss_legendre_16"
+    ## tolerances of the cheap estimate, ignored by the quadratures
+    evaluate.cheap_rtol = 1e-3
+    evaluate.cheap_atol = 1e-3
+    ## size of the fixed val subsample of the cheap estimate, <= 0 uses all
+    evaluate.cheap_n_val = 2000
+    evaluate.promote_margin = 0.2
 
     # data
     config.data = data = ml_collections.ConfigDict()
@@ -69,6 +97,9 @@ def get_default_configs():
     config.model = model = ml_collections.ConfigDict()
     model.ema = False
     model.z_dim = 128
+    ## toy_param_mvn_mi / toy_full_param_mvn_mi: symmetrize theta and invert
+    ## I + t^2 theta through one eigendecomposition per forward pass
+    model.spectral = False
 
     # optimization
     config.optim = optim = ml_collections.ConfigDict()
@@ -82,6 +113,26 @@ def get_default_configs():
     optim.amsgrad = False
     optim.scheduler = True
 
+    # metrics logging
+    config.metrics = metrics = ml_collections.ConfigDict()
+    ## comma-separated list out of wandb, stdout, jsonl, parquet
+    metrics.sinks = "wandb,stdout"
+    ## aggregate scalars on device for this many steps; <= 0 uses training.log_freq
+    metrics.flush_freq = 0
+
+    # profiling
+    config.profiling = profiling = ml_collections.ConfigDict()
+    ## named phase timers and counters (see profiling.py), no overhead when off
+    profiling.enabled = False
+    ## write the phase times every this many steps; <= 0 uses training.log_freq
+    profiling.flush_freq = 0
+    ## synchronize CUDA at phase boundaries for exact phase times
+    profiling.synchronize = True
+    ## capture steps [trace_start, trace_start + trace_steps) with torch.profiler
+    ## into a Chrome trace, 0 disables the capture
+    profiling.trace_start = 10
+    profiling.trace_steps = 0
+
     config.seed = 42
     config.device = (
         torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
@@ -15,6 +15,8 @@ def get_config():
     # for TwoSB
     training.two_sb_var = 2.0
     training.use_two_sb = True
+    # minibatch coupling of px and qx: independent, exact, sinkhorn or auto
+    training.coupling = "independent"
 
     # data
     data = config.data
@@ -0,0 +1,117 @@
+"""Minibatch couplings of the endpoints of two-sided toy paths.
+
+By default px and qx of a batch are paired by index, an independent coupling,
+so the interpolants of a TwoSided path cross a lot. Here each minibatch is
+re-paired by optimal transport under the squared euclidean cost:
+
+- "exact": the optimal permutation (Hungarian algorithm, scipy, on the CPU).
+- "sinkhorn": log-domain Sinkhorn iterations on the device of the batch. For
+  every px, its partner is then drawn from its row of the entropic plan.
+- "auto": exact up to `max_exact` points, Sinkhorn for larger batches.
+
+Every qx still comes from q: exact OT permutes the batch, and the columns of
+the Sinkhorn plan have equal mass. So the endpoint marginals, and with them
+the ratio log q - log p that the time scores integrate to, are unchanged. The
+intermediate p_t are not, which is why `toy_marginals` (independent coupling)
+is no longer the exact time score of a coupled path.
+
+The Brownian bridge of TwoSB with variance two_sb_var has the static
+Schroedinger bridge coupling, the entropic plan with reg = 2 * two_sb_var in
+absolute units of the cost. Sinkhorn with that reg samples from it.
+"""
+
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+COUPLINGS = ["independent", "exact", "sinkhorn", "auto"]
+
+
+def squared_distances(px, qx):
+    return torch.cdist(px.reshape(len(px), -1), qx.reshape(len(qx), -1)) ** 2
+
+
+def exact_permutation(cost):
+    """Index of the qx paired with every px under the optimal permutation."""
+    rows, cols = linear_sum_assignment(cost.detach().cpu().numpy())
+    perm = np.empty_like(cols)
+    perm[rows] = cols
+    return torch.as_tensor(perm, device=cost.device)
+
+
+def sinkhorn_log_plan(cost, reg, num_iters, tol=1e-4):
+    """Log of the entropic OT plan between uniform weights on the batches.
+
+    Stops early once no dual potential f changes by more than `tol`.
+    """
+    n, m = cost.shape
+    log_a = torch.full((n,), -np.log(n), dtype=cost.dtype, device=cost.device)
+    log_b = torch.full((m,), -np.log(m), dtype=cost.dtype, device=cost.device)
+    log_k = -cost / reg
+    f = torch.zeros_like(log_a)
+    g = torch.zeros_like(log_b)
+    for _ in range(num_iters):
+        f_new = log_a - torch.logsumexp(log_k + g[None, :], dim=1)
+        g = log_b - torch.logsumexp(log_k + f_new[:, None], dim=0)
+        converged = torch.max(torch.abs(f_new - f)) < tol
+        f = f_new
+        if converged:
+            break
+    return log_k + f[:, None] + g[None, :]
+
+
+def sinkhorn_permutation(cost, reg, num_iters, tol=1e-4):
+    """For every px, a partner drawn from its row of the Sinkhorn plan."""
+    log_plan = sinkhorn_log_plan(cost, reg, num_iters, tol)
+    probs = torch.softmax(log_plan, dim=1)
+    return torch.multinomial(probs, 1).view(-1)
+
+
+def get_coupling_fn(
+    method, reg=0.05, num_iters=100, tol=1e-4, max_exact=512, relative=True
+):
+    """Returns `couple(px, qx) -> (px, qx)` with qx re-paired to px.
+
+    Args:
+      method: one of `COUPLINGS`.
+      reg: entropic regularization of Sinkhorn. With `relative`, it is in units
+        of the mean squared distance of the batch, otherwise in absolute units.
+      num_iters, tol: largest number of Sinkhorn iterations and the tolerance
+        on the change of the dual potentials for stopping earlier.
+      max_exact: largest batch that "auto" couples exactly.
+    """
+    if method not in COUPLINGS:
+        raise NotImplementedError(f"Coupling {method} not supported yet!")
+
+    def couple(px, qx):
+        if method == "independent":
+            return px, qx
+        with torch.no_grad():
+            cost = squared_distances(px, qx)
+            if method == "exact" or (method == "auto" and len(px) <= max_exact):
+                perm = exact_permutation(cost)
+            else:
+                scale = cost.mean() if relative else 1.0
+                perm = sinkhorn_permutation(cost, reg * scale, num_iters, tol)
+        return px, qx[perm]
+
+    return couple
+
+
+def get_coupled_interpolate_fn(interpolate_fn, couple):
+    """Couples px and qx before they are passed to a TwoSided interpolate_fn."""
+
+    def coupled_interpolate_fn(px, qx, t):
+        return interpolate_fn(*couple(px, qx), t)
+
+    return coupled_interpolate_fn
+
+
+def get_coupled_batch_fn(batch_fn, couple):
+    """Couples the [px, qx] batches of the conditional losses, which take the
+    endpoints directly rather than through an interpolate_fn."""
+
+    def coupled_batch_fn(n):
+        return list(couple(*batch_fn(n)))
+
+    return coupled_batch_fn
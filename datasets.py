@@ -1,17 +1,14 @@
 import os
 import numpy as np
-import jax
 
 # import tensorflow as tf
 # import tensorflow_datasets as tfds
 import torch.utils.data
 
-# flow-specific code
-import torchvision.transforms.functional as F
-import torchvision as tv
-import torchvision.transforms as tr
-from torchvision.datasets import MNIST, FashionMNIST
-import torchvision.transforms as transforms
+import distributed
+
+# flow-specific code: torchvision is imported inside the MNIST loaders so that
+# the toy experiments do not pay for it at startup
 
 
 def logit_transform(image, lambd=1e-6):
@@ -226,6 +223,139 @@ def get_data_inverse_scaler(config):
 #     return train_ds, eval_ds, dataset_builder
 
 
+class PreloadedImageLoader(object):
+    """Batches images that are decoded once and kept in memory as uint8.
+
+    Iterating yields `(images, labels)` like a `torch.utils.data.DataLoader`
+    over the torchvision dataset, but every batch is built with a single
+    gather on the device that holds the data. When `dequantize` is set, batches
+    are uniformly dequantized to (x + u) / 256 and passed through `scaler`;
+    otherwise they are returned in [0, 1] exactly like `ToTensor`.
+    """
+
+    def __init__(
+        self,
+        images,
+        labels,
+        batch_size,
+        shuffle=False,
+        drop_last=False,
+        dequantize=False,
+        scaler=None,
+    ):
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.dequantize = dequantize
+        self.scaler = scaler
+
+    def __len__(self):
+        n = len(self.images)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.images)
+        device = self.images.device
+        if self.shuffle:
+            order = torch.randperm(n, device=device)
+        else:
+            order = torch.arange(n, device=device)
+        for i in range(len(self)):
+            idx = order[i * self.batch_size : (i + 1) * self.batch_size]
+            batch = self.images[idx].float()
+            if self.dequantize:
+                batch = (batch + torch.rand_like(batch)) / 256.0
+                if self.scaler is not None:
+                    batch = self.scaler(batch)
+            else:
+                batch = batch / 255.0
+            yield batch, self.labels[idx]
+
+
+def _load_image_tensors(config, train=True):
+    """Decodes a whole torchvision split into uint8 tensors on `config.device`."""
+    from torchvision.datasets import MNIST, FashionMNIST
+
+    data_dir = "./data"
+    if config.data.dataset == "MNIST":
+        # the test split is stored in its own folder, as in get_test_set_for_flow
+        folder = "mnist" if train else "mnist_test"
+        dataset = MNIST(
+            os.path.join(data_dir, "datasets", folder), train=train, download=True
+        )
+    elif config.data.dataset == "FashionMNIST":
+        dataset = FashionMNIST(
+            os.path.join(data_dir, "datasets", "fashion_mnist"),
+            train=train,
+            download=True,
+        )
+    else:
+        raise NotImplementedError(
+            f"Preloading for dataset {config.data.dataset} not supported yet!"
+        )
+
+    images = dataset.data.unsqueeze(1)  # (N, 1, H, W) uint8
+    labels = torch.as_tensor(dataset.targets)
+    if images.shape[-1] != config.data.image_size:
+        # NOTE: the tensor resize is close to, but not bit-exact with, PIL
+        images = torch.nn.functional.interpolate(
+            images.float(),
+            size=config.data.image_size,
+            mode="bilinear",
+            antialias=True,
+            align_corners=False,
+        )
+        images = images.round().clamp(0, 255).to(torch.uint8)
+    return images.to(config.device), labels.to(config.device)
+
+
+def get_preloaded_dataset_for_flow(config):
+    """Device-resident version of `get_dataset_for_flow`.
+
+    Uses the same 50K/10K train/validation split, but batches come out
+    dequantized and rescaled with `get_data_scaler(config)`, ready for training.
+    """
+    images, labels = _load_image_tensors(config, train=True)
+    scaler = get_data_scaler(config)
+    # in data-parallel training every rank gets a disjoint shard of the train split
+    rank, world_size = distributed.get_rank(), distributed.get_world_size()
+    train_ds = PreloadedImageLoader(
+        images[:50000][rank::world_size],
+        labels[:50000][rank::world_size],
+        config.training.batch_size // world_size,
+        shuffle=True,
+        drop_last=world_size > 1,
+        dequantize=True,
+        scaler=scaler,
+    )
+    eval_ds = PreloadedImageLoader(
+        images[50000:60000],
+        labels[50000:60000],
+        config.eval.batch_size,
+        shuffle=False,
+        dequantize=True,
+        scaler=scaler,
+    )
+    return train_ds, eval_ds
+
+
+def get_preloaded_test_set_for_flow(config):
+    """Device-resident `get_test_set_for_flow`, with dequantized, rescaled batches."""
+    images, labels = _load_image_tensors(config, train=False)
+    return PreloadedImageLoader(
+        images,
+        labels,
+        config.eval.batch_size,
+        shuffle=False,
+        dequantize=True,
+        scaler=get_data_scaler(config),
+    )
+
+
 def get_dataset_for_flow(config, uniform_dequantization=False):
     """
     hello
@@ -234,6 +364,9 @@ def get_dataset_for_flow(config, uniform_dequantization=False):
     :param evaluation:
     :return:
     """
+    import torchvision.transforms as transforms
+    from torchvision.datasets import MNIST, FashionMNIST
+
     data_dir = "./data"
     train_transform = test_transform = transforms.Compose(
         [transforms.Resize(config.data.image_size), transforms.ToTensor()]
@@ -254,7 +387,9 @@ def get_dataset_for_flow(config, uniform_dequantization=False):
         )
     # subset to first 50K examples for train
     train_indices = np.arange(50000)
-    train_ds = torch.utils.data.Subset(dataset, train_indices)
+    # in data-parallel training every rank gets a disjoint shard of the train split
+    rank, world_size = distributed.get_rank(), distributed.get_world_size()
+    train_ds = torch.utils.data.Subset(dataset, train_indices[rank::world_size])
     eval_ds = torch.utils.data.Subset(dataset, np.arange(50000, 60000))
 
     # eval_ds = MNIST(os.path.join(data_dir, 'datasets', 'mnist_test'),
@@ -264,10 +399,10 @@ def get_dataset_for_flow(config, uniform_dequantization=False):
     # TODO: not set up for actual evaluation yet! this is just returning the validation set
     train_ds = torch.utils.data.DataLoader(
         train_ds,
-        config.training.batch_size,
+        config.training.batch_size // world_size,
         shuffle=True,
         num_workers=2,
-        drop_last=False,
+        drop_last=world_size > 1,
     )
     eval_ds = torch.utils.data.DataLoader(
         eval_ds, config.eval.batch_size, shuffle=False, num_workers=2, drop_last=False
@@ -276,36 +411,69 @@ def get_dataset_for_flow(config, uniform_dequantization=False):
     return train_ds, eval_ds
 
 
-def get_test_set_for_flow(config):
+def _get_test_split(config):
+    """The test split of the configured dataset, as `_load_image_tensors` has it."""
+    import torchvision.transforms as transforms
+    from torchvision.datasets import MNIST, FashionMNIST
+
     data_dir = "./data"
     test_transform = transforms.Compose(
         [transforms.Resize(config.data.image_size), transforms.ToTensor()]
     )
-    eval_ds = MNIST(
-        os.path.join(data_dir, "datasets", "mnist_test"),
-        train=False,
-        download=True,
-        transform=test_transform,
+    if config.data.dataset == "MNIST":
+        return MNIST(
+            os.path.join(data_dir, "datasets", "mnist_test"),
+            train=False,
+            download=True,
+            transform=test_transform,
+        )
+    elif config.data.dataset == "FashionMNIST":
+        return FashionMNIST(
+            os.path.join(data_dir, "datasets", "fashion_mnist"),
+            train=False,
+            download=True,
+            transform=test_transform,
+        )
+    raise NotImplementedError(
+        f"Test set of dataset {config.data.dataset} not supported yet!"
     )
+
+
+def get_test_set_for_flow(config):
+    eval_ds = _get_test_split(config)
     eval_ds = torch.utils.data.DataLoader(
         eval_ds, config.eval.batch_size, shuffle=False, num_workers=2, drop_last=False
     )
     return eval_ds
 
 
+def _ais_test_indexes(config, dataset_size):
+    """The random test subset of the AIS evaluations.
+
+    Drawn from its own generator, so every checkpoint, repeat and shard of an
+    evaluation sees the same subset, whatever the state of the global RNG.
+    """
+    generator = torch.Generator().manual_seed(config.seed)
+    return torch.randperm(dataset_size, generator=generator)[
+        : config.eval.n_ais_samples
+    ]
+
+
 def get_ais_test_set_for_flow(config):
-    data_dir = "./data"
-    test_transform = transforms.Compose(
-        [transforms.Resize(config.data.image_size), transforms.ToTensor()]
-    )
-    eval_ds = MNIST(
-        os.path.join(data_dir, "datasets", "mnist_test"),
-        train=False,
-        download=True,
-        transform=test_transform,
-    )
-    dataset_size = len(eval_ds)
-    chosen_indexes = torch.randperm(dataset_size)[: config.eval.n_ais_samples]
+    if config.data.preload:
+        # same random subset as below; ais_fn dequantizes the [0, 1] batches itself
+        images, labels = _load_image_tensors(config, train=False)
+        chosen_indexes = _ais_test_indexes(config, len(images))
+        chosen_indexes = chosen_indexes.to(images.device)
+        return PreloadedImageLoader(
+            images[chosen_indexes],
+            labels[chosen_indexes],
+            config.eval.ais_batch_size,
+            shuffle=False,
+        )
+
+    eval_ds = _get_test_split(config)
+    chosen_indexes = _ais_test_indexes(config, len(eval_ds))
     eval_ds = torch.utils.data.Subset(eval_ds, chosen_indexes)
     eval_ds = torch.utils.data.DataLoader(
         eval_ds,
@@ -318,21 +486,10 @@ def get_ais_test_set_for_flow(config):
 
 
 def get_raise_batch(config):
-    data_dir = "./data"
-    test_transform = transforms.Compose(
-        [transforms.Resize(config.data.image_size), transforms.ToTensor()]
-    )
-    eval_ds = MNIST(
-        os.path.join(data_dir, "datasets", "mnist_test"),
-        train=False,
-        download=True,
-        transform=test_transform,
-    )
+    eval_ds = _get_test_split(config)
 
     n_samples = config.eval.n_ais_samples
-
-    dataset_size = len(eval_ds)
-    random_indices = torch.randperm(dataset_size)[:n_samples]
+    random_indices = _ais_test_indexes(config, len(eval_ds))
 
     subset_dataset = torch.utils.data.Subset(eval_ds, random_indices)
 
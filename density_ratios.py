@@ -9,9 +9,85 @@ from torchdiffeq import odeint
 from functools import partial
 import logging
 
+import profiling
+import ratio_cache
 
-def get_toy_density_ratio_fn(rtol=1e-6, atol=1e-6, method="RK45", eps1=0.0, eps2=1e-5):
-    """Create a function to compute the density ratios of a given point."""
+
+SCIPY_METHODS = ("RK23", "RK45", "DOP853", "Radau", "BDF", "LSODA")
+TORCHDIFFEQ_METHODS = ("dopri5", "dopri8", "bosh3", "fehlberg2", "adaptive_heun")
+
+
+def integrate_time_score(rx_fn, times, y0, method="RK45", rtol=1e-6, atol=1e-6):
+    """Integrates `rx_fn(t, y)`, the per-sample time scores, over `times`.
+
+    method is one of
+    - a `scipy.integrate.solve_ivp` method, e.g. "RK45", "DOP853" or "LSODA",
+    - "torchdiffeq_<method>" for an adaptive torchdiffeq solver, e.g.
+      "torchdiffeq_dopri5",
+    - "gauss_legendre_<n>" for n-point Gauss-Legendre quadrature. The time
+      scores do not depend on y, so the integral is a plain quadrature and
+      rtol and atol are ignored.
+
+    Returns y at times[1] as a numpy array and the number of evaluations.
+    """
+    with profiling.phase("ratio_integration"):
+        y, nfe = _integrate_time_score(rx_fn, times, y0, method, rtol, atol)
+    profiling.count("nfe", nfe)
+    return y, nfe
+
+
+def _integrate_time_score(rx_fn, times, y0, method, rtol, atol):
+    t0, t1 = times
+    if method in SCIPY_METHODS:
+        solution = integrate.solve_ivp(
+            rx_fn, times, y0, method=method, rtol=rtol, atol=atol
+        )
+        return solution.y[:, -1], solution.nfev
+    elif method.startswith("torchdiffeq_"):
+        solver = method[len("torchdiffeq_") :]
+        if solver not in TORCHDIFFEQ_METHODS:
+            raise NotImplementedError(f"torchdiffeq method {solver} not supported yet!")
+        nfe = 0
+
+        def func(t, y):
+            nonlocal nfe
+            nfe += 1
+            return torch.from_numpy(np.asarray(rx_fn(t.item(), y.numpy()), np.float64))
+
+        solution = odeint(
+            func,
+            torch.from_numpy(np.asarray(y0, np.float64)),
+            torch.tensor([t0, t1], dtype=torch.float64),
+            rtol=rtol,
+            atol=atol,
+            method=solver,
+            # do not step past t1, where the time scores can be undefined
+            options=dict(step_t=torch.tensor([t1], dtype=torch.float64)),
+        )
+        return solution[-1].numpy(), nfe
+    elif method.startswith("gauss_legendre_"):
+        n = int(method[len("gauss_legendre_") :])
+        nodes, weights = np.polynomial.legendre.leggauss(n)
+        half_width = 0.5 * (t1 - t0)
+        y = np.asarray(y0, np.float64)
+        integral = np.zeros_like(y)
+        for node, weight in zip(nodes, weights):
+            integral += weight * np.asarray(rx_fn(t0 + half_width * (node + 1.0), y))
+        return y + half_width * integral, n
+    else:
+        raise NotImplementedError(f"Integration method {method} not supported yet!")
+
+
+def get_toy_density_ratio_fn(
+    rtol=1e-6, atol=1e-6, method="RK45", eps1=0.0, eps2=1e-5, cache=None
+):
+    """Create a function to compute the density ratios of a given point.
+
+    method is any method of `integrate_time_score`. With a
+    `ratio_cache.RatioCache`, the log ratios of a model and points that were
+    evaluated before with the same settings are read from the cache.
+    """
+    key_fn = ratio_cache.get_key_fn("toy", rtol, atol, method, eps1, eps2)
 
     def ratio_fn(score_model, x, score_type):
         with torch.no_grad():
@@ -29,19 +105,27 @@ def get_toy_density_ratio_fn(rtol=1e-6, atol=1e-6, method="RK45", eps1=0.0, eps2
 
                 return rx
 
-            # now just a function of t
-            p_get_rx = partial(ode_func, x=x, score_model=score_model)
-            # TODO: flipped (1, eps) for toy datasets
-            solution = integrate.solve_ivp(
-                p_get_rx,
-                (eps1, 1.0 - eps2),
-                np.zeros((x.shape[0],)),
-                method=method,
-                rtol=rtol,
-                atol=atol,
-            )
-            nfe = solution.nfev
-            density_ratio = solution.y[:, -1]
+            def solve():
+                # now just a function of t
+                p_get_rx = partial(ode_func, x=x, score_model=score_model)
+                # TODO: flipped (1, eps) for toy datasets
+                log_r, nfe = integrate_time_score(
+                    p_get_rx,
+                    (eps1, 1.0 - eps2),
+                    np.zeros((x.shape[0],)),
+                    method=method,
+                    rtol=rtol,
+                    atol=atol,
+                )
+                return dict(log_r=log_r, nfe=nfe)
+
+            if cache is None:
+                result = solve()
+            else:
+                key = key_fn(score_model, x, score_type)
+                result = cache.get_or_compute(key, solve, kind="toy")
+            nfe = int(result["nfe"])
+            density_ratio = result["log_r"]
             print("ratio computation took {} function evaluations.".format(nfe))
 
             return density_ratio, nfe
@@ -205,6 +289,7 @@ def get_z_interp_density_ratio_fn_flow(
     prob_path=None,
     conditional=False,
     epsilons=False,
+    cache=None,
 ):
     """Create a function to compute the density ratios of a given point.
     NOTE: this is the one that's being used for the DDPM noise schedule!
@@ -264,6 +349,24 @@ def get_z_interp_density_ratio_fn_flow(
                 z_batch = batch
             return z_batch
 
+    # the AIS variant integrates the same log ratios, so they share entries
+    key_fn = ratio_cache.get_key_fn(
+        "z_interp",
+        rtol,
+        atol,
+        method,
+        eps,
+        times,
+        mlp,
+        use_zt,
+        z_space_model_name,
+        conditional,
+        epsilons,
+        sde,
+        prob_path,
+        flow,
+    )
+
     # print('I am in the correct DRE function!')
     def ratio_fn(score_model, x):
         with torch.no_grad():
@@ -279,22 +382,32 @@ def get_z_interp_density_ratio_fn_flow(
 
                 return rx
 
-            # now just a function of t
-            batch = x.view(x.size(0), -1) if mlp else x
-            p_get_rx = partial(
-                ode_func, x=score_batch_fn(batch), score_model=score_model
-            )
-            # TODO: flipped (eps, 1) for DDPM noise
-            solution = integrate.solve_ivp(
-                p_get_rx,
-                times,
-                np.zeros((x.shape[0],)) + eps,
-                method=method,
-                rtol=rtol,
-                atol=atol,
-            )
-            nfe = solution.nfev
-            density_ratio = solution.y[:, -1]
+            def solve():
+                # now just a function of t
+                batch = x.view(x.size(0), -1) if mlp else x
+                p_get_rx = partial(
+                    ode_func, x=score_batch_fn(batch), score_model=score_model
+                )
+                # TODO: flipped (eps, 1) for DDPM noise
+                log_r, nfe = integrate_time_score(
+                    p_get_rx,
+                    times,
+                    np.zeros((x.shape[0],)) + eps,
+                    method=method,
+                    rtol=rtol,
+                    atol=atol,
+                )
+                # TODO
+                log_p = prior_logp_fn(flow, x).cpu().detach().numpy()
+                return dict(log_r=log_r, log_p=log_p, nfe=nfe)
+
+            if cache is None:
+                result = solve()
+            else:
+                key = key_fn(score_model, x)
+                result = cache.get_or_compute(key, solve, kind="z_interp")
+            nfe = int(result["nfe"])
+            density_ratio = result["log_r"]
             print("ratio computation took {} function evaluations.".format(nfe))
 
             # compute "approximate" bpds. corresponds to DIRECT method in TRE paper
@@ -303,8 +416,7 @@ def get_z_interp_density_ratio_fn_flow(
             N = np.prod(shape[1:])
 
             log_qp = density_ratio
-            # TODO
-            log_p = prior_logp_fn(flow, x).cpu().detach().numpy()
+            log_p = result["log_p"]
             assert log_qp.shape == log_p.shape
 
             # for actual bpd evaluation
@@ -348,6 +460,7 @@ def get_ais_z_interp_density_ratio_fn_flow(
     prob_path=None,
     conditional=False,
     epsilons=False,
+    cache=None,
 ):
     """Create a function to compute the density ratios of a given point.
     NOTE: this is the one that's being used for the DDPM noise schedule!
@@ -407,6 +520,24 @@ def get_ais_z_interp_density_ratio_fn_flow(
                 z_batch = batch
             return z_batch
 
+    # the AIS variant integrates the same log ratios, so they share entries
+    key_fn = ratio_cache.get_key_fn(
+        "z_interp",
+        rtol,
+        atol,
+        method,
+        eps,
+        times,
+        mlp,
+        use_zt,
+        z_space_model_name,
+        conditional,
+        epsilons,
+        sde,
+        prob_path,
+        flow,
+    )
+
     # print('I am in the correct DRE function!')
     def ratio_fn(score_model, x, log_normalizer=0.0):
         with torch.no_grad():
@@ -422,22 +553,32 @@ def get_ais_z_interp_density_ratio_fn_flow(
 
                 return rx
 
-            # now just a function of t
-            batch = x.view(x.size(0), -1) if mlp else x
-            p_get_rx = partial(
-                ode_func, x=score_batch_fn(batch), score_model=score_model
-            )
-            # TODO: flipped (eps, 1) for DDPM noise
-            solution = integrate.solve_ivp(
-                p_get_rx,
-                times,
-                np.zeros((x.shape[0],)) + eps,
-                method=method,
-                rtol=rtol,
-                atol=atol,
-            )
-            nfe = solution.nfev
-            density_ratio = solution.y[:, -1]
+            def solve():
+                # now just a function of t
+                batch = x.view(x.size(0), -1) if mlp else x
+                p_get_rx = partial(
+                    ode_func, x=score_batch_fn(batch), score_model=score_model
+                )
+                # TODO: flipped (eps, 1) for DDPM noise
+                log_r, nfe = integrate_time_score(
+                    p_get_rx,
+                    times,
+                    np.zeros((x.shape[0],)) + eps,
+                    method=method,
+                    rtol=rtol,
+                    atol=atol,
+                )
+                # TODO
+                log_p = prior_logp_fn(flow, x).cpu().detach().numpy()
+                return dict(log_r=log_r, log_p=log_p, nfe=nfe)
+
+            if cache is None:
+                result = solve()
+            else:
+                key = key_fn(score_model, x)
+                result = cache.get_or_compute(key, solve, kind="z_interp")
+            nfe = int(result["nfe"])
+            density_ratio = result["log_r"]
             print("ratio computation took {} function evaluations.".format(nfe))
 
             # compute "approximate" bpds. corresponds to DIRECT method in TRE paper
@@ -446,8 +587,7 @@ def get_ais_z_interp_density_ratio_fn_flow(
             N = np.prod(shape[1:])
 
             log_qp = density_ratio
-            # TODO
-            log_p = prior_logp_fn(flow, x).cpu().detach().numpy()
+            log_p = result["log_p"]
             assert log_qp.shape == log_p.shape
 
             # for actual bpd evaluation
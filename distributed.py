@@ -0,0 +1,128 @@
+"""Helpers for data-parallel training with torch.distributed on CPU nodes.
+
+Training is launched with torchrun, e.g.
+
+    torchrun --nproc_per_node=8 main.py --flow --config ... --mode train
+
+Every process holds a full replica of the score model and a disjoint shard of
+the training set. Gradients are averaged over processes before each optimizer
+step, so the parameters (and therefore the EMA) stay identical on all ranks.
+Checkpointing, logging and evaluation only happen on rank 0.
+"""
+
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(config):
+    """Joins the gloo process group described by torchrun's environment variables."""
+    if not config.training.distributed or dist.is_initialized():
+        return
+    dist.init_process_group(backend="gloo")
+
+    # by default every process would try to use all cores of the node
+    num_threads = config.training.threads_per_rank
+    if num_threads <= 0:
+        num_threads = max(os.cpu_count() // dist.get_world_size(), 1)
+    torch.set_num_threads(num_threads)
+    logging.info(
+        "rank %d/%d running with %d threads"
+        % (dist.get_rank(), dist.get_world_size(), num_threads)
+    )
+
+
+def get_rank():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+
+def get_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def broadcast_parameters(params, src=0):
+    """Overwrites `params` on every rank with the values held by `src`."""
+    if get_world_size() == 1:
+        return
+    for p in params:
+        dist.broadcast(p.data, src)
+
+
+def all_reduce_gradients(params):
+    """Averages the gradients of `params` over all ranks with a single all-reduce."""
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = [p.grad for p in params if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= world_size
+    offset = 0
+    for g in grads:
+        n = g.numel()
+        g.copy_(flat[offset : offset + n].view_as(g))
+        offset += n
+
+
+def all_gather_arrays(array):
+    """Concatenates a numpy array from every rank, in rank order."""
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, np.asarray(array))
+    return np.concatenate(gathered)
+
+
+class DistributedLossHistory(object):
+    """Keeps a loss history buffer identical on all ranks.
+
+    The buffer has one slot per example of the global batch. Every rank
+    contributes the losses of its local batch, which occupies slots
+    [rank * local_batch_size, (rank + 1) * local_batch_size). Updates are
+    all-gathered so each rank applies exactly the same update, and weights are
+    computed over the full buffer before a rank takes its own slice. Attribute
+    access is forwarded to the wrapped history, so checkpointing code can keep
+    reading `_loss_history` etc.
+    """
+
+    def __init__(self, history, local_batch_size):
+        self.history = history
+        self.local_batch_size = local_batch_size
+
+    def __getattr__(self, name):
+        return getattr(self.history, name)
+
+    def weights(self, ts=None):
+        if ts is None:
+            return self.history.weights()
+        # the interpolated weights depend on the times drawn on every rank
+        return self.history.weights(all_gather_arrays(ts))
+
+    def batch_slice(self, n):
+        start = get_rank() * self.local_batch_size
+        return slice(start, start + n)
+
+    def update_with_all_losses(self, ts, losses, weights=None):
+        ts = all_gather_arrays(ts)
+        losses = all_gather_arrays(losses)
+        if weights is None:
+            self.history.update_with_all_losses(ts=ts, losses=losses)
+        else:
+            weights = all_gather_arrays(weights)
+            self.history.update_with_all_losses(ts=ts, losses=losses, weights=weights)
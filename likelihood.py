@@ -3,23 +3,150 @@
 import torch
 import numpy as np
 from scipy import integrate
+from torchdiffeq import odeint
 from models import utils as mutils
 
 
 def get_div_fn(fn):
-    """Create the divergence function of `fn` using the Hutchinson-Skilling trace estimator."""
+    """Create the divergence function of `fn` using the Hutchinson-Skilling trace estimator.
+
+    `eps` either has the shape of `x`, or holds K probes with shape (K, *x.shape);
+    the K vector-Jacobian products then share one forward pass and one batched
+    backward pass, and the estimates are averaged.
+    """
 
     def div_fn(x, t, eps):
+        sum_dims = tuple(range(1, len(x.shape)))
+        if eps.dim() == x.dim():
+            with torch.enable_grad():
+                x.requires_grad_(True)
+                fn_eps = torch.sum(fn(x, t) * eps)
+                grad_fn_eps = torch.autograd.grad(fn_eps, x)[0]
+            x.requires_grad_(False)
+            return torch.sum(grad_fn_eps * eps, dim=sum_dims)
+
         with torch.enable_grad():
             x.requires_grad_(True)
-            fn_eps = torch.sum(fn(x, t) * eps)
-            grad_fn_eps = torch.autograd.grad(fn_eps, x)[0]
+            fn_x = fn(x, t)
+            grad_fn_eps = torch.autograd.grad(
+                fn_x, x, grad_outputs=eps, is_grads_batched=True
+            )[0]
         x.requires_grad_(False)
-        return torch.sum(grad_fn_eps * eps, dim=tuple(range(1, len(x.shape))))
+        sum_dims = tuple(d + 1 for d in sum_dims)
+        return torch.sum(grad_fn_eps * eps, dim=sum_dims).mean(0)
 
     return div_fn
 
 
+def get_exact_div_fn(fn):
+    """Create the exact divergence of `fn` from its full Jacobian.
+
+    Costs one Jacobian of size dim x dim per sample, so only meant for
+    low-dimensional (toy) data.
+    """
+
+    def div_fn(x, t, eps=None):
+        def fn_single(x_i, t_i):
+            return fn(x_i[None], t_i[None])[0]
+
+        with torch.enable_grad():
+            jac = torch.func.vmap(torch.func.jacrev(fn_single))(x, t)
+        dim = int(np.prod(x.shape[1:]))
+        jac = jac.reshape(x.shape[0], dim, dim)
+        return torch.diagonal(jac, dim1=1, dim2=2).sum(-1)
+
+    return div_fn
+
+
+def get_probes(data, hutchinson_type="Rademacher", num_probes=1):
+    """Noise for the trace estimator, shape of `data` or (num_probes, *data.shape)."""
+    if num_probes > 1:
+        data = data.new_empty((num_probes,) + tuple(data.shape))
+    if hutchinson_type == "Gaussian":
+        return torch.randn_like(data)
+    elif hutchinson_type == "Rademacher":
+        return torch.randint_like(data, low=0, high=2).float() * 2 - 1.0
+    else:
+        raise NotImplementedError(f"Hutchinson type {hutchinson_type} unknown.")
+
+
+# names of scipy's solvers in torchdiffeq
+_TORCHDIFFEQ_METHODS = {"RK45": "dopri5", "RK23": "bosh3", "DOP853": "dopri8"}
+
+
+def solve_pf_ode(
+    drift_fn, div_fn, data, t_span, rtol, atol, method, integrator="scipy"
+):
+    """Integrates the probability flow ODE jointly with the divergence of its drift.
+
+    With `integrator="scipy"` the state is flattened into a NumPy array for
+    `scipy.integrate.solve_ivp`; with "torchdiffeq" it stays on the device of
+    `data`.
+
+    Returns:
+      z, the integrated divergence of shape [batch size] and the number of
+        function evaluations.
+    """
+    shape = data.shape
+    if integrator == "scipy":
+
+        def ode_func(t, x):
+            sample = (
+                mutils.from_flattened_numpy(x[: -shape[0]], shape)
+                .to(data.device)
+                .type(torch.float32)
+            )
+            vec_t = torch.ones(sample.shape[0], device=sample.device) * t
+            drift = mutils.to_flattened_numpy(drift_fn(sample, vec_t))
+            logp_grad = mutils.to_flattened_numpy(div_fn(sample, vec_t))
+            return np.concatenate([drift, logp_grad], axis=0)
+
+        init = np.concatenate(
+            [mutils.to_flattened_numpy(data), np.zeros((shape[0],))], axis=0
+        )
+        solution = integrate.solve_ivp(
+            ode_func, t_span, init, rtol=rtol, atol=atol, method=method
+        )
+        nfe = solution.nfev
+        zp = solution.y[:, -1]
+        z = (
+            mutils.from_flattened_numpy(zp[: -shape[0]], shape)
+            .to(data.device)
+            .type(torch.float32)
+        )
+        delta_logp = (
+            mutils.from_flattened_numpy(zp[-shape[0] :], (shape[0],))
+            .to(data.device)
+            .type(torch.float32)
+        )
+        return z, delta_logp, nfe
+
+    elif integrator == "torchdiffeq":
+        nfe = 0
+
+        def ode_func(t, state):
+            nonlocal nfe
+            nfe += 1
+            sample = state[0]
+            vec_t = torch.ones(sample.shape[0], device=sample.device) * t
+            return drift_fn(sample, vec_t), div_fn(sample, vec_t)
+
+        init = (data.float(), torch.zeros(shape[0], device=data.device))
+        t = torch.tensor(t_span, dtype=torch.float32, device=data.device)
+        z, delta_logp = odeint(
+            ode_func,
+            init,
+            t,
+            rtol=rtol,
+            atol=atol,
+            method=_TORCHDIFFEQ_METHODS.get(method, method),
+        )
+        return z[-1], delta_logp[-1], nfe
+
+    else:
+        raise NotImplementedError(f"Integrator {integrator} unknown.")
+
+
 def get_likelihood_fn(
     sde,
     inverse_scaler,
@@ -28,6 +155,9 @@ def get_likelihood_fn(
     atol=1e-5,
     method="RK45",
     eps=1e-5,
+    num_probes=1,
+    divergence="hutchinson",
+    integrator="scipy",
 ):
     """Create a function to compute the unbiased log-likelihood estimate of a given data point.
 
@@ -40,6 +170,10 @@ def get_likelihood_fn(
       method: A `str`. The algorithm for the black-box ODE solver.
         See documentation for `scipy.integrate.solve_ivp`.
       eps: A `float` number. The probability flow ODE is integrated to `eps` for numerical stability.
+      num_probes: An `int`. Number of Hutchinson-Skilling probes averaged at every function evaluation.
+      divergence: "hutchinson" or "exact". "exact" computes the trace of the full Jacobian of the drift,
+        only feasible for low-dimensional data.
+      integrator: "scipy" or "torchdiffeq". The latter keeps the ODE state on the device of the data.
 
     Returns:
       A function that a batch of data points and returns the log-likelihoods in bits/dim,
@@ -54,7 +188,12 @@ def get_likelihood_fn(
         return rsde.sde(x, t)[0]
 
     def div_fn(model, x, t, noise):
-        return get_div_fn(lambda xx, tt: drift_fn(model, xx, tt))(x, t, noise)
+        if divergence == "exact":
+            return get_exact_div_fn(lambda xx, tt: drift_fn(model, xx, tt))(x, t)
+        elif divergence == "hutchinson":
+            return get_div_fn(lambda xx, tt: drift_fn(model, xx, tt))(x, t, noise)
+        else:
+            raise NotImplementedError(f"Divergence {divergence} unknown.")
 
     def likelihood_fn(model, data):
         """Compute an unbiased estimate to the log-likelihood in bits/dim.
@@ -71,43 +210,17 @@ def get_likelihood_fn(
         """
         with torch.no_grad():
             shape = data.shape
-            if hutchinson_type == "Gaussian":
-                epsilon = torch.randn_like(data)
-            elif hutchinson_type == "Rademacher":
-                epsilon = torch.randint_like(data, low=0, high=2).float() * 2 - 1.0
-            else:
-                raise NotImplementedError(f"Hutchinson type {hutchinson_type} unknown.")
-
-            def ode_func(t, x):
-                sample = (
-                    mutils.from_flattened_numpy(x[: -shape[0]], shape)
-                    .to(data.device)
-                    .type(torch.float32)
-                )
-                vec_t = torch.ones(sample.shape[0], device=sample.device) * t
-                drift = mutils.to_flattened_numpy(drift_fn(model, sample, vec_t))
-                logp_grad = mutils.to_flattened_numpy(
-                    div_fn(model, sample, vec_t, epsilon)
-                )
-                return np.concatenate([drift, logp_grad], axis=0)
-
-            init = np.concatenate(
-                [mutils.to_flattened_numpy(data), np.zeros((shape[0],))], axis=0
-            )
-            solution = integrate.solve_ivp(
-                ode_func, (eps, sde.T), init, rtol=rtol, atol=atol, method=method
-            )
-            nfe = solution.nfev
-            zp = solution.y[:, -1]
-            z = (
-                mutils.from_flattened_numpy(zp[: -shape[0]], shape)
-                .to(data.device)
-                .type(torch.float32)
-            )
-            delta_logp = (
-                mutils.from_flattened_numpy(zp[-shape[0] :], (shape[0],))
-                .to(data.device)
-                .type(torch.float32)
+            epsilon = get_probes(data, hutchinson_type, num_probes)
+
+            z, delta_logp, nfe = solve_pf_ode(
+                lambda x, t: drift_fn(model, x, t),
+                lambda x, t: div_fn(model, x, t, epsilon),
+                data,
+                (eps, sde.T),
+                rtol=rtol,
+                atol=atol,
+                method=method,
+                integrator=integrator,
             )
             prior_logp = sde.prior_logp(z)
             bpd = -(prior_logp + delta_logp) / np.log(2)
@@ -131,6 +244,9 @@ def get_likelihood_fn_flow(
     atol=1e-5,
     method="RK45",
     eps=1e-5,
+    num_probes=1,
+    divergence="hutchinson",
+    integrator="scipy",
 ):
     """Create a function to compute the unbiased log-likelihood estimate of a given data point.
 
@@ -143,6 +259,10 @@ def get_likelihood_fn_flow(
       method: A `str`. The algorithm for the black-box ODE solver.
         See documentation for `scipy.integrate.solve_ivp`.
       eps: A `float` number. The probability flow ODE is integrated to `eps` for numerical stability.
+      num_probes: An `int`. Number of Hutchinson-Skilling probes averaged at every function evaluation.
+      divergence: "hutchinson" or "exact". "exact" computes the trace of the full Jacobian of the drift,
+        only feasible for low-dimensional data.
+      integrator: "scipy" or "torchdiffeq". The latter keeps the ODE state on the device of the data.
 
     Returns:
       A function that a batch of data points and returns the log-likelihoods in bits/dim,
@@ -157,7 +277,12 @@ def get_likelihood_fn_flow(
         return rsde.sde(x, t)[0]
 
     def div_fn(model, x, t, noise):
-        return get_div_fn(lambda xx, tt: drift_fn(model, xx, tt))(x, t, noise)
+        if divergence == "exact":
+            return get_exact_div_fn(lambda xx, tt: drift_fn(model, xx, tt))(x, t)
+        elif divergence == "hutchinson":
+            return get_div_fn(lambda xx, tt: drift_fn(model, xx, tt))(x, t, noise)
+        else:
+            raise NotImplementedError(f"Divergence {divergence} unknown.")
 
     # def likelihood_fn(model, data, flow_log_det, log_det_logit):
     def likelihood_fn(model, data):
@@ -175,25 +300,7 @@ def get_likelihood_fn_flow(
         """
         with torch.no_grad():
             shape = data.shape
-            if hutchinson_type == "Gaussian":
-                epsilon = torch.randn_like(data)
-            elif hutchinson_type == "Rademacher":
-                epsilon = torch.randint_like(data, low=0, high=2).float() * 2 - 1.0
-            else:
-                raise NotImplementedError(f"Hutchinson type {hutchinson_type} unknown.")
-
-            def ode_func(t, x):
-                sample = (
-                    mutils.from_flattened_numpy(x[: -shape[0]], shape)
-                    .to(data.device)
-                    .type(torch.float32)
-                )
-                vec_t = torch.ones(sample.shape[0], device=sample.device) * t
-                drift = mutils.to_flattened_numpy(drift_fn(model, sample, vec_t))
-                logp_grad = mutils.to_flattened_numpy(
-                    div_fn(model, sample, vec_t, epsilon)
-                )
-                return np.concatenate([drift, logp_grad], axis=0)
+            epsilon = get_probes(data, hutchinson_type, num_probes)
 
             # so first, we need to transform the data to z-space (since that's where
             # training is taking place)
@@ -212,23 +319,15 @@ def get_likelihood_fn_flow(
 
             # TODO: this is a sanity check
             # data = torch.randn_like(data)
-            init = np.concatenate(
-                [mutils.to_flattened_numpy(data), np.zeros((shape[0],))], axis=0
-            )
-            solution = integrate.solve_ivp(
-                ode_func, (eps, sde.T), init, rtol=rtol, atol=atol, method=method
-            )
-            nfe = solution.nfev
-            zp = solution.y[:, -1]
-            z = (
-                mutils.from_flattened_numpy(zp[: -shape[0]], shape)
-                .to(data.device)
-                .type(torch.float32)
-            )
-            delta_logp = (
-                mutils.from_flattened_numpy(zp[-shape[0] :], (shape[0],))
-                .to(data.device)
-                .type(torch.float32)
+            z, delta_logp, nfe = solve_pf_ode(
+                lambda x, t: drift_fn(model, x, t),
+                lambda x, t: div_fn(model, x, t, epsilon),
+                data.reshape(shape),
+                (eps, sde.T),
+                rtol=rtol,
+                atol=atol,
+                method=method,
+                integrator=integrator,
             )
 
             shape = z.shape
@@ -43,6 +43,10 @@ class LossSecondMomentResampler(object):
                 self._time_history[i, self._loss_counts[i]] = t
                 self._loss_counts[i] += 1
 
+    def batch_slice(self, n):
+        # the weights of a smaller (e.g. last) batch are taken from the first slots
+        return slice(0, n)
+
     def _warmed_up(self):
         return (self._loss_counts == self.history_per_term).all()
 
@@ -109,6 +113,10 @@ class InterpolateLossSecondMomentResampler(object):
                 self._weight_history[i, self._loss_counts[i]] = ws
                 self._loss_counts[i] += 1
 
+    def batch_slice(self, n):
+        # the weights of a smaller (e.g. last) batch are taken from the first slots
+        return slice(0, n)
+
     def _warmed_up(self):
         return (self._loss_counts == self.history_per_term).all()
 
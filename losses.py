@@ -6,7 +6,11 @@ import torch.optim as optim
 import torch.autograd as autograd
 import numpy as np
 from models import utils as mutils
+from models.ema import EMAModel
 from datasets import logit_transform
+import distributed
+import profiling
+import time_samplers
 import matplotlib.pyplot as plt
 
 sqrt_two = math.sqrt(2.0)
@@ -45,6 +49,9 @@ def optimization_manager(config):
         grad_clip=config.optim.grad_clip,
     ):
         """Optimizes with warmup and gradient clipping (disabled if negative)."""
+        params = list(params)
+        # average gradients over data-parallel ranks (no-op for a single process)
+        distributed.all_reduce_gradients(params)
         # TODO: this was present before, where warmup=5000. but it reverts everything
         # back to 0.001 afterwards???
         if warmup > 0:
@@ -79,6 +86,9 @@ def v2_optimization_manager(config):
         grad_clip=config.optim.grad_clip,
     ):
         """Optimizes with warmup and gradient clipping (disabled if negative)."""
+        params = list(params)
+        # average gradients over data-parallel ranks (no-op for a single process)
+        distributed.all_reduce_gradients(params)
         if step < warmup and warmup > 0:
             for g in optimizer.param_groups:
                 g["lr"] = lr * np.minimum(step / warmup, 1.0)
@@ -455,7 +465,7 @@ def get_time_sde_loss_fn_flow_z_interpolate(
         n = batch.size(0)
         # when data enters this loop, you first want it to be [-1, 1] (checked)
         if "none" not in flow_name:
-            with torch.no_grad():
+            with torch.no_grad(), profiling.phase("flow_encode"):
                 flow.eval()
                 z_batch = (batch + 1.0) / 2.0
                 if flow_name in ["mintnet", "nice", "realnvp"]:
@@ -494,7 +504,7 @@ def get_time_sde_loss_fn_flow_z_interpolate(
         zt = mean + std[:, None, None, None] * px
 
         if "none" not in flow_name:
-            with torch.no_grad():
+            with torch.no_grad(), profiling.phase("flow_decode"):
                 if flow_name in ["mintnet", "nice", "realnvp"]:
                     # map z -> x via flow, then rescale to [-1, 1]
                     xt = flow.module.sampling(zt, rescale=True)
@@ -593,7 +603,7 @@ def get_time_sde_loss_fn_flow_z_interpolate(
                 weights = torch.from_numpy(weights).float().to(unweighted_loss.device)
                 # TODO: HACK, this is when the batch size doesn't evenly divide the dataset during training
                 if len(weights) != len(batch):
-                    weights = weights[0 : len(batch)]
+                    weights = weights[history.batch_slice(len(batch))]
                 weights = weights.view(unweighted_loss.size())
 
                 # all positive weights
@@ -628,15 +638,15 @@ def get_time_sde_loss_fn_flow_z_interpolate(
         # collect everything in a loss_dict
         # let's just construct the loss_dict here and return the final loss
         loss_dict = dict(
-            loss=loss.mean().item(),
-            unweighted_loss=unweighted_loss.mean().item(),
-            variance=variance.item(),
-            total_time_loss=loss.mean().item(),
-            dt_time_loss=loss1.mean().item(),
-            time_loss=loss2.mean().item(),
-            time_sq_loss=loss3.mean().item(),
-            edge0=edge1.mean().item(),
-            edge1=-edge2.mean().item(),
+            loss=loss.mean().detach(),
+            unweighted_loss=unweighted_loss.mean().detach(),
+            variance=variance.detach(),
+            total_time_loss=loss.mean().detach(),
+            dt_time_loss=loss1.mean().detach(),
+            time_loss=loss2.mean().detach(),
+            time_sq_loss=loss3.mean().detach(),
+            edge0=edge1.mean().detach(),
+            edge1=-edge2.mean().detach(),
             weights=weights,
         )
         return loss.mean(), loss_dict
@@ -842,6 +852,8 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
     interpolate=False,
     factor=1,
     device=None,
+    time_sampler="uniform",
+    num_times=1,
 ):
     """Create a loss function for training with arbirary SDEs.
 
@@ -856,6 +868,9 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
       likelihood_weighting: If `True`, weight the mixture of score matching losses
         according to https://arxiv.org/abs/2101.09258; otherwise use the weighting recommended in our paper.
       eps: A `float` number. The smallest time step to sample from.
+      time_sampler: how t is drawn when not `resample_t`, see `time_samplers`.
+      num_times: number of (t, epsilon) pairs per data point. The flow encodes
+        each batch once, and the score network sees num_times times as many inputs.
 
     Returns:
       A loss function.
@@ -863,8 +878,18 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
 
     assert factor == 1  # assumes factor=1
 
+    if resample_t and time_sampler != "uniform":
+        raise NotImplementedError("resample_t only works with uniform time sampling")
+    sample_times = time_samplers.get_time_sampler(time_sampler, 0.0, 1 - eps, device)
+    if iw and num_times > 1:
+        raise NotImplementedError("iw keeps one loss history slot per data point")
+
     def ctsm_loss_fn(epsilons, epsilon, qx, t):
-        targets = prob_path.full_epsilon_target(epsilon, qx, t, factor)
+        # all num_times draws of t and epsilon broadcast against qx, which is not
+        # repeated: (num_times, batch_size, ...) in one call, flattened after
+        targets = prob_path.full_epsilon_target(
+            epsilon.view((-1,) + qx.shape), qx[None], t.view(-1, len(qx)), factor
+        ).flatten(0, 1)
 
         loss = torch.mean(torch.square(targets - epsilons), dim=(1, 2, 3))
 
@@ -885,9 +910,10 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
         )
 
         batch_size = batch.size(0)
+        num_pairs = num_times * batch_size
         # when data enters this loop, you first want it to be [-1, 1] (checked)
         if "none" not in flow_name:
-            with torch.no_grad():
+            with torch.no_grad(), profiling.phase("flow_encode"):
                 flow.eval()
                 z_batch = (batch + 1.0) / 2.0
                 if flow_name in ["mintnet", "nice", "realnvp"]:
@@ -917,33 +943,39 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
             temp = 0.9
             z = temp / (1 - temp**2)
 
-            y = torch.rand(batch_size, device=device)
+            y = torch.rand(num_pairs, device=device)
             t = 2 * y * z / (1 + torch.sqrt(1 + 4 * y**2 * z**2))
             t = t * (1 - eps) / temp
+            t_weights = torch.ones_like(t)
         else:
-            t = torch.rand(batch_size, device=device) * (1 - eps)
+            t, t_weights = sample_times(num_pairs)
 
         if iw and not interpolate:
             with torch.no_grad():
-                t = torch.sort(t)[0]  # HACK
+                t, order = torch.sort(t)  # HACK
+                t_weights = t_weights[order]
 
         #   # TODO: trying this out!
         #   u0 = torch.rand(1, device=device) * (sde.T - eps) + eps
         #   t = (u0 + torch.arange(1, n + 1).to(device) / n) % 1
 
-        epsilon = torch.randn_like(batch)  # noise
-        mean, std = prob_path.marginal_prob(z_batch, t)  # feed in z into SDE
-        zt = epsilon * std[:, None, None, None] + mean
+        epsilon = torch.randn(
+            (num_pairs,) + batch.shape[1:], device=batch.device, dtype=batch.dtype
+        )  # noise
+        # feed in z into SDE, broadcast over the num_times draws of (t, epsilon)
+        mean, std = prob_path.marginal_prob(z_batch[None], t.view(num_times, -1))
+        zt = epsilon.view(mean.shape) * std[..., None, None, None] + mean
+        zt = zt.flatten(0, 1)
 
         if "none" not in flow_name:
-            with torch.no_grad():
+            with torch.no_grad(), profiling.phase("flow_decode"):
                 if flow_name in ["mintnet", "nice", "realnvp"]:
                     # map z -> x via flow, then rescale to [-1, 1]
                     xt = flow.module.sampling(zt, rescale=True)
                 else:
                     if "noise" in flow_name or "copula" in flow_name:
                         xt = flow.module.sample(
-                            zt.view(batch_size, -1),
+                            zt.view(num_pairs, -1),
                             context=None,
                             rescale=True,
                             transform=True,
@@ -951,16 +983,16 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
                         )
                     else:
                         xt = flow.module.sample(
-                            zt.view(batch_size, -1), context=None, rescale=True
+                            zt.view(num_pairs, -1), context=None, rescale=True
                         )
         else:
             xt = zt
 
         # reshape bc mlp
         if mlp:
-            epsilon = epsilon.view(batch_size, -1)
+            epsilon = epsilon.view(num_pairs, -1)
             batch = batch.view(batch_size, -1)
-            xt = xt.view(batch_size, -1)  # mlp
+            xt = xt.view(num_pairs, -1)  # mlp
 
         unweighted_loss = ctsm_loss_fn(score_fn(xt, t), epsilon, z_batch, t)
 
@@ -978,7 +1010,7 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
                 weights = torch.from_numpy(weights).float().to(device)
                 # TODO: HACK, this is when the batch size doesn't evenly divide the dataset during training
                 if len(weights) != len(batch):
-                    weights = weights[0 : len(batch)]
+                    weights = weights[history.batch_slice(len(batch))]
                 weights = weights.view(unweighted_loss.size())
 
                 # all positive weights
@@ -1007,16 +1039,19 @@ def get_time_prob_path_loss_fn_flow_z_interpolate_epsilons(
             loss = unweighted_loss
             weights = torch.ones_like(loss)
 
+        # correct for the density t was drawn from, see time_samplers
+        loss = loss * t_weights
+
         # variance
         variance = ((loss - torch.mean(loss, dim=0, keepdim=True)) ** 2).mean()
 
         # collect everything in a loss_dict
         # let's just construct the loss_dict here and return the final loss
         loss_dict = dict(
-            loss=loss.mean().item(),
-            unweighted_loss=unweighted_loss.mean().item(),
-            variance=variance.item(),
-            total_time_loss=loss.mean().item(),
+            loss=loss.mean().detach(),
+            unweighted_loss=unweighted_loss.mean().detach(),
+            variance=variance.detach(),
+            total_time_loss=loss.mean().detach(),
             weights=weights,
         )
         return loss.mean(), loss_dict
@@ -1040,6 +1075,8 @@ def get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
     interpolate=False,
     factor=1,
     device=None,
+    time_sampler="uniform",
+    num_times=1,
 ):
     """Create a loss function for training with arbirary SDEs.
 
@@ -1054,6 +1091,9 @@ def get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
       likelihood_weighting: If `True`, weight the mixture of score matching losses
         according to https://arxiv.org/abs/2101.09258; otherwise use the weighting recommended in our paper.
       eps: A `float` number. The smallest time step to sample from.
+      time_sampler: how t is drawn when not `resample_t`, see `time_samplers`.
+      num_times: number of (t, epsilon) pairs per data point. The flow encodes
+        each batch once, and the score network sees num_times times as many inputs.
 
     Returns:
       A loss function.
@@ -1061,8 +1101,18 @@ def get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
 
     assert factor == 1  # assumes factor=1
 
+    if resample_t and time_sampler != "uniform":
+        raise NotImplementedError("resample_t only works with uniform time sampling")
+    sample_times = time_samplers.get_time_sampler(time_sampler, 0.0, 1 - eps, device)
+    if iw and num_times > 1:
+        raise NotImplementedError("iw keeps one loss history slot per data point")
+
     def ctsm_loss_fn(epsilons, epsilon, qx, t):
-        targets = prob_path.full_epsilon_target(epsilon, qx, t, factor)
+        # all num_times draws of t and epsilon broadcast against qx, which is not
+        # repeated: (num_times, batch_size, ...) in one call, flattened after
+        targets = prob_path.full_epsilon_target(
+            epsilon.view((-1,) + qx.shape), qx[None], t.view(-1, len(qx)), factor
+        ).flatten(0, 1)
 
         loss = torch.mean(torch.square(targets - epsilons), dim=(1, 2, 3))
 
@@ -1083,9 +1133,10 @@ def get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
         )
 
         batch_size = batch.size(0)
+        num_pairs = num_times * batch_size
         # when data enters this loop, you first want it to be [-1, 1] (checked)
         if "none" not in flow_name:
-            with torch.no_grad():
+            with torch.no_grad(), profiling.phase("flow_encode"):
                 flow.eval()
                 z_batch = (batch + 1.0) / 2.0
                 if flow_name in ["mintnet", "nice", "realnvp"]:
@@ -1115,23 +1166,29 @@ def get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
             temp = 0.9
             z = temp / (1 - temp**2)
 
-            y = torch.rand(batch_size, device=device)
+            y = torch.rand(num_pairs, device=device)
             t = 2 * y * z / (1 + torch.sqrt(1 + 4 * y**2 * z**2))
             t = t * (1 - eps) / temp
+            t_weights = torch.ones_like(t)
         else:
-            t = torch.rand(batch_size, device=device) * (1 - eps)
+            t, t_weights = sample_times(num_pairs)
 
         if iw and not interpolate:
             with torch.no_grad():
-                t = torch.sort(t)[0]  # HACK
+                t, order = torch.sort(t)  # HACK
+                t_weights = t_weights[order]
 
         #   # TODO: trying this out!
         #   u0 = torch.rand(1, device=device) * (sde.T - eps) + eps
         #   t = (u0 + torch.arange(1, n + 1).to(device) / n) % 1
 
-        epsilon = torch.randn_like(batch)  # noise
-        mean, std = prob_path.marginal_prob(z_batch, t)  # feed in z into SDE
-        zt = epsilon * std[:, None, None, None] + mean
+        epsilon = torch.randn(
+            (num_pairs,) + batch.shape[1:], device=batch.device, dtype=batch.dtype
+        )  # noise
+        # feed in z into SDE, broadcast over the num_times draws of (t, epsilon)
+        mean, std = prob_path.marginal_prob(z_batch[None], t.view(num_times, -1))
+        zt = epsilon.view(mean.shape) * std[..., None, None, None] + mean
+        zt = zt.flatten(0, 1)
 
         # with torch.no_grad():
         #     if flow_name in ["mintnet", "nice", "realnvp"]:
@@ -1183,7 +1240,7 @@ def get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
                 weights = torch.from_numpy(weights).float().to(device)
                 # TODO: HACK, this is when the batch size doesn't evenly divide the dataset during training
                 if len(weights) != len(batch):
-                    weights = weights[0 : len(batch)]
+                    weights = weights[history.batch_slice(len(batch))]
                 weights = weights.view(unweighted_loss.size())
 
                 # all positive weights
@@ -1212,16 +1269,19 @@ def get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
             loss = unweighted_loss
             weights = torch.ones_like(loss)
 
+        # correct for the density t was drawn from, see time_samplers
+        loss = loss * t_weights
+
         # variance
         variance = ((loss - torch.mean(loss, dim=0, keepdim=True)) ** 2).mean()
 
         # collect everything in a loss_dict
         # let's just construct the loss_dict here and return the final loss
         loss_dict = dict(
-            loss=loss.mean().item(),
-            unweighted_loss=unweighted_loss.mean().item(),
-            variance=variance.item(),
-            total_time_loss=loss.mean().item(),
+            loss=loss.mean().detach(),
+            unweighted_loss=unweighted_loss.mean().detach(),
+            variance=variance.detach(),
+            total_time_loss=loss.mean().detach(),
             weights=weights,
         )
         return loss.mean(), loss_dict
@@ -1254,6 +1314,8 @@ def get_step_fn(
     device="cpu",
     epsilons=False,
     use_zt=False,
+    time_sampler="uniform",
+    num_times=1,
 ):
     """Create a one-step training/evaluation function.
 
@@ -1360,6 +1422,8 @@ def get_step_fn(
                         likelihood_weighting=likelihood_weighting,
                         resample_t=resample_t,
                         device=device,
+                        time_sampler=time_sampler,
+                        num_times=num_times,
                     )
                 elif use_zt:
                     loss_fn = get_time_prob_path_loss_fn_flow_zt_z_interpolate_epsilons(
@@ -1377,6 +1441,8 @@ def get_step_fn(
                         likelihood_weighting=likelihood_weighting,
                         resample_t=resample_t,
                         device=device,
+                        time_sampler=time_sampler,
+                        num_times=num_times,
                     )
             else:
                 raise NotImplementedError
@@ -1403,18 +1469,18 @@ def get_step_fn(
         if train:
             optimizer = state["optimizer"]
             optimizer.zero_grad()
-            loss, loss_dict = loss_fn(model, batch)
-            loss.backward()
-            optimize_fn(optimizer, model.parameters(), step=state["step"])
+            with profiling.phase("score_forward"):
+                loss, loss_dict = loss_fn(model, batch)
+            with profiling.phase("backward"):
+                loss.backward()
+            with profiling.phase("optimizer"):
+                optimize_fn(optimizer, model.parameters(), step=state["step"])
             state["step"] += 1
-            state["ema"].update(model.parameters())
+            with profiling.phase("ema"):
+                state["ema"].update(model.parameters())
         else:
-            with torch.no_grad():
-                ema = state["ema"]
-                ema.store(model.parameters())
-                ema.copy_to(model.parameters())
-                loss, loss_dict = loss_fn(model, batch)
-                ema.restore(model.parameters())
+            with torch.no_grad(), profiling.phase("score_forward"):
+                loss, loss_dict = loss_fn(EMAModel(model, state["ema"]), batch)
 
         return loss_dict
 
@@ -5,7 +5,6 @@ from absl import flags
 from ml_collections.config_flags import config_flags
 import logging
 import os
-import wandb
 import torch
 import numpy as np
 
@@ -44,33 +43,40 @@ def main(argv):
         torch.backends.cudnn.benchmark = False
 
     mode = None
+    # under torchrun only the first process sets up wandb and the log files
+    is_main = int(os.environ.get("RANK", 0)) == 0
 
     if FLAGS.mode == "eval":
         mode = "disabled"
-    # TODO: set up wandb and replace names here
-    api_key = os.getenv("WANDB_API_KEY")
-    wandb.login(key=api_key)
-    wandb.init(
-        project=FLAGS.project,
-        entity=TODO,
-        name=FLAGS.doc,
-        mode=mode,
-    )
+    # only set up wandb if it is one of the metrics sinks
+    if is_main and "wandb" in FLAGS.config.metrics.sinks:
+        import wandb
+
+        # TODO: set up wandb and replace names here
+        api_key = os.getenv("WANDB_API_KEY")
+        wandb.login(key=api_key)
+        wandb.init(
+            project=FLAGS.project,
+            entity=TODO,
+            name=FLAGS.doc,
+            mode=mode,
+        )
 
     if FLAGS.mode == "train":
         # Create the working directory
         os.makedirs(FLAGS.workdir, exist_ok=True)
-        # Set logger so that it outputs to both console and file
-        # Make logging work for both disk and Google Cloud Storage
-        gfile_stream = open(os.path.join(FLAGS.workdir, "stdout.txt"), "w")
-        handler = logging.StreamHandler(gfile_stream)
-        formatter = logging.Formatter(
-            "%(levelname)s - %(filename)s - %(asctime)s - %(message)s"
-        )
-        handler.setFormatter(formatter)
         logger = logging.getLogger()
-        logger.addHandler(handler)
         logger.setLevel("INFO")
+        if is_main:
+            # Set logger so that it outputs to both console and file
+            # Make logging work for both disk and Google Cloud Storage
+            gfile_stream = open(os.path.join(FLAGS.workdir, "stdout.txt"), "w")
+            handler = logging.StreamHandler(gfile_stream)
+            formatter = logging.Formatter(
+                "%(levelname)s - %(filename)s - %(asctime)s - %(message)s"
+            )
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
 
         # save config
         print(FLAGS.config)
@@ -0,0 +1,223 @@
+"""Low-overhead metrics logging for the training loops.
+
+Scalars are accumulated on the device they were produced on, so logging a loss
+does not force a host sync. Every `flush_freq` steps the running statistics
+(mean, var, min, max) are moved to the host in a single transfer and written to
+a set of pluggable sinks (wandb, a local jsonl/parquet file, or stdout).
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+import distributed
+
+
+class Sink(object):
+    """Base class for a destination of aggregated metrics."""
+
+    def write(self, record, step):
+        raise NotImplementedError
+
+    def write_images(self, name, images, step):
+        # most sinks have no way of storing images
+        pass
+
+    def close(self):
+        pass
+
+
+class StdoutSink(Sink):
+    def write(self, record, step):
+        msg = ", ".join(
+            "%s: %.5e" % (k, v) for k, v in record.items() if _is_number(v)
+        )
+        logging.info("step: %d, %s" % (step, msg))
+
+
+class WandbSink(Sink):
+    def __init__(self):
+        # only import wandb when it is actually used
+        import wandb
+
+        self.wandb = wandb
+
+    def write(self, record, step):
+        record = dict(record)
+        record["step"] = step
+        self.wandb.log(record)
+
+    def write_images(self, name, images, step):
+        self.wandb.log({name: [self.wandb.Image(i) for i in images], "step": step})
+
+
+class JsonlSink(Sink):
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fp = open(path, "a")
+
+    def write(self, record, step):
+        record = {k: v for k, v in record.items() if _is_number(v)}
+        record["step"] = step
+        self.fp.write(json.dumps(record) + "\n")
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class ParquetSink(Sink):
+    """Buffers records in memory and writes a single parquet file on close."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.records = []
+
+    def write(self, record, step):
+        record = {k: v for k, v in record.items() if _is_number(v)}
+        record["step"] = step
+        self.records.append(record)
+
+    def close(self):
+        import pandas as pd
+
+        if self.records:
+            pd.DataFrame(self.records).to_parquet(self.path)
+
+
+def _is_number(v):
+    return isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(
+        v, bool
+    )
+
+
+class MetricsLogger(object):
+    """Accumulates scalar metrics on device and periodically flushes them.
+
+    `log` is called every step with a dict of (0-dim) tensors or python numbers.
+    Nothing leaves the device until `flush`, which is triggered automatically
+    every `flush_freq` calls to `log`.
+    """
+
+    def __init__(self, sinks, flush_freq=100):
+        self.sinks = sinks
+        self.flush_freq = flush_freq
+        self._stats = {}
+        self._counts = {}
+        self._last_step = 0
+
+    def log(self, metrics, step):
+        """Accumulates the scalar entries of `metrics`; non-scalars are ignored."""
+        with torch.no_grad():
+            for k, v in metrics.items():
+                if k == "step":
+                    continue
+                if torch.is_tensor(v):
+                    if v.numel() != 1:
+                        continue
+                    v = v.detach().reshape(()).to(torch.float64)
+                elif _is_number(v):
+                    v = torch.tensor(float(v), dtype=torch.float64)
+                else:
+                    continue
+
+                # [sum, sum of squares, min, max]
+                stats = self._stats.get(k)
+                if stats is None:
+                    self._stats[k] = torch.stack([v, v * v, v, v])
+                    self._counts[k] = 1
+                else:
+                    stats[:2].add_(torch.stack([v, v * v]))
+                    stats[2] = torch.minimum(stats[2], v)
+                    stats[3] = torch.maximum(stats[3], v)
+                    self._counts[k] += 1
+
+        self._last_step = step
+        if self.flush_freq > 0 and step % self.flush_freq == 0:
+            self.flush(step)
+
+    def flush(self, step=None):
+        """Moves the running statistics to the host and writes them to all sinks."""
+        if not self._stats:
+            return
+        step = self._last_step if step is None else step
+        keys = list(self._stats.keys())
+        # stacked on their device first, so all metrics of a device take a
+        # single device-to-host transfer; Python numbers are already on the host
+        values = {}
+        for device in {self._stats[k].device for k in keys}:
+            device_keys = [k for k in keys if self._stats[k].device == device]
+            stacked = torch.stack([self._stats[k] for k in device_keys])
+            values.update(zip(device_keys, stacked.cpu().numpy()))
+
+        record = {}
+        for k in keys:
+            s, ss, mn, mx = values[k]
+            n = self._counts[k]
+            mean = s / n
+            record[k] = float(mean)
+            if n > 1:
+                record[f"{k}/var"] = float(max(ss / n - mean**2, 0.0))
+                record[f"{k}/min"] = float(mn)
+                record[f"{k}/max"] = float(mx)
+
+        self._stats = {}
+        self._counts = {}
+        self.write(record, step)
+
+    def write(self, record, step):
+        """Writes `record` to all sinks immediately, bypassing aggregation.
+
+        Meant for infrequent values such as evaluation results.
+        """
+        record = {
+            k: float(v) if torch.is_tensor(v) and v.numel() == 1 else v
+            for k, v in record.items()
+            if k != "step"
+        }
+        for sink in self.sinks:
+            sink.write(record, step)
+
+    def write_images(self, name, images, step):
+        for sink in self.sinks:
+            sink.write_images(name, images, step)
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+
+def get_metrics_logger(config, workdir):
+    """Builds a `MetricsLogger` from `config.metrics`."""
+    flush_freq = config.metrics.flush_freq
+    if flush_freq <= 0:
+        flush_freq = config.training.log_freq
+    # in data-parallel training only rank 0 writes metrics
+    if not distributed.is_main_process():
+        return MetricsLogger([], flush_freq=flush_freq)
+
+    sinks = []
+    metrics_dir = os.path.join(workdir, "metrics")
+    for name in config.metrics.sinks.split(","):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name == "wandb":
+            sinks.append(WandbSink())
+        elif name == "stdout":
+            sinks.append(StdoutSink())
+        elif name == "jsonl":
+            sinks.append(JsonlSink(os.path.join(metrics_dir, "train_metrics.jsonl")))
+        elif name == "parquet":
+            sinks.append(
+                ParquetSink(os.path.join(metrics_dir, "train_metrics.parquet"))
+            )
+        else:
+            raise NotImplementedError(f"Metrics sink {name} not supported yet!")
+
+    return MetricsLogger(sinks, flush_freq=flush_freq)
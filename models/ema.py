@@ -4,15 +4,23 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import torch
+import torch.nn as nn
+from torch.func import functional_call
 
 
 # Partially based on: https://github.com/tensorflow/tensorflow/blob/r1.13/tensorflow/python/training/moving_averages.py
 class ExponentialMovingAverage:
     """
     Maintains (exponential) moving average of a set of parameters.
+
+    The shadow parameters are views into one flat buffer, `flat_shadow`, and
+    are updated with a single multi-tensor `torch._foreach_lerp_`. With
+    `update_every=k` the average is only updated on every k-th call, with the
+    product of the k per-step decays, which matches the per-step average when
+    the parameters barely change within k steps.
     """
 
-    def __init__(self, parameters, decay, use_num_updates=True):
+    def __init__(self, parameters, decay, use_num_updates=True, update_every=1):
         """
         Args:
           parameters: Iterable of `torch.nn.Parameter`; usually the result of
@@ -20,14 +28,34 @@ class ExponentialMovingAverage:
           decay: The exponential decay.
           use_num_updates: Whether to use number of updates when computing
             averages.
+          update_every: Number of `update` calls between updates of the
+            average.
         """
         if decay < 0.0 or decay > 1.0:
             raise ValueError("Decay must be between 0 and 1")
+        if update_every < 1:
+            raise ValueError("update_every must be at least 1")
         self.decay = decay
         self.num_updates = 0 if use_num_updates else None
-        self.shadow_params = [p.clone().detach() for p in parameters if p.requires_grad]
+        self.update_every = update_every
+        # product of the decays of the calls since the last update
+        self.pending_decay = 1.0
+        self.num_pending = 0
+        self._set_shadow_params([p.detach() for p in parameters if p.requires_grad])
         self.collected_params = []
 
+    def _set_shadow_params(self, tensors):
+        """Copies `tensors` into one flat buffer, shadow_params are its views."""
+        tensors = list(tensors)
+        if len({(t.dtype, t.device) for t in tensors}) > 1:
+            # mixed precision or devices, keep separate tensors
+            self.flat_shadow = None
+            self.shadow_params = [t.clone() for t in tensors]
+            return
+        self.flat_shadow = torch.cat([t.reshape(-1) for t in tensors])
+        views = self.flat_shadow.split([t.numel() for t in tensors])
+        self.shadow_params = [v.view(t.shape) for v, t in zip(views, tensors)]
+
     def update(self, parameters):
         """
         Update currently maintained parameters.
@@ -43,11 +71,17 @@ class ExponentialMovingAverage:
         if self.num_updates is not None:
             self.num_updates += 1
             decay = min(decay, (1 + self.num_updates) / (10 + self.num_updates))
-        one_minus_decay = 1.0 - decay
+        self.pending_decay *= decay
+        self.num_pending += 1
+        if self.num_pending < self.update_every:
+            return
+
+        one_minus_decay = 1.0 - self.pending_decay
+        self.pending_decay = 1.0
+        self.num_pending = 0
         with torch.no_grad():
             parameters = [p for p in parameters if p.requires_grad]
-            for s_param, param in zip(self.shadow_params, parameters):
-                s_param.sub_(one_minus_decay * (s_param - param))
+            torch._foreach_lerp_(self.shadow_params, parameters, one_minus_decay)
 
     def copy_to(self, parameters):
         """
@@ -58,9 +92,8 @@ class ExponentialMovingAverage:
             updated with the stored moving averages.
         """
         parameters = [p for p in parameters if p.requires_grad]
-        for s_param, param in zip(self.shadow_params, parameters):
-            if param.requires_grad:
-                param.data.copy_(s_param.data)
+        with torch.no_grad():
+            torch._foreach_copy_(parameters, self.shadow_params)
 
     def store(self, parameters):
         """
@@ -92,9 +125,40 @@ class ExponentialMovingAverage:
             decay=self.decay,
             num_updates=self.num_updates,
             shadow_params=self.shadow_params,
+            update_every=self.update_every,
+            pending_decay=self.pending_decay,
+            num_pending=self.num_pending,
         )
 
     def load_state_dict(self, state_dict):
         self.decay = state_dict["decay"]
         self.num_updates = state_dict["num_updates"]
-        self.shadow_params = state_dict["shadow_params"]
+        self._set_shadow_params(state_dict["shadow_params"])
+        # update_every stays as configured, the pending decays are folded into
+        # the next update even if it was lowered; older checkpoints have none
+        self.pending_decay = state_dict.get("pending_decay", 1.0)
+        self.num_pending = state_dict.get("num_pending", 0)
+
+
+class EMAModel(nn.Module):
+    """
+    The model evaluated with the moving averages of its parameters.
+
+    Calls `model` through `torch.func.functional_call` with the shadow
+    parameters of `ema` in place of its trainable parameters, so evaluating
+    it neither copies the averages into the model nor touches the training
+    weights; buffers and frozen parameters are the model's own. Use it in
+    place of the store / copy_to / restore sequence.
+    """
+
+    def __init__(self, model, ema):
+        super().__init__()
+        self.model = model
+        self.ema = ema
+        self.names = [name for name, p in model.named_parameters() if p.requires_grad]
+        assert len(self.names) == len(ema.shadow_params)
+
+    def forward(self, *args, **kwargs):
+        # read at call time, load_state_dict replaces the shadow parameters
+        params = dict(zip(self.names, self.ema.shadow_params))
+        return functional_call(self.model, params, args, kwargs)
@@ -191,6 +191,36 @@ class TimeScoreNetwork(nn.Module):
 #       return out
 
 
+def _spectral_mvn_terms(theta, x, t):
+    """Shared pieces of the MVN parameter score networks in the eigenbasis of theta.
+
+    With theta = V diag(lam) V^T symmetric, (I + t^2 theta)^-1 = V diag(d) V^T
+    with d = 1 / (1 + t^2 lam), so one eigendecomposition per forward pass
+    replaces an inverse per sample.
+    """
+    eigvals, eigvecs = torch.linalg.eigh(0.5 * (theta + theta.T))
+    t = t.view(-1, 1)
+    inv_diag = 1.0 / (1.0 + t**2 * eigvals)
+    x_rot = x.view(x.shape[0], -1) @ eigvecs
+    return eigvals, eigvecs, t, inv_diag, x_rot
+
+
+def _spectral_mvn_score(theta, x, t, model_type):
+    """Fast path of `MVNParamScoreNetwork.forward` for a symmetric theta."""
+    eigvals, eigvecs, t, inv_diag, x_rot = _spectral_mvn_terms(theta, x, t)
+
+    # t tr(theta C^-1) and t x^T C^-1 theta C^-1 x with C = I + t^2 theta
+    term1 = t * torch.sum(eigvals * inv_diag, dim=-1, keepdim=True)
+    term2 = t * torch.sum(eigvals * (x_rot * inv_diag) ** 2, dim=-1, keepdim=True)
+    out_t = -term1 + term2
+
+    if model_type == "time":
+        return out_t
+    else:
+        out_x = -((x_rot * inv_diag) @ eigvecs.T)
+        return out_x, out_t
+
+
 @utils.register_model(name="toy_param_mvn_mi")
 class MVNParamScoreNetwork(nn.Module):
     """
@@ -205,8 +235,16 @@ class MVNParamScoreNetwork(nn.Module):
         self.theta = nn.Parameter(
             torch.randn(self.dim, self.dim).to(device).normal_(0, 0.05)
         )
+        # the fast path only sees the symmetric part of theta
+        self.spectral = config.model.spectral
+        if self.spectral:
+            with torch.no_grad():
+                self.theta.copy_(0.5 * (self.theta + self.theta.T))
 
     def forward(self, x, t):
+        if self.spectral:
+            return _spectral_mvn_score(self.theta, x, t, self.config.model.type)
+
         id_mat = torch.eye(self.dim).to(x.device).view(1, 1, self.dim, self.dim)
 
         # resize things for batching
@@ -253,8 +291,16 @@ class FullMVNParamScoreNetwork(nn.Module):
         self.theta = nn.Parameter(
             torch.randn(self.dim, self.dim).to(device).normal_(0, 0.05)
         )
+        # the fast path only sees the symmetric part of theta
+        self.spectral = config.model.spectral
+        if self.spectral:
+            with torch.no_grad():
+                self.theta.copy_(0.5 * (self.theta + self.theta.T))
 
     def forward(self, x, t):
+        if self.spectral:
+            return _spectral_mvn_score(self.theta, x, t, self.config.model.type)
+
         id_mat = torch.eye(self.dim).to(x.device).view(1, 1, self.dim, self.dim)
 
         # resize things for batching
@@ -287,6 +333,9 @@ class FullMVNParamScoreNetwork(nn.Module):
             return out_x, out_t
 
     def forward_full(self, x, t):
+        if self.spectral:
+            return self._forward_full_spectral(x, t)
+
         id_mat = torch.eye(self.dim).to(x.device).view(1, 1, self.dim, self.dim)
 
         # resize things for batching
@@ -332,6 +381,30 @@ class FullMVNParamScoreNetwork(nn.Module):
             out_x = -(x.view(-1, 1, 1, self.dim) @ new_cov_inv).squeeze()
             return out_x, out_t.squeeze()
 
+    def _forward_full_spectral(self, x, t):
+        """Fast path of `forward_full` for a symmetric theta."""
+        eigvals, eigvecs, t, inv_diag, x_rot = _spectral_mvn_terms(self.theta, x, t)
+
+        # post_cov = (1 - t^2) C^-1 (theta + I) = V diag(post_eig) V^T
+        temp = 1 - t**2
+        post_eig = temp * (eigvals + 1.0) * inv_diag
+        post_mean = (t / temp) * ((x_rot * post_eig) @ eigvecs.T)
+        post_var = post_eig @ (eigvecs**2).T
+
+        x = x.view(x.shape[0], -1)
+        out_t = (
+            t * temp
+            - t * (torch.square(post_mean) + post_var)
+            - t * torch.square(x)
+            + (t**2 + 1) * x * post_mean
+        ) / temp**2
+
+        if self.config.model.type == "time":
+            return out_t.squeeze()
+        else:
+            out_x = -((x_rot * inv_diag) @ eigvecs.T)
+            return out_x, out_t.squeeze()
+
 
 @utils.register_model(name="toy_param_scorenet")
 class ParamScoreNetwork(nn.Module):
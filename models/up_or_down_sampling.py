@@ -12,11 +12,88 @@ import numpy as np
 
 
 def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
+    # the CUDA op is not available, use the polyphase implementation on CPU
+    if input.device.type == "cpu":
+        return upfirdn2d_polyphase(input, kernel, up, down, pad[0], pad[1])
     return upfirdn2d_native(
         input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1]
     )
 
 
+def upfirdn2d_polyphase(input, kernel, up, down, pad0, pad1):
+    """Same result as `upfirdn2d_native` with equal factors and padding along x and y.
+
+    Instead of zero-stuffing the input and discarding outputs, upsampling uses a
+    strided `conv_transpose2d` (which only visits the non-zero taps) and
+    downsampling a strided convolution. Separable kernels, i.e. the outer
+    products built by `_setup_kernel`, are applied as two 1D passes.
+    """
+    n, channel, in_h, in_w = input.shape
+    x = input.reshape(n * channel, 1, in_h, in_w)
+    kernel = kernel.to(x.dtype)
+
+    factors = _separate_kernel(kernel)
+    if factors is not None:
+        k_y, k_x = factors
+        x = _upfirdn_pass(x, k_y.view(1, 1, -1, 1), up, down, pad0, pad1, (True, False))
+        x = _upfirdn_pass(x, k_x.view(1, 1, 1, -1), up, down, pad0, pad1, (False, True))
+    else:
+        w = kernel.view(1, 1, *kernel.shape)
+        x = _upfirdn_pass(x, w, up, down, pad0, pad1, (True, True))
+    return x.reshape(n, channel, x.shape[2], x.shape[3])
+
+
+def _separate_kernel(kernel):
+    """Returns (k_y, k_x) with kernel == outer(k_y, k_x), or None if not separable."""
+    idx = torch.argmax(kernel.abs())
+    i, j = idx // kernel.shape[1], idx % kernel.shape[1]
+    pivot = kernel[i, j]
+    if pivot == 0:
+        return None
+    k_y = kernel[:, j]
+    k_x = kernel[i, :] / pivot
+    if not torch.allclose(torch.outer(k_y, k_x), kernel, rtol=1e-6, atol=0):
+        return None
+    return k_y, k_x
+
+
+def _upfirdn_pass(x, w, up, down, pad0, pad1, axes):
+    """upfirdn of a (N, 1, H, W) tensor with a (1, 1, kh, kw) kernel.
+
+    Only the dimensions flagged in `axes` = (resample_h, resample_w) are
+    resampled and padded, the kernel must have size 1 along the others.
+    """
+    kernel_h, kernel_w = w.shape[2:]
+    resample_h, resample_w = axes
+    pads = [pad0 if resample_w else 0, pad1 if resample_w else 0]
+    pads += [pad0 if resample_h else 0, pad1 if resample_h else 0]
+    stride_up = (up if resample_h else 1, up if resample_w else 1)
+    stride_down = (down if resample_h else 1, down if resample_w else 1)
+
+    if up == 1:
+        # negative padding crops
+        x = F.pad(x, pads)
+        return F.conv2d(x, torch.flip(w, [2, 3]), stride=stride_down)
+
+    # y[i * up + k] += x[i] * w[k]; the upfirdn output n is y[n + k - 1 - pad0]
+    y = F.conv_transpose2d(x, w, stride=stride_up)
+    out_h = x.shape[2] * stride_up[0] + pads[2] + pads[3] - kernel_h + 1
+    out_w = x.shape[3] * stride_up[1] + pads[0] + pads[1] - kernel_w + 1
+    start_h, start_w = kernel_h - 1 - pads[2], kernel_w - 1 - pads[0]
+    y = F.pad(
+        y,
+        [
+            -start_w,
+            start_w + out_w - y.shape[3],
+            -start_h,
+            start_h + out_h - y.shape[2],
+        ],
+    )
+    if down > 1:
+        y = y[:, :, :: stride_down[0], :: stride_down[1]]
+    return y
+
+
 def upfirdn2d_native(
     input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
 ):
@@ -16,8 +16,10 @@ class AutoregressiveTransform(transforms.Transform):
     The parameters of each invertible elementwise transformation can be functions of previous input
     variables, but they must not depend on the current or any following input variables.
 
-    NOTE: Calculating the inverse transform is D times slower than calculating the
-    forward transform, where D is the dimensionality of the input to the transform.
+    NOTE: Calculating the inverse transform requires D sequential passes through the
+    autoregressive net, where D is the dimensionality of the input to the transform.
+    For a MADE, the hidden units are computed incrementally instead, so that the whole
+    inverse costs about as much as one forward pass of the network.
     """
 
     def __init__(self, autoregressive_net):
@@ -30,6 +32,37 @@ class AutoregressiveTransform(transforms.Transform):
         return outputs, logabsdet
 
     def inverse(self, inputs, context=None):
+        if inputs.dim() == 2 and made_module.IncrementalMADE.is_supported(
+            self.autoregressive_net
+        ):
+            return self._incremental_inverse(inputs, context)
+        return self._sequential_inverse(inputs, context)
+
+    def _incremental_inverse(self, inputs, context=None):
+        made = made_module.IncrementalMADE(
+            self.autoregressive_net, torch.zeros_like(inputs), context
+        )
+        outputs = torch.zeros_like(inputs)
+        autoregressive_params = None
+        while made.fixed < inputs.shape[1]:
+            dims, columns, params = made.outputs_for()
+            if autoregressive_params is None:
+                autoregressive_params = params.new_zeros(
+                    inputs.shape[0], inputs.shape[1] * made.output_multiplier
+                )
+            autoregressive_params = autoregressive_params.index_copy(
+                1, columns, params
+            )
+            # the elementwise transforms may modify their parameters in place
+            dims_outputs, _ = self._elementwise_inverse(
+                inputs[:, dims], params.clone()
+            )
+            outputs = outputs.index_copy(1, dims, dims_outputs)
+            made.set_inputs(outputs)
+        # same final call as the sequential loop, with the same parameters
+        return self._elementwise_inverse(inputs, autoregressive_params)
+
+    def _sequential_inverse(self, inputs, context=None):
         num_inputs = np.prod(inputs.shape[1:])
         outputs = torch.zeros_like(inputs)
         logabsdet = None
@@ -107,7 +140,7 @@ class MaskedAffineAutoregressiveTransform(AutoregressiveTransform):
         # shift = autoregressive_params[..., split_idx:]
         # return unconstrained_scale, shift
         autoregressive_params = autoregressive_params.view(
-            -1, self.features, self._output_dim_multiplier()
+            autoregressive_params.shape[0], -1, self._output_dim_multiplier()
         )
         unconstrained_scale = autoregressive_params[..., 0]
         shift = autoregressive_params[..., 1]
@@ -151,7 +184,7 @@ class MaskedPiecewiseLinearAutoregressiveTransform(AutoregressiveTransform):
         batch_size = inputs.shape[0]
 
         unnormalized_pdf = autoregressive_params.view(
-            batch_size, self.features, self._output_dim_multiplier()
+            batch_size, inputs.shape[1], self._output_dim_multiplier()
         )
 
         outputs, logabsdet = splines.linear_spline(
@@ -217,7 +250,7 @@ class MaskedPiecewiseQuadraticAutoregressiveTransform(AutoregressiveTransform):
         batch_size = inputs.shape[0]
 
         transform_params = autoregressive_params.view(
-            batch_size, self.features, self._output_dim_multiplier()
+            batch_size, inputs.shape[1], self._output_dim_multiplier()
         )
 
         unnormalized_widths = transform_params[..., : self.num_bins]
@@ -292,7 +325,7 @@ class MaskedPiecewiseCubicAutoregressiveTransform(AutoregressiveTransform):
         batch_size = inputs.shape[0]
 
         transform_params = autoregressive_params.view(
-            batch_size, self.features, self.num_bins * 2 + 2
+            batch_size, inputs.shape[1], self.num_bins * 2 + 2
         )
 
         unnormalized_widths = transform_params[..., : self.num_bins]
@@ -313,7 +346,7 @@ class MaskedPiecewiseCubicAutoregressiveTransform(AutoregressiveTransform):
             unnorm_derivatives_right=unnorm_derivatives_right,
             inverse=inverse,
         )
-        return outputs, utils.sum_except_batch(logabsdet)
+        return outputs, nsf_utils.sum_except_batch(logabsdet)
 
     def _elementwise_forward(self, inputs, autoregressive_params):
         return self._elementwise(inputs, autoregressive_params)
@@ -407,7 +440,7 @@ class MaskedPiecewiseRationalQuadraticAutoregressiveTransform(AutoregressiveTran
             **spline_kwargs
         )
 
-        return outputs, utils.sum_except_batch(logabsdet)
+        return outputs, nsf_utils.sum_except_batch(logabsdet)
 
     def _elementwise_forward(self, inputs, autoregressive_params):
         return self._elementwise(inputs, autoregressive_params)
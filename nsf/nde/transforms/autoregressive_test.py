@@ -132,5 +132,96 @@ class MaskedPiecewiseCubicAutoregressiveTranformTest(TransformTest):
         self.assert_forward_inverse_are_consistent(transform, inputs)
 
 
+class IncrementalInverseTest(TransformTest):
+    def assert_inverse_matches_sequential(self, transform, inputs, context=None):
+        transform.eval()
+        with torch.no_grad():
+            outputs, logabsdet = transform.inverse(inputs, context)
+            expected_outputs, expected_logabsdet = transform._sequential_inverse(
+                inputs, context
+            )
+        self.assert_tensor_is_good(outputs, inputs.shape)
+        self.assertEqual(outputs, expected_outputs)
+        self.assertEqual(logabsdet, expected_logabsdet)
+
+    def test_affine(self):
+        batch_size = 10
+        features = 20
+        inputs = torch.randn(batch_size, features)
+        self.eps = 1e-5
+        for use_residual_blocks, random_mask in [
+            (False, False),
+            (False, True),
+            (True, False),
+        ]:
+            with self.subTest(
+                use_residual_blocks=use_residual_blocks, random_mask=random_mask
+            ):
+                transform = autoregressive.MaskedAffineAutoregressiveTransform(
+                    features=features,
+                    hidden_features=30,
+                    num_blocks=5,
+                    use_residual_blocks=use_residual_blocks,
+                    random_mask=random_mask,
+                )
+                self.assert_inverse_matches_sequential(transform, inputs)
+
+    def test_affine_with_context_and_batch_norm(self):
+        batch_size = 10
+        features = 20
+        inputs = torch.randn(batch_size, features)
+        context = torch.randn(batch_size, 5)
+        self.eps = 1e-5
+        transform = autoregressive.MaskedAffineAutoregressiveTransform(
+            features=features,
+            hidden_features=30,
+            context_features=5,
+            num_blocks=2,
+            use_batch_norm=True,
+        )
+        self.assert_inverse_matches_sequential(transform, inputs, context)
+
+    def test_piecewise(self):
+        batch_size = 10
+        features = 20
+        inputs = torch.rand(batch_size, features)
+        self.eps = 1e-4
+        transforms = {
+            "linear": autoregressive.MaskedPiecewiseLinearAutoregressiveTransform(
+                num_bins=10, features=features, hidden_features=30
+            ),
+            "quadratic": autoregressive.MaskedPiecewiseQuadraticAutoregressiveTransform(
+                features=features, hidden_features=30, num_bins=10
+            ),
+            "rational_quadratic": autoregressive.MaskedPiecewiseRationalQuadraticAutoregressiveTransform(
+                features=features,
+                hidden_features=30,
+                num_bins=10,
+                tails="linear",
+                tail_bound=3.0,
+            ),
+        }
+        for name, transform in transforms.items():
+            with self.subTest(name=name):
+                self.assert_inverse_matches_sequential(transform, inputs)
+
+    def test_rational_quadratic_random_mask(self):
+        batch_size = 10
+        features = 20
+        inputs = torch.randn(batch_size, features)
+        self.eps = 1e-4
+        # few hidden units, so that several dimensions are inverted together
+        transform = autoregressive.MaskedPiecewiseRationalQuadraticAutoregressiveTransform(
+            features=features,
+            hidden_features=8,
+            num_bins=10,
+            tails="linear",
+            tail_bound=3.0,
+            use_residual_blocks=False,
+            random_mask=True,
+        )
+        self.assert_inverse_matches_sequential(transform, inputs)
+
+
 if __name__ == "__main__":
     unittest.main()
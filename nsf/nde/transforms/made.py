@@ -45,7 +45,7 @@ class MaskedLinear(nn.Linear):
         cls, in_degrees, out_features, autoregressive_features, random_mask, is_output
     ):
         if is_output:
-            out_degrees = utils.tile(
+            out_degrees = nsf_utils.tile(
                 _get_input_degrees(autoregressive_features),
                 out_features // autoregressive_features,
             )
@@ -282,3 +282,171 @@ class MADE(nn.Module):
             outputs = block(outputs, context)
         outputs = self.final_layer(outputs)
         return outputs
+
+
+class _IncrementalStage(object):
+    """One layer of hidden (or output) units of an `IncrementalMADE`."""
+
+    def __init__(self, degrees, compute_fn, batch_size, dtype, device):
+        self.degrees = degrees.to(device)
+        self.compute_fn = compute_fn
+        self.values = torch.zeros(batch_size, len(degrees), dtype=dtype, device=device)
+        self.done = -1  # units with degree <= done have been computed
+
+    def update(self, degree):
+        units = torch.nonzero(
+            (self.degrees > self.done) & (self.degrees <= degree)
+        ).reshape(-1)
+        if len(units) > 0:
+            # out of place, so that the result can still be differentiated
+            self.values = self.values.index_copy(1, units, self.compute_fn(units))
+        self.done = degree
+
+
+class IncrementalMADE(object):
+    """Evaluates a MADE one group of input degrees at a time.
+
+    A hidden unit of degree m only depends on inputs 1..m, so once the first m
+    inputs are known its value is final. Each call to `outputs_for` computes the
+    hidden units that became available since the previous call (every unit is
+    computed exactly once) and returns the outputs of the next group of input
+    dimensions whose parameters no longer depend on unknown inputs. Used by
+    `AutoregressiveTransform.inverse`, which needs D sequential passes through
+    the network otherwise.
+    """
+
+    def __init__(self, made, inputs, context=None):
+        self.features = inputs.shape[1]
+        self.output_multiplier = made.final_layer.out_features // self.features
+        self.inputs = inputs
+        self.fixed = 0  # number of leading input dimensions that are known
+        batch_size, dtype, device = inputs.shape[0], inputs.dtype, inputs.device
+
+        def new_stage(degrees, compute_fn):
+            return _IncrementalStage(degrees, compute_fn, batch_size, dtype, device)
+
+        # Initial layer.
+        initial_weight, initial_bias = _masked_weight_and_bias(made.initial_layer)
+        initial_context = (
+            made.context_layer(context) if context is not None else None
+        )
+
+        def initial_fn(units):
+            outputs = F.linear(self.inputs, initial_weight[units], initial_bias[units])
+            if initial_context is not None:
+                outputs = outputs + initial_context[:, units]
+            return outputs
+
+        self.stages = [new_stage(made.initial_layer.degrees, initial_fn)]
+
+        # Blocks.
+        for block in made.blocks:
+            previous = self.stages[-1]
+            if isinstance(block, MaskedResidualBlock):
+                self.stages += self._residual_stages(block, previous, context, new_stage)
+            else:
+                self.stages.append(self._feedforward_stage(block, previous, new_stage))
+
+        self.final_weight, self.final_bias = _masked_weight_and_bias(made.final_layer)
+        self.final_degrees = made.final_layer.degrees.to(device)
+        self.hidden_degrees = self.stages[-1].degrees
+
+    @staticmethod
+    def is_supported(made):
+        """Dropout and batch statistics make repeated passes non-deterministic."""
+        if not isinstance(made, MADE):
+            return False
+        for block in made.blocks:
+            if isinstance(block, MaskedResidualBlock):
+                uses_batch_norm = block.use_batch_norm
+            else:
+                uses_batch_norm = block.batch_norm is not None
+            if made.training and (uses_batch_norm or block.dropout.p > 0):
+                return False
+        return True
+
+    def _feedforward_stage(self, block, previous, new_stage):
+        weight, bias = _masked_weight_and_bias(block.linear)
+
+        def compute_fn(units):
+            temps = previous.values
+            if block.batch_norm:
+                temps = block.batch_norm(temps)
+            temps = F.linear(temps, weight[units], bias[units])
+            temps = block.activation(temps)
+            return block.dropout(temps)
+
+        return new_stage(block.degrees, compute_fn)
+
+    def _residual_stages(self, block, previous, context, new_stage):
+        linear_0, linear_1 = block.linear_layers
+        weight_0, bias_0 = _masked_weight_and_bias(linear_0)
+        weight_1, bias_1 = _masked_weight_and_bias(linear_1)
+        block_context = block.context_layer(context) if context is not None else None
+
+        def hidden_fn(units):
+            temps = previous.values
+            if block.use_batch_norm:
+                temps = block.batch_norm_layers[0](temps)
+            temps = block.activation(temps)
+            temps = F.linear(temps, weight_0[units], bias_0[units])
+            if block.use_batch_norm:
+                batch_norm = block.batch_norm_layers[1]
+                temps = F.batch_norm(
+                    temps,
+                    batch_norm.running_mean[units],
+                    batch_norm.running_var[units],
+                    batch_norm.weight[units],
+                    batch_norm.bias[units],
+                    training=False,
+                    eps=batch_norm.eps,
+                )
+            temps = block.activation(temps)
+            return block.dropout(temps)
+
+        hidden = new_stage(linear_0.degrees, hidden_fn)
+
+        def output_fn(units):
+            temps = F.linear(hidden.values, weight_1[units], bias_1[units])
+            if block_context is not None:
+                # GLU applied unit by unit
+                temps = temps * torch.sigmoid(block_context[:, units])
+            return previous.values[:, units] + temps
+
+        return [hidden, new_stage(linear_1.degrees, output_fn)]
+
+    def set_inputs(self, inputs):
+        """Replaces the inputs; only the dimensions fixed so far are ever read."""
+        self.inputs = inputs
+
+    def outputs_for(self):
+        """Returns the indices of the next group of dimensions and their outputs.
+
+        The outputs for these dimensions only depend on the first `self.fixed`
+        inputs. The caller is expected to fill in the group's inputs with
+        `set_inputs` before calling this again.
+        """
+        for stage in self.stages:
+            stage.update(self.fixed)
+
+        # outputs of degree d only depend on hidden units of degree < d, so all
+        # outputs up to the next hidden degree that has not been computed yet
+        # can be evaluated together
+        pending = self.hidden_degrees[self.hidden_degrees > self.fixed]
+        last = self.features
+        if len(pending) > 0:
+            last = min(int(pending.min().item()), self.features)
+        dims = torch.arange(self.fixed, last, device=self.final_degrees.device)
+        columns = (
+            dims[:, None] * self.output_multiplier
+            + torch.arange(self.output_multiplier, device=dims.device)
+        ).reshape(-1)
+        outputs = F.linear(
+            self.stages[-1].values, self.final_weight[columns], self.final_bias[columns]
+        )
+        self.fixed = last
+        return dims, columns, outputs
+
+
+def _masked_weight_and_bias(linear):
+    return linear.weight * linear.mask, linear.bias
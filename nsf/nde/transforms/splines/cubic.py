@@ -178,7 +178,7 @@ def cubic_spline(
             (-depressed_1[one_root_mask] + torch.sqrt(-discriminant[one_root_mask]))
             / 2.0
         )
-        q = utils.cbrt(
+        q = nsf_utils.cbrt(
             (-depressed_1[one_root_mask] - torch.sqrt(-discriminant[one_root_mask]))
             / 2.0
         )
@@ -174,7 +174,7 @@ class OneRQNSFVP(ProbPath):
             -0.25 * (1 - t) ** 2 * (self.beta_1 - self.beta_0)
             - 0.5 * (1 - t) * self.beta_0
         )
-        mean = torch.exp(log_mean_coeff[:, None, None, None]) * x1
+        mean = torch.exp(log_mean_coeff[..., None, None, None]) * x1
         std = torch.sqrt(1.0 - torch.exp(2.0 * log_mean_coeff))
         return mean, std
 
@@ -253,14 +253,14 @@ class OneRQNSFVP(ProbPath):
         temp = torch.sqrt(
             2 * alpha**2 * d_alpha**2 + d_alpha**2 * (1 - alpha**2) * factor
         )
-        alpha = alpha[:, None, None, None]
-        d_alpha = d_alpha[:, None, None, None]
-        temp = temp[:, None, None, None]
+        alpha = alpha[..., None, None, None]
+        d_alpha = d_alpha[..., None, None, None]
+        temp = temp[..., None, None, None]
 
         return (
             alpha * d_alpha
             - alpha * d_alpha * torch.square(epsilon)
-            + d_alpha * std[:, None, None, None] * epsilon * x1
+            + d_alpha * std[..., None, None, None] * epsilon * x1
         ) / temp
 
     def noise_pred_target(self, epsilon, x1, t, factor):
@@ -0,0 +1,287 @@
+"""Named phase timers, counters and a torch.profiler window for the loops.
+
+Code is instrumented with module-level calls, which are no-ops unless a
+profiler was started with `init_profiler`:
+
+    with profiling.phase("backward"):
+        loss.backward()
+    profiling.count("nfe", nfe)
+
+The phases used across the repository are data, flow_encode, flow_decode,
+score_forward, backward, optimizer, ema, ratio_integration, ais_hmc, eval,
+checkpoint and logging. Phase times are exclusive: while a nested phase runs,
+e.g. flow_encode inside score_forward, the outer one is paused, so the phases
+of a step add up to its instrumented time. Every phase also counts how often
+it was entered, which gives the number of flow calls, and `count` adds to
+other counters such as the NFE of the ratio integrators.
+
+Every `flush_freq` steps the seconds and counts per step since the last flush
+are written to the metrics logger as time/<phase> and count/<name>, next to
+the wall time per step as time/step. The totals are written to
+<workdir>/profile/phases.json at the end, where the time of the steps outside
+all phases shows up as the phase "other". With
+`trace_steps > 0`, the steps [trace_start, trace_start + trace_steps) are
+captured with torch.profiler and exported to
+<workdir>/profile/trace_<trace_start>.json, which opens in chrome://tracing or
+Perfetto with the phases as named ranges.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import time
+
+import torch
+
+import distributed
+
+_NULL_PHASE = contextlib.nullcontext()
+# the profiler of the running loop, None when profiling is disabled
+_profiler = None
+
+
+class _Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler._exit()
+
+
+class Profiler(object):
+    """Accumulates exclusive phase times and counters between flushes."""
+
+    def __init__(
+        self,
+        out_dir,
+        metrics=None,
+        flush_freq=100,
+        synchronize=True,
+        trace_start=0,
+        trace_steps=0,
+    ):
+        """
+        Args:
+          out_dir: Directory of phases.json and the traces, None to not write them.
+          metrics: A `metrics.MetricsLogger` the phase times are written to.
+          flush_freq: Steps between writes to `metrics`, 0 to only write totals.
+          synchronize: Synchronize CUDA at phase boundaries, so that phases are
+            not charged for kernels launched by earlier ones.
+          trace_start: First step captured with torch.profiler.
+          trace_steps: Number of steps captured, 0 disables the capture.
+        """
+        self.out_dir = out_dir
+        self.metrics = metrics
+        self.flush_freq = flush_freq
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+
+        self.times = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.total_times = collections.defaultdict(float)
+        self.total_counts = collections.defaultdict(int)
+        self.steps = 0
+        self.total_steps = 0
+        self.last_step = 0
+        # wall time of the steps, from one call of `step` to the next
+        self.step_seconds = 0.0
+        self.total_step_seconds = 0.0
+        self._step_start = None
+        # [name, start, record_function] of the open phases, innermost last
+        self._stack = []
+        self._trace = None
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def _enter(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self.times[outer[0]] += now - outer[1]
+        record = None
+        if self._trace is not None:
+            record = torch.profiler.record_function(name)
+            record.__enter__()
+        self._stack.append([name, now, record])
+        self.counts[name] += 1
+
+    def _exit(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        name, start, record = self._stack.pop()
+        self.times[name] += now - start
+        if record is not None:
+            record.__exit__(None, None, None)
+        if self._stack:
+            # the outer phase resumes
+            self._stack[-1][1] = now
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def step(self, step):
+        """Marks the start of training step `step`."""
+        now = time.perf_counter()
+        if self._step_start is not None:
+            self.step_seconds += now - self._step_start
+        self._step_start = now
+        self.last_step = step
+        if self.trace_steps > 0:
+            if step == self.trace_start and self._trace is None:
+                self._start_trace()
+            elif step == self.trace_start + self.trace_steps:
+                self._stop_trace()
+        if self.steps > 0 and self.flush_freq > 0 and step % self.flush_freq == 0:
+            self.flush(step)
+        self.steps += 1
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._trace = torch.profiler.profile(activities=activities)
+        self._trace.start()
+
+    def _stop_trace(self):
+        if self._trace is None:
+            return
+        trace, self._trace = self._trace, None
+        trace.stop()
+        if self.out_dir is not None:
+            path = os.path.join(self.out_dir, f"trace_{self.trace_start}.json")
+            trace.export_chrome_trace(path)
+            logging.info("Exported a profiler trace to %s" % path)
+
+    def flush(self, step):
+        """Writes the seconds and counts per step since the last flush."""
+        steps = max(self.steps, 1)
+        record = {f"time/{k}": v / steps for k, v in self.times.items()}
+        if self.step_seconds > 0:
+            record["time/step"] = self.step_seconds / steps
+        record.update({f"count/{k}": v / steps for k, v in self.counts.items()})
+        if self.metrics is not None and record:
+            self.metrics.write(record, step)
+        for k, v in self.times.items():
+            self.total_times[k] += v
+        for k, v in self.counts.items():
+            self.total_counts[k] += v
+        self.total_steps += self.steps
+        self.total_step_seconds += self.step_seconds
+        self.times.clear()
+        self.counts.clear()
+        self.steps = 0
+        self.step_seconds = 0.0
+
+    def summary(self):
+        """Totals of all flushed steps, phases sorted by time.
+
+        Time of the steps outside all phases is reported as the phase "other".
+        """
+        times = dict(self.total_times)
+        other = self.total_step_seconds - sum(times.values())
+        if self.total_step_seconds > 0 and other > 0:
+            times["other"] = other
+        total = sum(times.values())
+        phases = {
+            k: dict(
+                seconds=v,
+                fraction=v / total if total > 0 else 0.0,
+                calls=self.total_counts.get(k, 0),
+            )
+            for k, v in sorted(times.items(), key=lambda kv: -kv[1])
+        }
+        counters = {
+            k: v for k, v in self.total_counts.items() if k not in self.total_times
+        }
+        return dict(
+            steps=self.total_steps,
+            step_seconds=self.total_step_seconds,
+            phases=phases,
+            counters=counters,
+        )
+
+    def close(self, step=None):
+        self._stop_trace()
+        if self._step_start is not None:
+            # the last step ends here
+            self.step_seconds += time.perf_counter() - self._step_start
+            self._step_start = None
+        if self.steps > 0 or self.times or self.counts:
+            self.flush(self.last_step if step is None else step)
+        summary = self.summary()
+        for k, v in summary["phases"].items():
+            logging.info(
+                "phase %s: %.3fs (%.1f%%), %d calls"
+                % (k, v["seconds"], 100 * v["fraction"], v["calls"])
+            )
+        for k, v in summary["counters"].items():
+            logging.info("counter %s: %d" % (k, v))
+        if self.out_dir is not None:
+            with open(os.path.join(self.out_dir, "phases.json"), "w") as f:
+                json.dump(summary, f, indent=2)
+        return summary
+
+
+def init_profiler(config, workdir, metrics=None):
+    """Starts profiling as configured by `config.profiling`.
+
+    Returns the profiler, or None if profiling is disabled.
+    """
+    global _profiler
+    _profiler = None
+    if not config.profiling.enabled:
+        return None
+    flush_freq = config.profiling.flush_freq
+    if flush_freq <= 0:
+        flush_freq = config.training.log_freq
+    out_dir = None
+    # in data-parallel training every rank is timed, only rank 0 writes
+    if distributed.is_main_process():
+        out_dir = os.path.join(workdir, "profile")
+        os.makedirs(out_dir, exist_ok=True)
+    _profiler = Profiler(
+        out_dir,
+        metrics=metrics,
+        flush_freq=flush_freq,
+        synchronize=config.profiling.synchronize,
+        trace_start=config.profiling.trace_start,
+        trace_steps=config.profiling.trace_steps,
+    )
+    return _profiler
+
+
+def phase(name):
+    """Context manager timing the phase `name`."""
+    if _profiler is None:
+        return _NULL_PHASE
+    return _profiler.phase(name)
+
+
+def count(name, n=1):
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+def step(step):
+    if _profiler is not None:
+        _profiler.step(step)
+
+
+def close(step=None):
+    """Writes the totals and stops profiling, returns the summary or None."""
+    global _profiler
+    if _profiler is None:
+        return None
+    profiler, _profiler = _profiler, None
+    return profiler.close(step)
@@ -0,0 +1,290 @@
+"""Content-addressed cache of density-ratio evaluation results.
+
+The ratio functions of `density_ratios` integrate the time scores over t for
+every evaluation point, which dominates evaluation. With a cache, the
+per-sample results (log r, log p where it is computed, and the NFE) are
+stored under a hash of everything they depend on:
+
+- the settings of the ratio function: rtol, atol, method, eps and the score
+  and prior functions, including the SDE, probability path and flow weights,
+- the weights of the score model (the EMA weights for a `models.ema.EMAModel`),
+- the evaluation points themselves, which covers the dataset split, indices
+  and dequantization noise.
+
+So evaluating the same checkpoint on the same data again, e.g. after changing
+only plotting or aggregation, reads the results instead of integrating.
+Entries are .npz files in one directory. Reading an entry refreshes its
+modification time and the least recently used entries are removed once the
+directory is larger than `max_bytes`. Entries are tagged with the workdir of
+the image runs and with <dataset>_<dim> in toy training, and can be listed and
+removed with
+
+    python ratio_cache.py --cache_dir=../results/ratio_cache --list
+    python ratio_cache.py --cache_dir=../results/ratio_cache --invalidate \\
+      --match=GaussiansforMI_40
+"""
+
+import functools
+import hashlib
+import json
+import os
+import time
+import types
+import weakref
+import zipfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models.ema import EMAModel
+from utils import atomic_savez
+
+
+_FUNCTION_TYPES = (
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+    functools.partial,
+)
+
+
+def _update(h, obj, seen):
+    """Feeds a canonical serialization of `obj` to the hash `h`."""
+    if torch.is_tensor(obj):
+        obj = obj.detach().cpu().contiguous()
+        h.update(f"tensor{obj.dtype}{tuple(obj.shape)}".encode())
+        h.update(obj.reshape(-1).view(torch.uint8).numpy())
+    elif isinstance(obj, np.ndarray):
+        h.update(f"array{obj.dtype}{obj.shape}".encode())
+        h.update(np.ascontiguousarray(obj))
+    elif obj is None or isinstance(obj, (bool, int, float, str, np.number)):
+        h.update(f"{type(obj).__name__}{obj!r}".encode())
+    elif isinstance(obj, bytes):
+        h.update(b"bytes" + obj)
+    elif id(obj) in seen:
+        h.update(b"seen")
+    elif isinstance(obj, dict):
+        seen.add(id(obj))
+        h.update(f"dict{len(obj)}".encode())
+        for key in sorted(obj, key=str):
+            _update(h, key, seen)
+            _update(h, obj[key], seen)
+    elif isinstance(obj, (list, tuple)):
+        seen.add(id(obj))
+        h.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _update(h, item, seen)
+    elif isinstance(obj, EMAModel):
+        seen.add(id(obj))
+        # the parameters of the wrapped model are the training weights
+        h.update(b"EMAModel")
+        _update(h, obj.ema.shadow_params, seen)
+        _update(h, dict(obj.model.named_buffers()), seen)
+    elif isinstance(obj, nn.Module):
+        seen.add(id(obj))
+        h.update(type(obj).__name__.encode())
+        _update(h, obj.state_dict(), seen)
+    elif isinstance(obj, _FUNCTION_TYPES):
+        # by name only, their code is part of the repository
+        h.update(getattr(obj, "__qualname__", type(obj).__name__).encode())
+    else:
+        # e.g. SDEs and probability paths, by their attributes
+        seen.add(id(obj))
+        h.update(type(obj).__name__.encode())
+        attributes = getattr(obj, "__dict__", {})
+        attributes = {
+            k: v for k, v in attributes.items() if not isinstance(v, _FUNCTION_TYPES)
+        }
+        _update(h, attributes, seen)
+
+
+def digest(*objs):
+    """Hex sha256 of tensors, arrays, modules, containers and plain objects."""
+    h = hashlib.sha256()
+    seen = set()
+    for obj in objs:
+        _update(h, obj, seen)
+    return h.hexdigest()
+
+
+# digest of every model seen by the key functions, with the fingerprint of its
+# tensors when it was hashed
+_model_digests = weakref.WeakKeyDictionary()
+
+
+def _fingerprint(model):
+    """Changes whenever a tensor of `model` is modified in place or replaced."""
+    if isinstance(model, EMAModel):
+        tensors = list(model.ema.shadow_params) + list(model.model.buffers())
+    else:
+        tensors = list(model.state_dict(keep_vars=True).values())
+    return tuple((id(t), t.data_ptr(), t._version) for t in tensors)
+
+
+def model_digest(model):
+    """`digest(model)`, only recomputed after the weights of `model` changed."""
+    if not isinstance(model, nn.Module):
+        return digest(model)
+    fingerprint = _fingerprint(model)
+    cached = _model_digests.get(model)
+    if cached is None or cached[0] != fingerprint:
+        cached = (fingerprint, digest(model))
+        _model_digests[model] = cached
+    return cached[1]
+
+
+def get_key_fn(*settings):
+    """Returns `key_fn(score_model, x, *args)`, the cache key of an evaluation.
+
+    The settings, which can hold the flow, are only hashed on the first call
+    and a score model only once per state of its weights, not once per batch.
+    """
+    settings_digest = None
+
+    def key_fn(score_model, x, *args):
+        nonlocal settings_digest
+        if settings_digest is None:
+            settings_digest = digest(*settings)
+        return digest(settings_digest, model_digest(score_model), x, *args)
+
+    return key_fn
+
+
+class RatioCache(object):
+    """A directory of evaluation results with size-based LRU eviction."""
+
+    def __init__(self, cache_dir, max_bytes, tag=""):
+        """
+        Args:
+          cache_dir: Directory of the entries, created if needed.
+          max_bytes: Entries are evicted once the directory is larger.
+          tag: Stored with every new entry, e.g. the workdir, for `invalidate`.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.tag = tag
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        """Returns the dict of arrays stored under `key`, or None."""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                result = {k: entry[k] for k in entry.files if k != "meta"}
+            # the modification time is the last use for the LRU eviction
+            os.utime(path)
+        except (FileNotFoundError, zipfile.BadZipFile, ValueError, EOFError):
+            # missing, or evicted or half-written by another process
+            return None
+        return result
+
+    def put(self, key, kind, **arrays):
+        """Stores `arrays` under `key` and evicts entries beyond `max_bytes`."""
+        meta = json.dumps(dict(kind=kind, tag=self.tag, created=time.time()))
+        atomic_savez(self._path(key), meta=np.array(meta), **arrays)
+        self.evict()
+
+    def get_or_compute(self, key, compute, kind):
+        """Returns the entry under `key`, or stores and returns `compute()`."""
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = compute()
+        self.put(key, kind, **result)
+        return result
+
+    def entries(self):
+        """(path, size, last use) of all entries, least recently used first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def meta(self, path):
+        with np.load(path) as entry:
+            return json.loads(str(entry["meta"]))
+
+    def invalidate(self, match=None):
+        """Removes all entries, or those whose kind or tag contains `match`."""
+        removed = 0
+        for path, _, _ in self.entries():
+            if match is not None:
+                meta = self.meta(path)
+                if match not in meta["kind"] and match not in meta["tag"]:
+                    continue
+            os.remove(path)
+            removed += 1
+        return removed
+
+
+def get_ratio_cache(config, tag=""):
+    """The cache configured by `config.eval.ratio_cache_dir`, None if disabled."""
+    if not config.eval.ratio_cache_dir:
+        return None
+    max_bytes = int(config.eval.ratio_cache_max_gb * 2**30)
+    return RatioCache(config.eval.ratio_cache_dir, max_bytes, tag=tag)
+
+
+if __name__ == "__main__":
+    from absl import app
+    from absl import flags
+
+    FLAGS = flags.FLAGS
+    flags.DEFINE_string("cache_dir", None, "Directory of the cache.")
+    flags.DEFINE_bool("list", False, "list the entries")
+    flags.DEFINE_bool("invalidate", False, "remove entries")
+    flags.DEFINE_string(
+        "match", None, "only remove entries whose kind or tag contains this"
+    )
+    flags.mark_flags_as_required(["cache_dir"])
+
+    def main(argv):
+        cache = RatioCache(FLAGS.cache_dir, max_bytes=float("inf"))
+        if FLAGS.list:
+            entries = cache.entries()
+            for path, size, last_use in entries:
+                meta = cache.meta(path)
+                print(
+                    "%s %8.1fkB %s %s %s"
+                    % (
+                        os.path.basename(path)[:16],
+                        size / 1024,
+                        time.strftime("%Y-%m-%d %H:%M", time.localtime(last_use)),
+                        meta["kind"],
+                        meta["tag"],
+                    )
+                )
+            total = sum(size for _, size, _ in entries)
+            print(f"{len(entries)} entries, {total / 2**20:.1f}MB")
+        if FLAGS.invalidate:
+            removed = cache.invalidate(FLAGS.match)
+            print(f"Removed {removed} entries from {FLAGS.cache_dir}")
+
+    app.run(main)
@@ -23,20 +23,16 @@ import time
 import copy
 
 import numpy as np
-import tensorflow as tf
-import tensorflow_gan as tfgan
 import logging
 
 # Keep the import below for registering all model definitions
 # from models import ddpm, ncsnv2, ncsnpp
 from models import ncsn_unet, ncsnpp
 import losses
-import interp_losses
 import sampling
 from models import utils as mutils
-from models.ema import ExponentialMovingAverage
+from models.ema import EMAModel, ExponentialMovingAverage
 import datasets
-from evaluations import evaluation
 import likelihood
 import sde_lib
 from absl import flags
@@ -46,7 +42,7 @@ import torch.optim as optim
 # from torch.nsf_utils import tensorboard
 from torchvision.utils import make_grid, save_image
 from utils import save_checkpoint, restore_checkpoint
-import wandb
+from metrics import get_metrics_logger
 import density_ratios
 
 FLAGS = flags.FLAGS
@@ -63,13 +59,16 @@ def train(config, workdir):
 
     # Create directories for experimental logs
     sample_dir = os.path.join(workdir, "samples")
-    tf.io.gfile.makedirs(sample_dir)
+    os.makedirs(sample_dir, exist_ok=True)
 
     # Initialize model.
     score_model = mutils.create_model(config)
     ema = ExponentialMovingAverage(
-        score_model.parameters(), decay=config.model.ema_rate
+        score_model.parameters(),
+        decay=config.model.ema_rate,
+        update_every=config.model.ema_update_every,
     )
+    ema_model = EMAModel(score_model, ema)
     optimizer = losses.get_optimizer(config, score_model.parameters())
     scheduler = optim.lr_scheduler.CosineAnnealingLR(
         optimizer,
@@ -87,8 +86,8 @@ def train(config, workdir):
     checkpoint_dir = os.path.join(workdir, "checkpoints")
     # Intermediate checkpoints to resume training after pre-emption in cloud environments
     checkpoint_meta_dir = os.path.join(workdir, "checkpoints-meta", "checkpoint.pth")
-    tf.io.gfile.makedirs(checkpoint_dir)
-    tf.io.gfile.makedirs(os.path.dirname(checkpoint_meta_dir))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(checkpoint_meta_dir), exist_ok=True)
     # Resume training when intermediate checkpoints are detected
     state = restore_checkpoint(checkpoint_meta_dir, state, config.device)
     initial_step = int(state["step"])
@@ -112,6 +111,8 @@ def train(config, workdir):
     scaler = datasets.get_data_scaler(config)
     inverse_scaler = datasets.get_data_inverse_scaler(config)
 
+    metrics = get_metrics_logger(config, workdir)
+
     # Setup SDEs
     if config.training.sde.lower() == "vpsde":
         sde = sde_lib.VPSDE(
@@ -269,13 +270,7 @@ def train(config, workdir):
         # Execute one training step
         # loss = train_step_fn(state, batch)
         summary = train_step_fn(state, batch.detach())
-        summary["step"] = step
-        wandb.log(summary)
-        if step % config.training.log_freq == 0:
-            logging.info(
-                "step: %d, training_loss: %.5e" % (step, summary["loss"].item())
-            )
-            # writer.add_scalar("training_loss", loss, step)
+        metrics.log(summary, step)
 
         # Save a temporary checkpoint to resume training after pre-emption periodically
         if step != 0 and step % config.training.snapshot_freq_for_preemption == 0:
@@ -313,19 +308,16 @@ def train(config, workdir):
             if step > 100 and step % config.training.ratio_freq == 0:
                 if config.eval.enable_bpd:
                     # use EMA for ratio computation
-                    ema.store(score_model.parameters())
-                    ema.copy_to(score_model.parameters())
-
                     # different types of density ratios for energy-based modeling
                     if config.training.pf_ode_bpd:
-                        bpd = likelihood_fn(score_model, dre_eval_batch)[0]
+                        bpd = likelihood_fn(ema_model, dre_eval_batch)[0]
                         bpd = bpd.detach().cpu().numpy().reshape(-1)
                         summary["test_ode_bpds"] = bpd.mean()
                         logging.info(
                             "step: %d, eval_bpd (PF ODE): %.5f" % (step, bpd.mean())
                         )
                     if config.training.dre_bpd:
-                        dre_bpd = density_ratio_fn(score_model, dre_eval_batch)[0]
+                        dre_bpd = density_ratio_fn(ema_model, dre_eval_batch)[0]
                         dre_bpd = dre_bpd.reshape(-1)
                         summary["test_dre_bpds"] = dre_bpd.mean()
                         logging.info(
@@ -333,7 +325,7 @@ def train(config, workdir):
                             % (step, dre_bpd.mean())
                         )
                     if config.training.dre_bpd_v2:
-                        dre_bpd_v2 = density_ratio_fn_v2(score_model, dre_eval_batch)[0]
+                        dre_bpd_v2 = density_ratio_fn_v2(ema_model, dre_eval_batch)[0]
                         dre_bpd_v2 = dre_bpd_v2.reshape(-1)
                         summary["test_dre_bpds_v2"] = dre_bpd_v2.mean()
                         logging.info(
@@ -342,7 +334,7 @@ def train(config, workdir):
                         )
                     if config.training.from_xscore:
                         est_bpd = estimated_density_ratio_fn(
-                            score_model, dre_eval_batch
+                            ema_model, dre_eval_batch
                         )[0]
                         est_bpd = est_bpd.reshape(-1)
                         summary["est_bpds"] = est_bpd.mean()
@@ -351,9 +343,7 @@ def train(config, workdir):
                             % (step, est_bpd.mean())
                         )
 
-                    ema.restore(score_model.parameters())
-
-            wandb.log(summary)
+            metrics.write(summary, step)
 
         # Save a checkpoint periodically and generate samples if needed
         if (
@@ -373,29 +363,24 @@ def train(config, workdir):
 
             # Generate and save samples
             if config.training.snapshot_sampling:
-                ema.store(score_model.parameters())
-                ema.copy_to(score_model.parameters())
-                sample, n = sampling_fn(score_model)
+                sample, n = sampling_fn(ema_model)
                 # log generations to wandb
-                wandb.log({"samples": [wandb.Image(i) for i in sample[0:64]]})
-                ema.restore(score_model.parameters())
+                metrics.write_images("samples", sample[0:64], step)
                 this_sample_dir = os.path.join(sample_dir, "iter_{}".format(step))
-                tf.io.gfile.makedirs(this_sample_dir)
+                os.makedirs(this_sample_dir, exist_ok=True)
                 nrow = int(np.sqrt(sample.shape[0]))
                 image_grid = make_grid(sample, nrow, padding=2)
                 sample = np.clip(
                     sample.permute(0, 2, 3, 1).cpu().numpy() * 255, 0, 255
                 ).astype(np.uint8)
-                with tf.io.gfile.GFile(
-                    os.path.join(this_sample_dir, "sample.np"), "wb"
-                ) as fout:
+                with open(os.path.join(this_sample_dir, "sample.np"), "wb") as fout:
                     np.save(fout, sample)
 
-                with tf.io.gfile.GFile(
-                    os.path.join(this_sample_dir, "sample.png"), "wb"
-                ) as fout:
+                with open(os.path.join(this_sample_dir, "sample.png"), "wb") as fout:
                     save_image(image_grid, fout)
 
+    metrics.close()
+
 
 def evaluate(config, workdir, eval_folder="eval"):
     """Evaluate trained models.
@@ -406,6 +391,11 @@ def evaluate(config, workdir, eval_folder="eval"):
       eval_folder: The subfolder for storing evaluation results. Default to
         "eval".
     """
+    # TensorFlow is only needed for computing sample quality metrics
+    import tensorflow as tf
+    import tensorflow_gan as tfgan
+    from evaluations import evaluation
+
     # Create directory to eval_folder
     eval_dir = os.path.join(workdir, eval_folder)
     tf.io.gfile.makedirs(eval_dir)
@@ -425,7 +415,9 @@ def evaluate(config, workdir, eval_folder="eval"):
     score_model = mutils.create_model(config)
     optimizer = losses.get_optimizer(config, score_model.parameters())
     ema = ExponentialMovingAverage(
-        score_model.parameters(), decay=config.model.ema_rate
+        score_model.parameters(),
+        decay=config.model.ema_rate,
+        update_every=config.model.ema_update_every,
     )
     state = dict(optimizer=optimizer, model=score_model, ema=ema, step=0)
 
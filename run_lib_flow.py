@@ -23,8 +23,6 @@ import time
 import copy
 
 import numpy as np
-import tensorflow as tf
-import tensorflow_gan as tfgan
 import logging
 
 # Keep the import below for registering all model definitions
@@ -36,9 +34,10 @@ from models import ncsn_flow
 import losses
 import sampling
 from models import utils as mutils
-from models.ema import ExponentialMovingAverage
+from models.ema import EMAModel, ExponentialMovingAverage
 import datasets
-from evaluations import evaluation
+import profiling
+import ratio_cache
 import likelihood
 import sde_lib
 from absl import flags
@@ -46,8 +45,9 @@ import torch
 import torch.optim as optim
 import torch.nn.functional as F
 from torchvision.utils import make_grid, save_image
-from utils import save_checkpoint, restore_checkpoint
-import wandb
+from utils import AsyncCheckpointer, restore_checkpoint
+from metrics import get_metrics_logger
+import distributed
 import density_ratios
 
 FLAGS = flags.FLAGS
@@ -64,16 +64,23 @@ def train(config, workdir):
       workdir: Working directory for checkpoints and TF summaries. If this
         contains checkpoint training will be resumed from the latest checkpoint.
     """
+    # data-parallel training: checkpointing, logging and evaluation only on rank 0
+    distributed.init_distributed(config)
+    world_size = distributed.get_world_size()
+    is_main = distributed.is_main_process()
 
     # Create directories for experimental logs
     sample_dir = os.path.join(workdir, "samples")
-    tf.io.gfile.makedirs(sample_dir)
+    os.makedirs(sample_dir, exist_ok=True)
 
     # Initialize model.
     score_model = mutils.create_model(config)
     ema = ExponentialMovingAverage(
-        score_model.parameters(), decay=config.model.ema_rate
+        score_model.parameters(),
+        decay=config.model.ema_rate,
+        update_every=config.model.ema_update_every,
     )
+    ema_model = EMAModel(score_model, ema)
     optimizer = losses.get_optimizer(config, score_model.parameters())
     scheduler = optim.lr_scheduler.CosineAnnealingLR(
         optimizer,
@@ -91,12 +98,23 @@ def train(config, workdir):
     checkpoint_dir = os.path.join(workdir, "checkpoints")
     # Intermediate checkpoints to resume training after pre-emption in cloud environments
     checkpoint_meta_dir = os.path.join(workdir, "checkpoints-meta", "checkpoint.pth")
-    tf.io.gfile.makedirs(checkpoint_dir)
-    tf.io.gfile.makedirs(os.path.dirname(checkpoint_meta_dir))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(checkpoint_meta_dir), exist_ok=True)
+    checkpointer = AsyncCheckpointer(
+        checkpoint_dir,
+        keep=config.training.keep_checkpoints,
+        blocking=not config.training.async_checkpoint,
+    )
     # Resume training when intermediate checkpoints are detected
     state = restore_checkpoint(checkpoint_meta_dir, state, config.device)
     initial_step = int(state["step"])
 
+    if world_size > 1:
+        # start every rank from the same weights, then draw different noise per rank
+        distributed.broadcast_parameters(score_model.parameters())
+        distributed.broadcast_parameters(ema.shadow_params)
+        torch.manual_seed(config.seed + distributed.get_rank())
+
     # Build data iterators
     if not config.training.z_space:
         train_ds, eval_ds, _ = datasets.get_dataset(
@@ -114,6 +132,9 @@ def train(config, workdir):
     scaler = datasets.get_data_scaler(config)
     inverse_scaler = datasets.get_data_inverse_scaler(config)
 
+    metrics = get_metrics_logger(config, workdir)
+    profiling.init_profiler(config, workdir, metrics)
+
     # load pre-trained normalizing flow checkpoint
     if config.training.z_space:
         logging.info("Loading pre-trained flow checkpoint...")
@@ -244,7 +265,10 @@ def train(config, workdir):
                 if z_interpolate:
                     density_ratio_fn = (
                         density_ratios.get_z_interp_density_ratio_fn_flow(
-                            sde, inverse_scaler, mlp=mlp
+                            sde,
+                            inverse_scaler,
+                            mlp=mlp,
+                            method=config.eval.ratio_method,
                         )
                     )
                 else:
@@ -288,6 +312,7 @@ def train(config, workdir):
         logging.info("rescaling output of time score network!")
 
     for step in range(initial_step, num_train_steps + 1):
+        profiling.step(step)
         if not config.training.z_space:
             # Convert data to JAX arrays and normalize them. Use ._numpy() to avoid copy.
             batch = (
@@ -343,17 +368,20 @@ def train(config, workdir):
         # Execute one training step
         # loss = train_step_fn(state, batch)
         summary = train_step_fn(state, batch.detach())
-        summary["step"] = step
-        wandb.log(summary)
-        if step % config.training.log_freq == 0:
-            logging.info("step: %d, training_loss: %.5e" % (step, summary["loss"]))
+        with profiling.phase("logging"):
+            metrics.log(summary, step)
 
         # Save a temporary checkpoint to resume training after pre-emption periodically
-        if step != 0 and step % config.training.snapshot_freq_for_preemption == 0:
-            save_checkpoint(checkpoint_meta_dir, state)
+        if (
+            is_main
+            and step != 0
+            and step % config.training.snapshot_freq_for_preemption == 0
+        ):
+            with profiling.phase("checkpoint"):
+                checkpointer.save(checkpoint_meta_dir, state)
 
         # Report the loss on an evaluation dataset periodically
-        if step % config.training.eval_freq == 0:
+        if is_main and step % config.training.eval_freq == 0:
             if not config.training.z_space:
                 eval_batch = (
                     torch.from_numpy(next(eval_iter)["image"]._numpy())
@@ -421,13 +449,10 @@ def train(config, workdir):
             if step > 100 and step % config.training.ratio_freq == 0:
                 if config.eval.enable_bpd:
                     # use EMA for ratio computation
-                    ema.store(score_model.parameters())
-                    ema.copy_to(score_model.parameters())
-
                     # different types of density ratios for energy-based modeling
                     if config.training.pf_ode_bpd:
                         bpd = likelihood_fn(
-                            score_model, dre_eval_batch, flow_log_det, log_det_logit
+                            ema_model, dre_eval_batch, flow_log_det, log_det_logit
                         )[0]
                         # bpd = bpd.detach().cpu().numpy().reshape(-1)
                         # summary['test_bpds'] = bpd.mean()
@@ -435,7 +460,7 @@ def train(config, workdir):
                         logging.info("step: %d, eval_bpd: %.5f" % (step, bpd.mean()))
                     if config.training.dre_bpd:
                         dre_bpd = density_ratio_fn(
-                            score_model=score_model, flow=flow, x=dre_eval_batch
+                            score_model=ema_model, flow=flow, x=dre_eval_batch
                         )[0]
                         # dre_bpd = dre_bpd.reshape(-1)
                         # summary['test_dre_bpds'] = dre_bpd.mean()
@@ -447,7 +472,7 @@ def train(config, workdir):
                         )
                     if config.training.dre_bpd_v2:
                         raise NotImplementedError
-                        dre_bpd_v2 = density_ratio_fn_v2(score_model, dre_eval_batch)[0]
+                        dre_bpd_v2 = density_ratio_fn_v2(ema_model, dre_eval_batch)[0]
                         dre_bpd_v2 = dre_bpd_v2.reshape(-1)
                         summary["test_dre_bpds_v2"] = dre_bpd_v2.mean()
                         logging.info(
@@ -457,7 +482,7 @@ def train(config, workdir):
                     if config.training.from_xscore:
                         raise NotImplementedError
                         est_bpd = estimated_density_ratio_fn(
-                            score_model, dre_eval_batch
+                            ema_model, dre_eval_batch
                         )[0]
                         est_bpd = est_bpd.reshape(-1)
                         summary["est_bpds"] = est_bpd.mean()
@@ -466,9 +491,7 @@ def train(config, workdir):
                             % (step, est_bpd.mean())
                         )
 
-                    ema.restore(score_model.parameters())
-
-            wandb.log(summary)
+            metrics.write(summary, step)
 
         # Save a checkpoint periodically and generate samples if needed
         if (
@@ -476,41 +499,43 @@ def train(config, workdir):
             and step % config.training.snapshot_freq == 0
             or step == num_train_steps
         ):
-            # Save the checkpoint.
-            save_step = step // config.training.snapshot_freq
-            save_checkpoint(
-                os.path.join(checkpoint_dir, f"checkpoint_{save_step}.pth"), state
-            )
-
-            # update optimizer scheduler
+            # update optimizer scheduler (on every rank to keep learning rates in sync)
             scheduler.step()
             print("learning rate is now: {}".format(scheduler._last_lr))
+            if not is_main:
+                continue
+
+            # Save the checkpoint.
+            save_step = step // config.training.snapshot_freq
+            with profiling.phase("checkpoint"):
+                checkpointer.save(
+                    os.path.join(checkpoint_dir, f"checkpoint_{save_step}.pth"),
+                    state,
+                    ema_artifact=True,
+                )
 
             # Generate and save samples
             if config.training.snapshot_sampling:
-                ema.store(score_model.parameters())
-                ema.copy_to(score_model.parameters())
-                sample, n = sampling_fn(score_model)
+                sample, n = sampling_fn(ema_model)
                 # log generations to wandb
-                wandb.log({"samples": [wandb.Image(i) for i in sample[0:64]]})
-                ema.restore(score_model.parameters())
+                metrics.write_images("samples", sample[0:64], step)
                 this_sample_dir = os.path.join(sample_dir, "iter_{}".format(step))
-                tf.io.gfile.makedirs(this_sample_dir)
+                os.makedirs(this_sample_dir, exist_ok=True)
                 nrow = int(np.sqrt(sample.shape[0]))
                 image_grid = make_grid(sample, nrow, padding=2)
                 sample = np.clip(
                     sample.permute(0, 2, 3, 1).cpu().numpy() * 255, 0, 255
                 ).astype(np.uint8)
-                with tf.io.gfile.GFile(
-                    os.path.join(this_sample_dir, "sample.np"), "wb"
-                ) as fout:
+                with open(os.path.join(this_sample_dir, "sample.np"), "wb") as fout:
                     np.save(fout, sample)
 
-                with tf.io.gfile.GFile(
-                    os.path.join(this_sample_dir, "sample.png"), "wb"
-                ) as fout:
+                with open(os.path.join(this_sample_dir, "sample.png"), "wb") as fout:
                     save_image(image_grid, fout)
 
+    profiling.close(num_train_steps)
+    checkpointer.close()
+    metrics.close()
+
 
 def evaluate(config, workdir, eval_folder="eval"):
     """Evaluate trained models.
@@ -521,6 +546,11 @@ def evaluate(config, workdir, eval_folder="eval"):
       eval_folder: The subfolder for storing evaluation results. Default to
         "eval".
     """
+    # TensorFlow is only needed for computing sample quality metrics
+    import tensorflow as tf
+    import tensorflow_gan as tfgan
+    from evaluations import evaluation
+
     # Create directory to eval_folder
     eval_dir = os.path.join(workdir, eval_folder)
     tf.io.gfile.makedirs(eval_dir)
@@ -548,7 +578,9 @@ def evaluate(config, workdir, eval_folder="eval"):
     score_model = mutils.create_model(config)
     optimizer = losses.get_optimizer(config, score_model.parameters())
     ema = ExponentialMovingAverage(
-        score_model.parameters(), decay=config.model.ema_rate
+        score_model.parameters(),
+        decay=config.model.ema_rate,
+        update_every=config.model.ema_update_every,
     )
     state = dict(optimizer=optimizer, model=score_model, ema=ema, step=0)
 
@@ -623,7 +655,10 @@ def evaluate(config, workdir, eval_folder="eval"):
                 if not config.eval.ais:
                     density_ratio_fn = (
                         density_ratios.get_z_interp_density_ratio_fn_flow(
-                            sde, inverse_scaler
+                            sde,
+                            inverse_scaler,
+                            method=config.eval.ratio_method,
+                            cache=ratio_cache.get_ratio_cache(config, tag=workdir),
                         )
                     )
                 else:
@@ -14,8 +14,10 @@ from models import ncsn_flow, ncsn_unet
 import losses
 import sampling
 from models import utils as mutils
-from models.ema import ExponentialMovingAverage
+from models.ema import EMAModel, ExponentialMovingAverage
 import datasets
+import profiling
+import ratio_cache
 
 # from evaluations import ais
 import likelihood
@@ -23,10 +25,17 @@ import sde_lib
 from absl import flags
 import torch
 from torchvision.utils import make_grid, save_image
-from utils import save_checkpoint, restore_checkpoint, load_history, get_prob_path
-import wandb
+from utils import (
+    AsyncCheckpointer,
+    atomic_savez,
+    restore_checkpoint,
+    restore_ema_checkpoint,
+    load_history,
+    get_prob_path,
+)
+from metrics import get_metrics_logger
+import distributed
 import density_ratios
-import matplotlib.pyplot as plt
 import pickle
 
 FLAGS = flags.FLAGS
@@ -47,6 +56,11 @@ def train(config, workdir):
       workdir: Working directory for checkpoints and TF summaries. If this
         contains checkpoint training will be resumed from the latest checkpoint.
     """
+    # data-parallel training: checkpointing, logging and evaluation only on rank 0
+    distributed.init_distributed(config)
+    world_size = distributed.get_world_size()
+    is_main = distributed.is_main_process()
+
     # Create directories for experimental logs
     sample_dir = os.path.join(workdir, "samples")
     os.makedirs(sample_dir, exist_ok=True)
@@ -57,8 +71,11 @@ def train(config, workdir):
     # Initialize model.
     score_model = mutils.create_model(config)
     ema = ExponentialMovingAverage(
-        score_model.parameters(), decay=config.model.ema_rate
+        score_model.parameters(),
+        decay=config.model.ema_rate,
+        update_every=config.model.ema_update_every,
     )
+    ema_model = EMAModel(score_model, ema)
     optimizer = losses.get_optimizer(config, score_model.parameters())
     if config.optim.manager == "v1":
         # this is what it always has been
@@ -103,6 +120,11 @@ def train(config, workdir):
     checkpoint_meta_dir = os.path.join(workdir, "checkpoints-meta", "checkpoint.pth")
     os.makedirs(checkpoint_dir, exist_ok=True)
     os.makedirs(os.path.dirname(checkpoint_meta_dir), exist_ok=True)
+    checkpointer = AsyncCheckpointer(
+        checkpoint_dir,
+        keep=config.training.keep_checkpoints,
+        blocking=not config.training.async_checkpoint,
+    )
 
     # Resume training when intermediate checkpoints are detected
     if config.training.resume_ckpt > 0:
@@ -124,12 +146,26 @@ def train(config, workdir):
             load_history(workdir, history, interpolate=config.training.interpolate)
             print("reloaded pre-saved history to continue training!")
 
+    if world_size > 1:
+        # start every rank from the same weights, then draw different noise per rank
+        distributed.broadcast_parameters(score_model.parameters())
+        distributed.broadcast_parameters(ema.shadow_params)
+        torch.manual_seed(config.seed + distributed.get_rank())
+        if history:
+            history = distributed.DistributedLossHistory(
+                history, config.training.batch_size // world_size
+            )
+
     # Build data iterators
     logging.info("Loading MNIST dataset to be encoded using the flow!")
-    train_ds, eval_ds = datasets.get_dataset_for_flow(
-        config,
-        uniform_dequantization=config.data.uniform_dequantization,
-    )
+    if config.data.preload:
+        # batches are already on device, dequantized and rescaled
+        train_ds, eval_ds = datasets.get_preloaded_dataset_for_flow(config)
+    else:
+        train_ds, eval_ds = datasets.get_dataset_for_flow(
+            config,
+            uniform_dequantization=config.data.uniform_dequantization,
+        )
     # Create data normalizer and its inverse
     train_iter = iter(train_ds)  # pytype: disable=wrong-arg-types
     eval_iter = iter(eval_ds)  # pytype: disable=wrong-arg-types
@@ -137,6 +173,9 @@ def train(config, workdir):
     scaler = datasets.get_data_scaler(config)
     inverse_scaler = datasets.get_data_inverse_scaler(config)
 
+    metrics = get_metrics_logger(config, workdir)
+    profiling.init_profiler(config, workdir, metrics)
+
     # load pre-trained normalizing flow checkpoint
     if config.training.z_space:
         logging.info("Loading pre-trained flow checkpoint...")
@@ -228,6 +267,8 @@ def train(config, workdir):
         device=config.device,
         use_zt=use_zt,
         epsilons=config.training.epsilons,
+        time_sampler=config.training.time_sampler,
+        num_times=config.training.num_times,
     )
     eval_step_fn = get_step_fn(
         sde,
@@ -255,9 +296,16 @@ def train(config, workdir):
         device=config.device,
         use_zt=use_zt,
         epsilons=config.training.epsilons,
+        time_sampler=config.training.time_sampler,
     )
     # TODO: also need to fix likelihood fn and dre_v2 fn for z-space joint training
-    likelihood_fn = likelihood.get_likelihood_fn_flow(sde, inverse_scaler)
+    likelihood_fn = likelihood.get_likelihood_fn_flow(
+        sde,
+        inverse_scaler,
+        num_probes=config.eval.likelihood_num_probes,
+        divergence=config.eval.likelihood_divergence,
+        integrator=config.eval.likelihood_integrator,
+    )
     if config.training.algo != "baseline":
         if not config.training.z_space:
             density_ratio_fn = density_ratios.get_density_ratio_fn(
@@ -271,6 +319,7 @@ def train(config, workdir):
                     mlp=mlp,
                     # rtol=config.eval.rtol,
                     # atol=config.eval.atol,
+                    method=config.eval.ratio_method,
                     # eps=train_eps,
                     use_zt=use_zt,
                     flow=flow,
@@ -299,7 +348,7 @@ def train(config, workdir):
             config.data.image_size,
         )
         sampling_fn = sampling.get_sampling_fn(
-            config, sde, sampling_shape, inverse_scaler, sampling_eps
+            config, sde, sampling_shape, flow, flow_name, inverse_scaler, sampling_eps
         )
 
     num_train_steps = config.training.n_iters
@@ -316,143 +365,155 @@ def train(config, workdir):
     all_checkpoint_steps = dict()
     all_times = []
     for step in range(initial_step, num_train_steps + 1):
-        try:
-            batch, _ = next(train_iter)  # ignore labels
-        except StopIteration:
-            train_iter = iter(train_ds)
-            batch, _ = next(train_iter)
-        batch = batch.to(config.device).float()
-
-        # add uniform noise, then rescale to [-1, +1]
-        # NOTE: should flip the order for adding gaussian noise
-        batch = batch * 255.0 / 256.0
-        batch += torch.rand_like(batch) / 256.0
-
-        # automatically assuming we'll be doing z_interpolate
-        # rescale to [-1, 1]
-        batch = scaler(batch)
+        profiling.step(step)
+        with profiling.phase("data"):
+            try:
+                batch, _ = next(train_iter)  # ignore labels
+            except StopIteration:
+                train_iter = iter(train_ds)
+                batch, _ = next(train_iter)
+            if not config.data.preload:
+                batch = batch.to(config.device).float()
+
+                # add uniform noise, then rescale to [-1, +1]
+                # NOTE: should flip the order for adding gaussian noise
+                batch = batch * 255.0 / 256.0
+                batch += torch.rand_like(batch) / 256.0
+
+                # automatically assuming we'll be doing z_interpolate
+                # rescale to [-1, 1]
+                batch = scaler(batch)
 
         # Execute one training step
         t1 = time.perf_counter()
         summary = train_step_fn(state, batch.detach())
         all_times.append(time.perf_counter() - t1)
 
-        summary["step"] = step
-        wandb.log(summary)
-        if step % config.training.log_freq == 0:
-            logging.info("step: %d, training_loss: %.5e" % (step, summary["loss"]))
+        with profiling.phase("logging"):
+            metrics.log(summary, step)
 
         # visualize weights if possible
-        if "weights" in summary:
+        if is_main and "weights" in summary and step % config.training.log_freq == 0:
+            import matplotlib.pyplot as plt
+
             weights = summary["weights"].detach().cpu().numpy()
             plt.hist(weights.reshape(-1), bins="auto")
             plt.savefig(os.path.join(workdir, "weights_is.png"))
             plt.close()
 
         # Save a temporary checkpoint to resume training after pre-emption periodically
-        if step != 0 and step % config.training.snapshot_freq_for_preemption == 0:
-            save_checkpoint(checkpoint_meta_dir, state)
+        if (
+            is_main
+            and step != 0
+            and step % config.training.snapshot_freq_for_preemption == 0
+        ):
+            with profiling.phase("checkpoint"):
+                checkpointer.save(checkpoint_meta_dir, state)
 
         # Report the loss on an evaluation dataset periodically
-        if step % config.training.eval_freq == 0:
-            try:
-                eval_batch, _ = next(eval_iter)
-            except StopIteration:
-                eval_iter = iter(eval_ds)
-                eval_batch, _ = next(eval_iter)
-            eval_batch = eval_batch.to(config.device).float()
-
-            # uniform dequantization then [-1, 1] rescaling
-            eval_batch = eval_batch * 255.0 / 256.0
-            eval_batch += torch.rand_like(eval_batch) / 256.0
-
-            # if invert_flow or z_interpolate:  # p(x) = flow
-            eval_batch = scaler(eval_batch)
-            log_det_logit = torch.zeros(len(eval_batch), device=config.device)
-            flow_log_det = torch.zeros_like(log_det_logit)
-
-            # NOTE: no additional dequantization on z embeddings!
-            # dre_eval_batch = copy.copy(eval_batch)
-            dre_eval_batch = eval_batch.detach().clone()
-            eval_loss = eval_step_fn(state, eval_batch)
-            # if not history:
-            summary = dict(test_loss=eval_loss["loss"], step=step)
-            # else:
-            #   summary = dict(
-            #     test_loss=eval_loss['loss'],
-            #     unweighted_test_loss=eval_loss['unweighted_loss'],
-            #     step=step
-            #   )
-            logging.info("step: %d, eval_loss: %.5e" % (step, eval_loss["loss"]))
-
-            # only compute density ratios when network is sufficiently smooth
-            if step > 100 and step % config.training.ratio_freq == 0:
-                if config.eval.enable_bpd:
-                    # use EMA for ratio computation
-                    ema.store(score_model.parameters())
-                    ema.copy_to(score_model.parameters())
-
-                    # different types of density ratios for energy-based modeling
-                    if config.training.pf_ode_bpd:
-                        bpd = likelihood_fn(
-                            score_model, dre_eval_batch, flow_log_det, log_det_logit
-                        )[0]
-                        if len(bpd) > 1:
-                            bpd = bpd.detach().cpu().numpy().reshape(-1)
-                            summary["test_bpds"] = bpd.mean()
-                        else:
-                            summary["test_bpds"] = bpd.item()
-                        logging.info("step: %d, eval_bpd: %.5f" % (step, bpd.mean()))
-                    if config.training.dre_bpd:
-                        # TODO TODO TODO
-                        # dre_bpd = \
-                        #     density_ratio_fn(score_model=score_model, flow=flow, x=dre_eval_batch)[0]
-                        # IS
-                        dre_bpd = density_ratio_fn(
-                            score_model=score_model, x=dre_eval_batch
-                        )[0]
-                        # dre_bpd = dre_bpd.reshape(-1)
-                        # summary['test_dre_bpds'] = dre_bpd.mean()
-                        summary["test_dre_bpds"] = (
-                            dre_bpd.item()
-                        )  # TODO: changed this to sum
-                        logging.info(
-                            "step: %d, eval_dre_bpd: %.5f" % (step, dre_bpd.mean())
-                        )
-
-                        all_dre_bpds[step] = dre_bpd.mean()
-
-                    if config.training.dre_bpd_v2:
-                        dre_bpd_v2 = density_ratio_fn_pathwise(
-                            score_model=score_model, flow=flow, x=dre_eval_batch
-                        )[0]
-                        dre_bpd_v2 = dre_bpd_v2.reshape(-1)
-                        summary["test_dre_bpds_v2"] = dre_bpd_v2.mean()
-                        logging.info(
-                            "step: %d, eval_dre_bpd_v2: %.5f"
-                            % (step, dre_bpd_v2.mean())
-                        )
-
-                    ema.restore(score_model.parameters())
-
-            wandb.log(summary)
+        if is_main and step % config.training.eval_freq == 0:
+            with profiling.phase("eval"):
+                try:
+                    eval_batch, _ = next(eval_iter)
+                except StopIteration:
+                    eval_iter = iter(eval_ds)
+                    eval_batch, _ = next(eval_iter)
+                if not config.data.preload:
+                    eval_batch = eval_batch.to(config.device).float()
+
+                    # uniform dequantization then [-1, 1] rescaling
+                    eval_batch = eval_batch * 255.0 / 256.0
+                    eval_batch += torch.rand_like(eval_batch) / 256.0
+
+                    # if invert_flow or z_interpolate:  # p(x) = flow
+                    eval_batch = scaler(eval_batch)
+                log_det_logit = torch.zeros(len(eval_batch), device=config.device)
+                flow_log_det = torch.zeros_like(log_det_logit)
+
+                # NOTE: no additional dequantization on z embeddings!
+                # dre_eval_batch = copy.copy(eval_batch)
+                dre_eval_batch = eval_batch.detach().clone()
+                eval_loss = eval_step_fn(state, eval_batch)
+                # if not history:
+                summary = dict(test_loss=eval_loss["loss"], step=step)
+                # else:
+                #   summary = dict(
+                #     test_loss=eval_loss['loss'],
+                #     unweighted_test_loss=eval_loss['unweighted_loss'],
+                #     step=step
+                #   )
+                logging.info("step: %d, eval_loss: %.5e" % (step, eval_loss["loss"]))
+
+                # only compute density ratios when network is sufficiently smooth
+                if step > 100 and step % config.training.ratio_freq == 0:
+                    if config.eval.enable_bpd:
+                        # use EMA for ratio computation
+                        # different types of density ratios for energy-based modeling
+                        if config.training.pf_ode_bpd:
+                            bpd = likelihood_fn(
+                                ema_model, dre_eval_batch, flow_log_det, log_det_logit
+                            )[0]
+                            if len(bpd) > 1:
+                                bpd = bpd.detach().cpu().numpy().reshape(-1)
+                                summary["test_bpds"] = bpd.mean()
+                            else:
+                                summary["test_bpds"] = bpd.item()
+                            logging.info(
+                                "step: %d, eval_bpd: %.5f" % (step, bpd.mean())
+                            )
+                        if config.training.dre_bpd:
+                            # TODO TODO TODO
+                            # dre_bpd = \
+                            #     density_ratio_fn(score_model=score_model, flow=flow, x=dre_eval_batch)[0]
+                            # IS
+                            dre_bpd = density_ratio_fn(
+                                score_model=ema_model, x=dre_eval_batch
+                            )[0]
+                            # dre_bpd = dre_bpd.reshape(-1)
+                            # summary['test_dre_bpds'] = dre_bpd.mean()
+                            summary["test_dre_bpds"] = (
+                                dre_bpd.item()
+                            )  # TODO: changed this to sum
+                            logging.info(
+                                "step: %d, eval_dre_bpd: %.5f" % (step, dre_bpd.mean())
+                            )
+
+                            all_dre_bpds[step] = dre_bpd.mean()
+
+                        if config.training.dre_bpd_v2:
+                            dre_bpd_v2 = density_ratio_fn_pathwise(
+                                score_model=ema_model, flow=flow, x=dre_eval_batch
+                            )[0]
+                            dre_bpd_v2 = dre_bpd_v2.reshape(-1)
+                            summary["test_dre_bpds_v2"] = dre_bpd_v2.mean()
+                            logging.info(
+                                "step: %d, eval_dre_bpd_v2: %.5f"
+                                % (step, dre_bpd_v2.mean())
+                            )
+
+                metrics.write(summary, step)
 
         # Save a checkpoint periodically and generate samples if needed
-        if (
+        if is_main and (
             step != 0
             and step % config.training.snapshot_freq == 0
             or step == num_train_steps
         ):
             # Save the checkpoint.
             save_step = step // config.training.snapshot_freq
-            save_checkpoint(
-                os.path.join(checkpoint_dir, f"checkpoint_{save_step}.pth"), state
-            )
+            with profiling.phase("checkpoint"):
+                checkpointer.save(
+                    os.path.join(checkpoint_dir, f"checkpoint_{save_step}.pth"),
+                    state,
+                    ema_artifact=True,
+                )
 
             all_checkpoint_steps[step] = save_step
 
             # save weights
             if history:
+                import matplotlib.pyplot as plt
+
                 if interpolate:
                     weights = history._weight_history[:, -1]
                 else:
@@ -479,12 +540,9 @@ def train(config, workdir):
 
             # Generate and save samples
             if config.training.snapshot_sampling:
-                ema.store(score_model.parameters())
-                ema.copy_to(score_model.parameters())
-                sample, n = sampling_fn(score_model)
+                sample, n = sampling_fn(ema_model)
                 # log generations to wandb
-                wandb.log({"samples": [wandb.Image(i) for i in sample[0:64]]})
-                ema.restore(score_model.parameters())
+                metrics.write_images("samples", sample[0:64], step)
                 this_sample_dir = os.path.join(sample_dir, "iter_{}".format(step))
                 os.makedirs(this_sample_dir, exist_ok=True)
                 nrow = int(np.sqrt(sample.shape[0]))
@@ -498,6 +556,12 @@ def train(config, workdir):
                 with open(os.path.join(this_sample_dir, "sample.png"), "wb") as fout:
                     save_image(image_grid, fout)
 
+    profiling.close(num_train_steps)
+    checkpointer.close()
+    metrics.close()
+    if not is_main:
+        return
+
     with open(os.path.join(metrics_dir, "all_dre_bpds.p"), "wb") as fp:
         pickle.dump(all_dre_bpds, fp)
     with open(os.path.join(metrics_dir, "all_checkpoint_steps.p"), "wb") as fp:
@@ -519,12 +583,19 @@ def evaluate(config, workdir, eval_folder="eval"):
     # Create directory to eval_folder
     eval_dir = os.path.join(workdir, eval_folder)
     os.makedirs(eval_dir, exist_ok=True)
+    # under torchrun the ranks split the AIS chains between them
+    distributed.init_distributed(config)
+    # phase totals of the whole evaluation, written at the end
+    profiling.init_profiler(config, eval_dir)
 
     # Build data pipeline
     # train_ds, eval_ds, _ = datasets.get_dataset(config,
     #                                             uniform_dequantization=config.data.uniform_dequantization,
     #                                             evaluation=True)
-    eval_ds = datasets.get_test_set_for_flow(config)
+    if config.data.preload:
+        eval_ds = datasets.get_preloaded_test_set_for_flow(config)
+    else:
+        eval_ds = datasets.get_test_set_for_flow(config)
 
     # load pre-trained normalizing flow checkpoint
     if config.training.z_space:
@@ -543,7 +614,9 @@ def evaluate(config, workdir, eval_folder="eval"):
     score_model = mutils.create_model(config)
     optimizer = losses.get_optimizer(config, score_model.parameters())
     ema = ExponentialMovingAverage(
-        score_model.parameters(), decay=config.model.ema_rate
+        score_model.parameters(),
+        decay=config.model.ema_rate,
+        update_every=config.model.ema_update_every,
     )
     state = dict(optimizer=optimizer, model=score_model, ema=ema, step=0)
 
@@ -615,7 +688,13 @@ def evaluate(config, workdir, eval_folder="eval"):
 
     # Build the likelihood computation function when likelihood is enabled
     if config.eval.enable_bpd:
-        likelihood_fn = likelihood.get_likelihood_fn_flow(sde, inverse_scaler)
+        likelihood_fn = likelihood.get_likelihood_fn_flow(
+            sde,
+            inverse_scaler,
+            num_probes=config.eval.likelihood_num_probes,
+            divergence=config.eval.likelihood_divergence,
+            integrator=config.eval.likelihood_integrator,
+        )
         if config.training.algo != "baseline":
             if config.training.sde.lower() in ["interpxt", "flow_interpxt"]:
                 if not config.training.z_space:
@@ -636,6 +715,7 @@ def evaluate(config, workdir, eval_folder="eval"):
                         inverse_scaler,
                         # rtol=config.eval.rtol,
                         # atol=config.eval.atol,
+                        method=config.eval.ratio_method,
                         # eps=train_eps,
                         use_zt=use_zt,
                         flow=flow,
@@ -643,6 +723,7 @@ def evaluate(config, workdir, eval_folder="eval"):
                         prob_path=prob_path,
                         conditional=conditional,
                         epsilons=config.training.epsilons,
+                        cache=ratio_cache.get_ratio_cache(config, tag=workdir),
                     )
                 else:
                     # TODO: complete AIS density ratio evaluation
@@ -652,6 +733,7 @@ def evaluate(config, workdir, eval_folder="eval"):
                         inverse_scaler,
                         # rtol=config.eval.rtol,
                         # atol=config.eval.atol,
+                        method=config.eval.ratio_method,
                         # eps=train_eps,
                         use_zt=use_zt,
                         flow=flow,
@@ -659,6 +741,7 @@ def evaluate(config, workdir, eval_folder="eval"):
                         prob_path=prob_path,
                         conditional=conditional,
                         epsilons=config.training.epsilons,
+                        cache=ratio_cache.get_ratio_cache(config, tag=workdir),
                     )
         if config.training.dre_bpd_v2:
             density_ratio_fn_v2 = density_ratios.get_z_interp_pathwise_density_ratio_fn(
@@ -696,7 +779,8 @@ def evaluate(config, workdir, eval_folder="eval"):
         # Wait for 2 additional mins in case the file exists but is not ready for reading
         ckpt_path = os.path.join(checkpoint_dir, f"checkpoint_{ckpt}.pth")
         # try:
-        state = restore_checkpoint(ckpt_path, state, device=config.device, test=True)
+        # evaluation only needs the EMA weights
+        state = restore_ema_checkpoint(ckpt_path, state, device=config.device)
         # except:
         # time.sleep(60)
         # try:
@@ -738,12 +822,13 @@ def evaluate(config, workdir, eval_folder="eval"):
         if config.eval.enable_loss:
             all_losses = []
             for i, (eval_batch, _) in enumerate(eval_ds):
-                eval_batch = (
-                    (eval_batch * 255.0) + torch.rand_like(eval_batch)
-                ) / 256.0
+                if not config.data.preload:
+                    eval_batch = (
+                        (eval_batch * 255.0) + torch.rand_like(eval_batch)
+                    ) / 256.0
 
-                eval_batch = scaler(eval_batch)
-                eval_batch = eval_batch.to(config.device)
+                    eval_batch = scaler(eval_batch)
+                    eval_batch = eval_batch.to(config.device)
                 eval_loss = eval_step(state, eval_batch)
                 all_losses.append(eval_loss["loss"])
                 if (i + 1) % 1000 == 0:
@@ -776,6 +861,7 @@ def evaluate(config, workdir, eval_folder="eval"):
                     # elif config.eval.mcmc_algo == "hmc":
                     #     from ais.hmc_ais import ais_fn
                     from ais.diffusion_hmc_ais import ais_fn
+                    from ais.shards import merge_shards
 
                     # Let's try these settings
                     # ais_batch_size = config.eval.batch_size
@@ -790,36 +876,121 @@ def evaluate(config, workdir, eval_folder="eval"):
                     ais_method = config.eval.ais_method
                     num_hmc_steps = config.eval.n_hmc_steps
                     initial_step_size = config.eval.initial_step_size
-                    ais_x, ais_z, init_z, logws, log_normalizer, acceptance_rate = (
-                        ais_fn(
-                            flow=flow,
-                            flow_name=flow_name,
-                            score_model=score_model,
-                            use_zt=use_zt,
-                            conditional=conditional,
-                            batch_size=ais_batch_size,
-                            dataloader=ais_dataloader,
-                            num_ais_samples=n_ais_samples,
-                            num_ais_steps=n_ais_steps,
-                            num_steps_per_ais_step=n_steps_per_ais_step,
-                            num_continue=n_continue,
-                            ais_method=ais_method,
-                            num_hmc_steps=num_hmc_steps,
-                            scaler=scaler,
-                            inverse_scaler=inverse_scaler,
-                            initial_step_size=initial_step_size,
-                            device=config.device,
-                            sde=sde,
-                            epsilons=epsilons,
-                            prob_path=prob_path,
-                            rtol=config.eval.ais_rtol,
-                            atol=config.eval.ais_atol,
-                        )
+                    # chains can be spread over torchrun ranks or separate jobs
+                    num_shards = config.eval.ais_num_shards
+                    if num_shards <= 0:
+                        num_shards = distributed.get_world_size()
+                    shard_id = config.eval.ais_shard_id
+                    if shard_id < 0:
+                        shard_id = distributed.get_rank()
+                    shard_dir = os.path.join(
+                        eval_dir, f"ais_shards_{ais_method}_ckpt_{ckpt}"
                     )
+                    (
+                        ais_x,
+                        ais_z,
+                        init_z,
+                        logws,
+                        log_normalizer,
+                        acceptance_rate,
+                        ais_stats,
+                    ) = ais_fn(
+                        flow=flow,
+                        flow_name=flow_name,
+                        score_model=score_model,
+                        use_zt=use_zt,
+                        conditional=conditional,
+                        batch_size=ais_batch_size,
+                        dataloader=ais_dataloader,
+                        num_ais_samples=n_ais_samples,
+                        num_ais_steps=n_ais_steps,
+                        num_steps_per_ais_step=n_steps_per_ais_step,
+                        num_continue=n_continue,
+                        ais_method=ais_method,
+                        num_hmc_steps=num_hmc_steps,
+                        scaler=scaler,
+                        inverse_scaler=inverse_scaler,
+                        initial_step_size=initial_step_size,
+                        device=config.device,
+                        sde=sde,
+                        epsilons=epsilons,
+                        prob_path=prob_path,
+                        rtol=config.eval.ais_rtol,
+                        atol=config.eval.ais_atol,
+                        shard_id=shard_id,
+                        num_shards=num_shards,
+                        shard_dir=shard_dir,
+                        seed=config.seed,
+                        adapt_steps=config.eval.hmc_adapt_steps,
+                        target_accept=config.eval.hmc_target_accept,
+                        adapt_mass=config.eval.hmc_adapt_mass,
+                        schedule_mode=config.eval.ais_schedule,
+                        target_cess=config.eval.ais_target_cess,
+                        max_adaptive_steps=config.eval.ais_max_adaptive_steps,
+                        # shared by all shards of this checkpoint
+                        schedule_path=os.path.join(
+                            eval_dir, f"ais_schedule_{ais_method}_ckpt_{ckpt}.npz"
+                        ),
+                        schedule_timeout=(
+                            config.eval.ais_schedule_timeout
+                            if config.eval.ais_schedule_timeout > 0
+                            else None
+                        ),
+                        snapshot_interval=config.eval.ais_snapshot_interval,
+                        resume=config.eval.ais_resume,
+                        bdmc_gap_tol=config.eval.bdmc_gap_tol,
+                    )
+                    if num_shards > 1:
+                        # every shard stops here, the estimate uses the shards
+                        # that are finished so far
+                        distributed.barrier()
+                        merged = merge_shards(
+                            shard_dir, forward=ais_method != "raise"
+                        )
+                        if merged["missing_shards"]:
+                            logging.warning(
+                                "AIS shards %s are missing" % merged["missing_shards"]
+                            )
+                        ais_x, ais_z = merged["x"], merged["z"]
+                        init_z = merged["init_z"]
+                        logws = merged["logws"]
+                        log_normalizer = torch.tensor(merged["log_normalizer"])
+                        acceptance_rate = merged["acceptance_rate"]
+                        ais_stats = {
+                            k: merged[k]
+                            for k in ["log_normalizer_se", "ess", "n_chains"]
+                        }
+                        ais_stats["acceptance_trace"] = merged[
+                            "acceptance_trace"
+                        ].numpy()
+                        ais_stats["step_size"] = merged["step_size"].numpy()
+                        ais_stats["schedule"] = merged["schedule"].numpy()
+                        if "sandwich_gap" in merged:
+                            for k in [
+                                "log_normalizer_lower",
+                                "log_normalizer_lower_se",
+                                "log_normalizer_upper",
+                                "log_normalizer_upper_se",
+                                "sandwich_gap",
+                            ]:
+                                ais_stats[k] = merged[k]
+                            ais_stats["reverse_logws"] = merged["reverse_logws"].numpy()
                     ais_x = ais_x.view(-1, 1, 28, 28)
                     ais_z = ais_z.view(-1, 1, 28, 28)
                     log_normalizer = log_normalizer.detach().cpu().numpy()
-                    print(f"estimated log normalizer: {log_normalizer}")
+                    print(
+                        "estimated log normalizer: {} +- {}".format(
+                            log_normalizer, ais_stats["log_normalizer_se"]
+                        )
+                    )
+                    if "sandwich_gap" in ais_stats:
+                        print(
+                            "BDMC bounds on log normalizer: [{}, {}], gap {}".format(
+                                ais_stats["log_normalizer_lower"],
+                                ais_stats["log_normalizer_upper"],
+                                ais_stats["sandwich_gap"],
+                            )
+                        )
                     ais_dict = {
                         "x": ais_x.detach().cpu().numpy(),
                         "z": ais_z.detach().cpu().numpy(),
@@ -827,22 +998,28 @@ def evaluate(config, workdir, eval_folder="eval"):
                         "logws": logws.detach().cpu().numpy(),
                         "log_normalizer": log_normalizer,
                         "acceptance_rate": acceptance_rate,
+                        **ais_stats,
                     }
-                    save_image(
-                        ais_x.detach().cpu()[:64, :, :, :],
-                        os.path.join(
-                            eval_dir,
-                            "ais_samples_{}chains_{}steps.png".format(
-                                n_ais_samples, n_ais_steps
+                    # with several shards every rank holds the merged results.
+                    # Shards run as separate jobs all get here, and those that
+                    # finish before the others write a partial merge, which
+                    # must not replace the output of the complete one
+                    output_name = "ais_x_{}_ckpt_{}_output.npz".format(ais_method, ckpt)
+                    if num_shards > 1 and merged["missing_shards"]:
+                        output_name = "ais_x_{}_ckpt_{}_partial_output.npz".format(
+                            ais_method, ckpt
+                        )
+                    if distributed.is_main_process():
+                        save_image(
+                            ais_x.detach().cpu()[:64, :, :, :],
+                            os.path.join(
+                                eval_dir,
+                                "ais_samples_{}chains_{}steps.png".format(
+                                    n_ais_samples, n_ais_steps
+                                ),
                             ),
-                        ),
-                    )
-                    np.savez(
-                        os.path.join(
-                            eval_dir, "ais_x_{}_ckpt_{}_output".format(ais_method, ckpt)
-                        ),
-                        **ais_dict,
-                    )
+                        )
+                        atomic_savez(os.path.join(eval_dir, output_name), **ais_dict)
                     print(
                         "finished running {} for estimating log partition function!".format(
                             ais_method
@@ -858,13 +1035,14 @@ def evaluate(config, workdir, eval_folder="eval"):
                     nfes = []
 
                 for batch_id, (eval_batch, _) in enumerate(eval_ds):
-                    eval_batch = (
-                        (eval_batch * 255.0) + torch.rand_like(eval_batch)
-                    ) / 256.0
-
-                    # you can do this because eval_batch is from the test set, and already has been uniformly dequantized
-                    eval_batch = scaler(eval_batch)
-                    eval_batch = eval_batch.to(config.device)
+                    if not config.data.preload:
+                        eval_batch = (
+                            (eval_batch * 255.0) + torch.rand_like(eval_batch)
+                        ) / 256.0
+
+                        # you can do this because eval_batch is from the test set, and already has been uniformly dequantized
+                        eval_batch = scaler(eval_batch)
+                        eval_batch = eval_batch.to(config.device)
                     if not config.eval.ais:
                         # add nfe records
                         bpd, _, nfe = density_ratio_fn(
@@ -910,3 +1088,5 @@ def evaluate(config, workdir, eval_folder="eval"):
 
             with open(os.path.join(eval_dir, "all_bpds.p"), "wb") as f:
                 pickle.dump(all_bpds, f)
+
+    profiling.close()
@@ -17,6 +17,7 @@
 # pytype: skip-file
 """Various sampling methods."""
 import functools
+import math
 
 import torch
 import numpy as np
@@ -123,6 +124,21 @@ def get_sampling_fn(config, sde, shape, flow, flow_name, inverse_scaler, eps):
             eps=eps,
             device=config.device,
         )
+    # Few-step exponential integrator for the probability flow ODE of VP SDEs
+    elif sampler_name.lower() == "dpm_solver":
+        sampling_fn = get_dpm_solver_sampler(
+            sde=sde,
+            shape=shape,
+            flow=flow,
+            flow_name=flow_name,
+            inverse_scaler=inverse_scaler,
+            steps=config.sampling.dpm_solver_steps,
+            order=config.sampling.dpm_solver_order,
+            schedule=config.sampling.dpm_solver_schedule,
+            denoise=config.sampling.noise_removal,
+            eps=eps,
+            device=config.device,
+        )
     else:
         raise ValueError(f"Sampler name {sampler_name} unknown.")
 
@@ -543,29 +559,178 @@ def get_ode_sampler(
             if denoise:
                 x = denoise_update_fn(model, x)
 
-            with torch.no_grad():
-                if "none" not in flow_name:
-                    batch_size = shape[0]
-                    if flow_name in ["mintnet", "nice", "realnvp"]:
-                        # map z -> x via flow, then rescale to [-1, 1]
-                        x = flow.module.sampling(x, rescale=True)
-                    else:
-                        if "noise" in flow_name or "copula" in flow_name:
-                            x = flow.module.sample(
-                                x.view(batch_size, -1),
-                                context=None,
-                                rescale=True,
-                                transform=True,
-                                train=False,
-                            )
-                        else:
-                            x = flow.module.sample(
-                                x.view(batch_size, -1), context=None, rescale=True
-                            )
+            x = decode_from_flow(x, flow, flow_name)
+            x = inverse_scaler(x)
+            return x, nfe
+
+    return ode_sampler
+
+
+def decode_from_flow(x, flow, flow_name):
+    """Maps samples in the latent space of the flow back to images in [-1, 1]."""
+    with torch.no_grad():
+        if "none" not in flow_name:
+            batch_size = x.shape[0]
+            if flow_name in ["mintnet", "nice", "realnvp"]:
+                # map z -> x via flow, then rescale to [-1, 1]
+                x = flow.module.sampling(x, rescale=True)
+            else:
+                if "noise" in flow_name or "copula" in flow_name:
+                    x = flow.module.sample(
+                        x.view(batch_size, -1),
+                        context=None,
+                        rescale=True,
+                        transform=True,
+                        train=False,
+                    )
                 else:
-                    x = x.view((-1, 1, 28, 28))
+                    x = flow.module.sample(
+                        x.view(batch_size, -1), context=None, rescale=True
+                    )
+        else:
+            x = x.view((-1, 1, 28, 28))
+    return x
+
+
+def get_dpm_solver_sampler(
+    sde,
+    shape,
+    flow,
+    flow_name,
+    inverse_scaler,
+    steps=20,
+    order=3,
+    schedule="logSNR",
+    denoise=False,
+    eps=1e-3,
+    device="cuda",
+):
+    """Few-step probability flow ODE sampler for VP SDEs with DPM-Solver.
+
+    The ODE is solved exactly in its linear part and the noise prediction
+    eps_theta = -sigma_t * score is expanded in the log-SNR lambda_t, see
+    https://arxiv.org/abs/2206.00927. Order 1 is DDIM, orders 2 and 3 are the
+    singlestep DPM-Solver-2 and DPM-Solver-3 and cost `order` function
+    evaluations per step. The samples never leave `device`.
+
+    Args:
+      sde: A VP `sde_lib.SDE` object (VPSDE, Z_VPSDE, Z_RQNSF_VPSDE or Z_RQNSF_TFORM_VPSDE).
+      shape: A sequence of integers. The expected shape of a single sample.
+      inverse_scaler: The inverse data normalizer.
+      steps: An integer. The number of solver steps from `sde.T` to `eps`.
+      order: 1, 2 or 3. The order of the solver.
+      schedule: "logSNR" (uniform in lambda_t), "time_uniform" or "time_quadratic".
+      denoise: If `True`, return the data prediction at `eps` instead of the sample.
+      eps: A `float` number. The probability flow ODE is integrated to `eps` for numerical stability.
+      device: PyTorch device.
+
+    Returns:
+      A sampling function that returns samples and the number of function evaluations during sampling.
+    """
+    if not isinstance(
+        sde,
+        (
+            sde_lib.VPSDE,
+            sde_lib.Z_VPSDE,
+            sde_lib.Z_RQNSF_VPSDE,
+            sde_lib.Z_RQNSF_TFORM_VPSDE,
+        ),
+    ):
+        raise NotImplementedError(
+            f"DPM-Solver for {sde.__class__.__name__} not supported yet!"
+        )
+    if order not in [1, 2, 3]:
+        raise NotImplementedError(f"DPM-Solver of order {order} not supported yet!")
+
+    beta_0, beta_1 = sde.beta_0, sde.beta_1
+
+    def log_alpha(t):
+        return -0.25 * t**2 * (beta_1 - beta_0) - 0.5 * t * beta_0
+
+    def sigma(t):
+        return math.sqrt(-math.expm1(2.0 * log_alpha(t)))
+
+    def log_snr(t):
+        # lambda_t = log(alpha_t / sigma_t)
+        return log_alpha(t) - 0.5 * math.log(-math.expm1(2.0 * log_alpha(t)))
+
+    def inverse_log_snr(lam):
+        log_alpha_t = -0.5 * np.logaddexp(0.0, -2.0 * lam)
+        # positive root of log_alpha(t) = log_alpha_t, written to avoid cancellation
+        a, b = 0.25 * (beta_1 - beta_0), 0.5 * beta_0
+        return -2.0 * log_alpha_t / (b + math.sqrt(b**2 - 4.0 * a * log_alpha_t))
+
+    if schedule == "logSNR":
+        lambdas = np.linspace(log_snr(sde.T), log_snr(eps), steps + 1)
+        timesteps = [inverse_log_snr(lam) for lam in lambdas]
+    elif schedule == "time_uniform":
+        timesteps = np.linspace(sde.T, eps, steps + 1).tolist()
+    elif schedule == "time_quadratic":
+        timesteps = (np.linspace(np.sqrt(sde.T), np.sqrt(eps), steps + 1) ** 2).tolist()
+    else:
+        raise NotImplementedError(f"Timestep schedule {schedule} unknown.")
+
+    def dpm_solver_step(noise_fn, x, s, t):
+        """One step from time s to time t < s."""
+        h = log_snr(t) - log_snr(s)
+        noise_s = noise_fn(x, s)
+        x_t = math.exp(log_alpha(t) - log_alpha(s)) * x
+        x_t = x_t - sigma(t) * math.expm1(h) * noise_s
+        if order == 1:
+            return x_t
+
+        r1 = 0.5 if order == 2 else 1.0 / 3.0
+        s1 = inverse_log_snr(log_snr(s) + r1 * h)
+        u1 = math.exp(log_alpha(s1) - log_alpha(s)) * x
+        u1 = u1 - sigma(s1) * math.expm1(r1 * h) * noise_s
+        d1 = noise_fn(u1, s1) - noise_s
+        if order == 2:
+            return x_t - sigma(t) / (2.0 * r1) * math.expm1(h) * d1
+
+        r2 = 2.0 / 3.0
+        s2 = inverse_log_snr(log_snr(s) + r2 * h)
+        u2 = math.exp(log_alpha(s2) - log_alpha(s)) * x
+        u2 = u2 - sigma(s2) * math.expm1(r2 * h) * noise_s
+        u2 = u2 - sigma(s2) * r2 / r1 * (math.expm1(r2 * h) / (r2 * h) - 1.0) * d1
+        d2 = noise_fn(u2, s2) - noise_s
+        return x_t - sigma(t) / r2 * (math.expm1(h) / h - 1.0) * d2
+
+    def dpm_solver_sampler(model, z=None):
+        """The DPM-Solver sampler function.
+
+        Args:
+          model: A score model.
+          z: If present, generate samples from latent code `z`.
+        Returns:
+          samples, number of function evaluations.
+        """
+        score_fn = get_score_fn(sde, model, train=False, continuous=True)
+
+        def noise_fn(x, t):
+            vec_t = torch.ones(shape[0], device=device) * t
+            score = score_fn(x, vec_t)
+            if isinstance(score, list) or isinstance(score, tuple):
+                score = score[0]
+            return -sigma(t) * score
 
+        with torch.no_grad():
+            # Initial sample
+            if z is None:
+                x = sde.prior_sampling(shape).to(device)
+            else:
+                x = z
+
+            for s, t in zip(timesteps[:-1], timesteps[1:]):
+                x = dpm_solver_step(noise_fn, x, s, t)
+            nfe = steps * order
+
+            if denoise:
+                # data prediction x_0 = (x_t - sigma_t eps_theta) / alpha_t
+                x = (x - sigma(eps) * noise_fn(x, eps)) / math.exp(log_alpha(eps))
+                nfe += 1
+
+            x = decode_from_flow(x, flow, flow_name)
             x = inverse_scaler(x)
             return x, nfe
 
-    return ode_sampler
+    return dpm_solver_sampler
@@ -4,7 +4,6 @@ import abc
 import torch
 import numpy as np
 import torch.nn.functional as F
-from scipy.integrate import quad
 
 
 def logit_transform(image, lambd=1e-6):
@@ -0,0 +1,82 @@
+"""Samplers for the training times of the TSM/CTSM losses.
+
+The losses are Monte Carlo estimates of an integral over t, uniform on
+[eps1, eps1 + eps_factor]. Every sampler returns times t of shape
+(batch_size,) together with per-sample weights, the ratio of the uniform
+density to the density t was drawn from, so that E[weights * loss(t)] is the
+same objective for all samplers:
+
+- "uniform": i.i.d. uniform times, the default.
+- "stratified": one uniform draw in each of the batch_size quantiles.
+- "antithetic": half of the batch is drawn uniformly and mirrored, t -> 1 - t
+  in units of the interval.
+- "sobol": consecutive points of a scrambled Sobol sequence that persists
+  across steps.
+- "importance": t drawn from the `resample_t` proposal of `losses`, which puts
+  more mass on large t, with weights 1 / density. Unlike `resample_t`, this
+  leaves the objective unchanged.
+
+The first four have uniform marginals, so their weights are all one; they
+only lower the variance of the estimate through negatively correlated times.
+"""
+
+import torch
+
+TIME_SAMPLERS = ["uniform", "stratified", "antithetic", "sobol", "importance"]
+
+
+def get_time_sampler(name, eps1, eps_factor, device, temp=0.9):
+    """Returns `sample_fn(batch_size) -> (t, weights)`.
+
+    Args:
+      name: one of `TIME_SAMPLERS`.
+      eps1, eps_factor: t is sampled from [eps1, eps1 + eps_factor].
+      temp: for "importance", the largest time of the proposal before it is
+        rescaled to the interval, as in the `resample_t` transform.
+    """
+    if name == "uniform":
+
+        def sample_unit(n):
+            return torch.rand(n, device=device), None
+
+    elif name == "stratified":
+
+        def sample_unit(n):
+            u = torch.arange(n, device=device) + torch.rand(n, device=device)
+            return u / n, None
+
+    elif name == "antithetic":
+
+        def sample_unit(n):
+            u = torch.rand((n + 1) // 2, device=device)
+            return torch.cat([u, 1.0 - u])[:n], None
+
+    elif name == "sobol":
+        engine = torch.quasirandom.SobolEngine(
+            dimension=1, scramble=True, seed=int(torch.randint(2**31 - 1, ()))
+        )
+
+        def sample_unit(n):
+            return engine.draw(n).view(n).to(device), None
+
+    elif name == "importance":
+        z = temp / (1 - temp**2)
+
+        def sample_unit(n):
+            # inverse cdf of s / (z (1 - s^2)) on [0, temp]
+            y = torch.rand(n, device=device)
+            s = 2 * y * z / (1 + torch.sqrt(1 + 4 * y**2 * z**2))
+            # uniform density over proposal density, in units of the interval
+            weights = z * (1 - s**2) ** 2 / (temp * (1 + s**2))
+            return s / temp, weights
+
+    else:
+        raise NotImplementedError(f"Time sampler {name} not supported yet!")
+
+    def sample_fn(batch_size):
+        u, weights = sample_unit(batch_size)
+        if weights is None:
+            weights = torch.ones_like(u)
+        return u * eps_factor + eps1, weights
+
+    return sample_fn
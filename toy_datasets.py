@@ -13,8 +13,23 @@ from torch.distributions import (
 from torch.distributions.transforms import ReshapeTransform
 import os
 
-if not os.path.exists("val_sets"):
-    os.mkdir("val_sets")
+
+def val_set_name(config):
+    """Name of the validation set of the dataset of `config`, e.g. GMMs_2_4."""
+    if config.data.dataset == "GMMs":
+        return f"{config.data.dataset}_{config.data.dim}_{config.data.k}"
+    return f"{config.data.dataset}_{config.data.dim}"
+
+
+def val_set_path(config):
+    """Path of the cached validation set, relative to the working directory."""
+    return os.path.join("val_sets", val_set_name(config) + ".pt")
+
+
+def _make_val_set_path(config):
+    """`val_set_path`, creating val_sets/ on first use."""
+    os.makedirs("val_sets", exist_ok=True)
+    return val_set_path(config)
 
 
 class PeakedGaussians(object):
@@ -127,14 +142,12 @@ class ToyGMM(object):
         samples: batch
         """
         mu, sigma = self.sde.marginal_prob(batch, t)
-        log_qs = []
-        for i in range(len(mu)):
-            log_q = (
-                -((x[i] - mu[i]) ** 2) / (2 * sigma[i] ** 2)
-                - 0.5 * torch.log(2 * math.pi * sigma[i] ** 2)
-            ) + math.log(1.0 / len(mu))
-            log_qs.append(log_q)
-        log_q = torch.logsumexp(torch.stack(log_qs, dim=0), dim=0)
+        # one component per element of the batch, all evaluated at once
+        var = sigma.reshape(-1, *([1] * (x.dim() - 1))) ** 2
+        log_qs = (
+            -((x - mu) ** 2) / (2 * var) - 0.5 * torch.log(2 * math.pi * var)
+        ) + math.log(1.0 / len(mu))
+        log_q = torch.logsumexp(log_qs, dim=0)
         return log_q
 
 
@@ -491,7 +504,7 @@ def get_dataset(config, sde=None):
             mean_sqnorm=dim * number**2,
             unit_factor=config.training.unit_factor,
         )
-        val_path = f"val_sets/{config.data.dataset}_{config.data.dim}.pt"
+        val_path = _make_val_set_path(config)
         # HACK: get val set
         if config.training.n_iters == -1:
             torch.manual_seed(1)
@@ -571,9 +584,7 @@ def get_dataset(config, sde=None):
             two_sb_var=config.training.two_sb_var,
             use_two_sb=config.training.use_two_sb,
         )
-        val_path = (
-            f"val_sets/{config.data.dataset}_{config.data.dim}_{config.data.k}.pt"
-        )
+        val_path = _make_val_set_path(config)
         # HACK
         if config.training.n_iters == -1:
             torch.manual_seed(1)
@@ -588,7 +599,7 @@ def get_dataset(config, sde=None):
     elif config.data.dataset == "GaussiansforMI":
         current_dataset = GaussiansforMI(config.data.dim, config.device)
 
-        val_path = f"val_sets/{config.data.dataset}_{config.data.dim}.pt"
+        val_path = _make_val_set_path(config)
         if not os.path.exists(val_path):
             torch.manual_seed(1)
             samples = current_dataset.sample_data(10000).to(device)
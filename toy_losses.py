@@ -3,6 +3,9 @@ import torch.autograd as autograd
 import torch.optim as optim
 import numpy as np
 
+import profiling
+import time_samplers
+
 
 def get_optimizer(config, params):
     """Returns a flax optimizer object based on `config`."""
@@ -114,7 +117,11 @@ def get_toy_timewise_score_estimation(
     device,
     batch_size,
     interpolate_fn,
+    time_sampler="uniform",
 ):
+    sample_times = time_samplers.get_time_sampler(
+        time_sampler, eps1, eps_factor, device
+    )
     t0 = torch.zeros((batch_size, 1), device=device) + eps1
     t1 = torch.ones((batch_size, 1), device=device) - eps2
 
@@ -135,7 +142,8 @@ def get_toy_timewise_score_estimation(
 
         we are reweighting the output of the score network (most recent version)
         """
-        t = torch.rand(batch_size, 1, device=device) * eps_factor + eps1
+        t, t_weights = sample_times(batch_size)
+        t, t_weights = t[:, None], t_weights[:, None]
 
         # Note: using squeeze()s were unnecessary, and are removed
         px, qx, xt = interpolate_fn(*samples, t)
@@ -143,6 +151,8 @@ def get_toy_timewise_score_estimation(
         # reweighted version
 
         lambda_t, lambda_t0, lambda_t1, lambda_dt = time_weighting_quantities(t=t)
+        # only the integrand over t depends on the sampled times
+        lambda_t, lambda_dt = lambda_t * t_weights, lambda_dt * t_weights
 
         term1 = 2 * scorenet(px, t0) * lambda_t0
         term2 = 2 * scorenet(qx, t1) * lambda_t1
@@ -175,8 +185,12 @@ def get_cat_toy_timewise_score_estimation(
     device,
     batch_size,
     interpolate_fn,
+    time_sampler="uniform",
 ):
     print("Using torch.cat")
+    sample_times = time_samplers.get_time_sampler(
+        time_sampler, eps1, eps_factor, device
+    )
     t0 = torch.zeros((batch_size, 1), device=device) + eps1
     t1 = torch.ones((batch_size, 1), device=device) - eps2
 
@@ -197,13 +211,16 @@ def get_cat_toy_timewise_score_estimation(
 
         we are reweighting the output of the score network (most recent version)
         """
-        t = torch.rand(batch_size, 1, device=device) * eps_factor + eps1
+        t, t_weights = sample_times(batch_size)
+        t, t_weights = t[:, None], t_weights[:, None]
         # Note: using squeeze()s were unnecessary, and are removed
         px, qx, xt = interpolate_fn(*samples, t)
 
         # reweighted version
 
         lambda_t, lambda_t0, lambda_t1, lambda_dt = time_weighting_quantities(t=t)
+        # only the integrand over t depends on the sampled times
+        lambda_t, lambda_dt = lambda_t * t_weights, lambda_dt * t_weights
 
         t.requires_grad_(True)
         xs = torch.cat([px, qx, xt], dim=0)
@@ -244,10 +261,15 @@ def get_toy_c_timewise_score_estimation(
     batch_size,
     device,
     full=False,
+    time_sampler="uniform",
 ):
     if likelihood_weighting != "obj_var":
         raise NotImplementedError
 
+    sample_times = time_samplers.get_time_sampler(
+        time_sampler, eps1, eps_factor, device
+    )
+
     if full:
 
         def loss_fn(scorenet, epsilon, xs, t, mean, std):
@@ -269,13 +291,15 @@ def get_toy_c_timewise_score_estimation(
 
     def toy_c_timewise_score_estimation(scorenet, samples):
 
-        t = torch.rand(batch_size, 1, device=device) * eps_factor + eps1
+        t, t_weights = sample_times(batch_size)
+        t, t_weights = t[:, None], t_weights[:, None]
 
         mean, std, var = prob_path.marginal_prob(*samples, t)
         epsilon = torch.randn((batch_size, prob_path.dim), device=device)
 
         # Note: lambda_t here has a different interpretation from Choi et al.
         loss = loss_fn(scorenet, epsilon, samples, t, mean, std)
+        loss = loss * t_weights.view(loss.shape)
 
         return loss.mean()
 
@@ -299,6 +323,7 @@ def get_step_fn(
     batch_size=None,
     full=False,
     interpolate_fn=None,
+    time_sampler="uniform",
 ):
     """Create a one-step training/evaluation function.
 
@@ -326,6 +351,7 @@ def get_step_fn(
                 device=device,
                 batch_size=batch_size,
                 interpolate_fn=interpolate_fn,
+                time_sampler=time_sampler,
             )
         else:
             loss_fn = get_toy_c_timewise_score_estimation(
@@ -338,6 +364,7 @@ def get_step_fn(
                 batch_size=batch_size,
                 device=device,
                 full=full,
+                time_sampler=time_sampler,
             )
     else:
         # should not use these (yet)
@@ -376,9 +403,12 @@ def get_step_fn(
             #     loss = loss_fn(model, batch, t)
             # else:
             #     loss = loss_fn(model, batch, t)
-            loss = loss_fn(model, batch)
-            loss.backward()
-            optimize_fn(optimizer, model.parameters(), step=state["step"])
+            with profiling.phase("score_forward"):
+                loss = loss_fn(model, batch)
+            with profiling.phase("backward"):
+                loss.backward()
+            with profiling.phase("optimizer"):
+                optimize_fn(optimizer, model.parameters(), step=state["step"])
             state["step"] += 1
         else:
             model.eval()
@@ -394,10 +424,12 @@ def get_step_fn(
                 #     loss = loss_fn(model, batch, t)
                 # else:
                 #     loss = loss_fn(model, batch, t)
-                loss = loss_fn(model, batch)
+                with profiling.phase("score_forward"):
+                    loss = loss_fn(model, batch)
         # return loss in a single dictionary
+        # keep the loss on device, the metrics logger aggregates it without syncing
         loss_dict = {
-            "loss": loss.item(),
+            "loss": loss.detach(),
             # 'loss1': loss1.item(),
             # 'loss2': loss2.item(),
             # 'loss3': loss3.item(),
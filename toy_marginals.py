@@ -0,0 +1,214 @@
+"""Closed-form time marginals of the toy probability paths.
+
+For the Gaussian and GMM toy datasets every path we train on is linear in the
+endpoints, x_t = a(t) x0 + b(t) x1 + c(t) eps with x0 ~ p, x1 ~ q and
+eps ~ N(0, I), so p_t is again a mixture of diagonal Gaussians with one
+component per pair of components of p and q. This gives exact log p_t(x) and
+d/dt log p_t(x) at any t, evaluated for a whole batch with a single
+logsumexp over components.
+
+`OracleTimeScoreModel` wraps the time score as a toy score model, so it can be
+passed to `density_ratios.get_toy_density_ratio_fn` in place of a trained
+network: a zero-training baseline for the ratio integrators.
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+from torch.distributions import Independent, MixtureSameFamily, Normal
+
+
+class DiagonalGaussianMixture(object):
+    """Mixture of Gaussians with diagonal covariances.
+
+    weights: (K,) mixture weights, means and stds: (K, dim).
+    """
+
+    def __init__(self, weights, means, stds):
+        self.log_weights = torch.log(weights)
+        self.means = means
+        self.vars = stds**2
+
+    @classmethod
+    def from_distribution(cls, dist):
+        """Converts an `Independent(Normal)` or a `MixtureSameFamily` of those."""
+        if isinstance(dist, MixtureSameFamily):
+            comp = dist.component_distribution
+            if not isinstance(comp, Independent) or not isinstance(
+                comp.base_dist, Normal
+            ):
+                raise NotImplementedError(
+                    f"Mixture components {type(comp)} not supported yet!"
+                )
+            weights = dist.mixture_distribution.probs
+            loc, scale = comp.base_dist.loc, comp.base_dist.scale
+            return cls(weights.to(loc.device), loc, scale)
+        elif isinstance(dist, Independent) and isinstance(dist.base_dist, Normal):
+            loc, scale = dist.base_dist.loc, dist.base_dist.scale
+            return cls(torch.ones(1, device=loc.device), loc[None], scale[None])
+        else:
+            raise NotImplementedError(f"Distribution {type(dist)} not supported yet!")
+
+    @property
+    def zero_mean(self):
+        return bool(torch.all(self.means == 0))
+
+
+class VPInterpolant(object):
+    """x_t = sqrt(1 - t^2) x0 + t x1, used by OneVP and the two-sided VP path."""
+
+    def coefficients(self, t):
+        # a, b, c^2
+        return torch.sqrt(1 - t**2), t, torch.zeros_like(t)
+
+    def time_derivatives(self, t):
+        # da, db, d(a^2), d(b^2), d(c^2); da is singular at t = 1
+        return (
+            -t / torch.sqrt(1 - t**2),
+            torch.ones_like(t),
+            -2 * t,
+            2 * t,
+            torch.zeros_like(t),
+        )
+
+
+class SBInterpolant(object):
+    """x_t = (1 - t) x0 + t x1 + sqrt(t (1 - t) var) eps, used by TwoSB.
+
+    var = 0 gives the OT interpolant.
+    """
+
+    def __init__(self, var):
+        self.var = var
+
+    def coefficients(self, t):
+        return 1 - t, t, t * (1 - t) * self.var
+
+    def time_derivatives(self, t):
+        return (
+            -torch.ones_like(t),
+            torch.ones_like(t),
+            -2 * (1 - t),
+            2 * t,
+            (1 - 2 * t) * self.var,
+        )
+
+
+class AnalyticTimeMarginal(object):
+    """Exact log p_t and its time derivative for a linear path between mixtures."""
+
+    def __init__(self, p, q, interpolant):
+        self.p = p
+        self.q = q
+        self.interpolant = interpolant
+        # skip da * mu0 for a standard normal p, da is infinite at t = 1 for VP
+        self.p_zero_mean = p.zero_mean
+
+        n_p, n_q = len(p.log_weights), len(q.log_weights)
+        self.log_weights = (p.log_weights[:, None] + q.log_weights[None, :]).reshape(
+            n_p * n_q
+        )
+
+    def _pairwise(self, a, b, p_values, q_values):
+        # (n, 1) coefficients against (K_p, dim) and (K_q, dim) -> (n, K_p * K_q, dim)
+        out = a[:, :, None, None] * p_values[None, :, None] + (
+            b[:, :, None, None] * q_values[None, None]
+        )
+        return out.reshape(out.shape[0], -1, out.shape[-1])
+
+    def _components(self, t, with_derivatives):
+        a, b, c2 = self.interpolant.coefficients(t)
+        means = self._pairwise(a, b, self.p.means, self.q.means)
+        variances = self._pairwise(a**2, b**2, self.p.vars, self.q.vars)
+        variances = variances + c2[:, :, None]
+        if not with_derivatives:
+            return means, variances, None, None
+
+        da, db, da2, db2, dc2 = self.interpolant.time_derivatives(t)
+        if self.p_zero_mean:
+            da = torch.zeros_like(da)
+        d_means = self._pairwise(da, db, self.p.means, self.q.means)
+        d_variances = self._pairwise(da2, db2, self.p.vars, self.q.vars)
+        d_variances = d_variances + dc2[:, :, None]
+        return means, variances, d_means, d_variances
+
+    def _component_log_probs(self, x, t, with_derivatives):
+        t = torch.as_tensor(t, dtype=x.dtype, device=x.device)
+        t = t.expand(x.shape[0], 1) if t.dim() < 2 else t.reshape(-1, 1)
+        means, variances, d_means, d_variances = self._components(t, with_derivatives)
+
+        diff = x[:, None] - means
+        log_probs = -0.5 * torch.sum(
+            diff**2 / variances + torch.log(2 * math.pi * variances), dim=-1
+        )
+        return log_probs + self.log_weights, diff, variances, d_means, d_variances
+
+    def log_prob(self, x, t):
+        """log p_t(x) of shape (n, 1) for x of shape (n, dim)."""
+        log_probs = self._component_log_probs(x, t, with_derivatives=False)[0]
+        return torch.logsumexp(log_probs, dim=-1, keepdim=True)
+
+    def log_prob_and_time_score(self, x, t):
+        """log p_t(x) and d/dt log p_t(x), both of shape (n, 1)."""
+        log_probs, diff, variances, d_means, d_variances = self._component_log_probs(
+            x, t, with_derivatives=True
+        )
+        # d/dt log N(x; m_t, s_t^2) per component
+        d_log_probs = torch.sum(
+            -0.5 * d_variances / variances
+            + diff * d_means / variances
+            + 0.5 * diff**2 * d_variances / variances**2,
+            dim=-1,
+        )
+        log_p = torch.logsumexp(log_probs, dim=-1, keepdim=True)
+        responsibilities = torch.exp(log_probs - log_p)
+        time_score = torch.sum(responsibilities * d_log_probs, dim=-1, keepdim=True)
+        return log_p, time_score
+
+    def time_score(self, x, t):
+        """d/dt log p_t(x) of shape (n, 1) for x of shape (n, dim)."""
+        return self.log_prob_and_time_score(x, t)[1]
+
+    def log_density_ratios(self, x):
+        """log p_1(x) - log p_0(x), i.e. the target of the ratio integrators."""
+        return self.log_prob(x, 1.0) - self.log_prob(x, 0.0)
+
+
+class OracleTimeScoreModel(nn.Module):
+    """Drop-in replacement for a trained toy time score network.
+
+    Called as `model(x, t)` with t of shape (n, 1) and returns the exact
+    d/dt log p_t(x), so it works with `get_toy_density_ratio_fn` and
+    score_type="time".
+    """
+
+    def __init__(self, marginal):
+        super().__init__()
+        self.marginal = marginal
+
+    def forward(self, x, t):
+        return self.marginal.time_score(x, t)
+
+
+def get_toy_marginal(config, dataset):
+    """Builds the `AnalyticTimeMarginal` of the path toy_run_lib trains on."""
+    prob_path_name = config.training.prob_path
+    if config.data.dataset not in ["Gaussians", "GMMs"]:
+        raise NotImplementedError(
+            f"Analytic marginals for {config.data.dataset} not supported yet!"
+        )
+
+    # same choice of interpolant as in toy_run_lib.train
+    if prob_path_name.startswith("One") or not config.training.use_two_sb:
+        interpolant = VPInterpolant()
+    else:
+        interpolant = SBInterpolant(config.training.two_sb_var)
+
+    p = DiagonalGaussianMixture.from_distribution(dataset.p)
+    q = DiagonalGaussianMixture.from_distribution(dataset.q)
+    return AnalyticTimeMarginal(p, q, interpolant)
+
+
+def get_oracle_score_model(config, dataset):
+    return OracleTimeScoreModel(get_toy_marginal(config, dataset))
@@ -2,6 +2,8 @@ import torch
 import torch.autograd as autograd
 import torch.optim as optim
 
+import time_samplers
+
 
 def get_optimizer(config, params):
     """Returns a flax optimizer object based on `config`."""
@@ -112,8 +114,19 @@ def get_toy_joint_score_estimation(
 
 # TODO: this is used for toy timewise exp
 def get_toy_timewise_score_estimation(
-    sde, likelihood_weighting, factor, eps1, eps2, eps_factor, device, batch_size
+    sde,
+    likelihood_weighting,
+    factor,
+    eps1,
+    eps2,
+    eps_factor,
+    device,
+    batch_size,
+    time_sampler="uniform",
 ):
+    sample_times = time_samplers.get_time_sampler(
+        time_sampler, eps1, eps_factor, device
+    )
     t0 = torch.zeros((batch_size, 1), device=device) + eps1
     t1 = torch.ones((batch_size, 1), device=device) - eps2
 
@@ -135,7 +148,8 @@ def get_toy_timewise_score_estimation(
         we are reweighting the output of the score network (most recent version)
         """
         # sample appropriate data
-        t = torch.rand(batch_size, 1, device=device) * eps_factor + eps1
+        t, t_weights = sample_times(batch_size)
+        t, t_weights = t[:, None], t_weights[:, None]
         px = torch.randn_like(qx, device=device)
         mean, std, var = sde.marginal_prob(qx, t)
         xt = mean + px * std
@@ -143,6 +157,8 @@ def get_toy_timewise_score_estimation(
         # reweighted version
 
         lambda_t, lambda_t0, lambda_t1, lambda_dt = time_weighting_quantities(t=t)
+        # only the integrand over t depends on the sampled times
+        lambda_t, lambda_dt = lambda_t * t_weights, lambda_dt * t_weights
 
         term1 = 2 * scorenet(px, t0) * lambda_t0
         term2 = 2 * scorenet(qx, t1) * lambda_t1
@@ -166,9 +182,20 @@ def get_toy_timewise_score_estimation(
 
 
 def get_toy_cat_timewise_score_estimation(
-    sde, likelihood_weighting, factor, eps1, eps2, eps_factor, device, batch_size
+    sde,
+    likelihood_weighting,
+    factor,
+    eps1,
+    eps2,
+    eps_factor,
+    device,
+    batch_size,
+    time_sampler="uniform",
 ):
     print("Using torch.cat")
+    sample_times = time_samplers.get_time_sampler(
+        time_sampler, eps1, eps_factor, device
+    )
     t0 = torch.zeros((batch_size, 1), device=device) + eps1
     t1 = torch.ones((batch_size, 1), device=device) - eps2
 
@@ -190,7 +217,8 @@ def get_toy_cat_timewise_score_estimation(
         we are reweighting the output of the score network (most recent version)
         """
         # sample appropriate data
-        t = torch.rand(batch_size, 1, device=device) * eps_factor + eps1
+        t, t_weights = sample_times(batch_size)
+        t, t_weights = t[:, None], t_weights[:, None]
         px = torch.randn_like(qx, device=device)
         mean, std, var = sde.marginal_prob(qx, t)
         xt = mean + px * std
@@ -198,6 +226,8 @@ def get_toy_cat_timewise_score_estimation(
         # reweighted version
 
         lambda_t, lambda_t0, lambda_t1, lambda_dt = time_weighting_quantities(t=t)
+        # only the integrand over t depends on the sampled times
+        lambda_t, lambda_dt = lambda_t * t_weights, lambda_dt * t_weights
 
         t.requires_grad_(True)
         xs = torch.cat([px, qx, xt], dim=0)
@@ -238,10 +268,15 @@ def get_toy_c_timewise_score_estimation(
     eps_factor,
     device,
     full=True,
+    time_sampler="uniform",
 ):
     if likelihood_weighting != "obj_var":
         raise NotImplementedError
 
+    sample_times = time_samplers.get_time_sampler(
+        time_sampler, eps1, eps_factor, device
+    )
+
     assert factor == 1  # assumes factor=1
 
     # clamp_limit = 36.0 * prob_path.dim
@@ -266,13 +301,15 @@ def get_toy_c_timewise_score_estimation(
             return ctsm_loss
 
     def toy_c_timewise_score_estimation(scorenet, samples):
-        t = torch.rand(batch_size, 1, device=device) * eps_factor + eps1
+        t, t_weights = sample_times(batch_size)
+        t, t_weights = t[:, None], t_weights[:, None]
 
         mean, std, var = prob_path.marginal_prob(samples, t)
         epsilon = torch.randn((len(t), prob_path.dim), device=device)
 
         # Note: lambda_t here has a different interpretation from Choi et al.
         loss = loss_fn(scorenet, epsilon, samples, t, mean, std)
+        loss = loss * t_weights.view(loss.shape)
 
         return loss.mean()
 
@@ -295,6 +332,7 @@ def get_step_fn(
     factor=1.0,
     device=torch.device("cpu"),
     full=False,
+    time_sampler="uniform",
 ):
     """Create a one-step training/evaluation function.
 
@@ -321,6 +359,7 @@ def get_step_fn(
                 eps_factor=eps_factor,
                 device=device,
                 batch_size=batch_size,
+                time_sampler=time_sampler,
             )
         else:
             loss_fn = get_toy_c_timewise_score_estimation(
@@ -333,6 +372,7 @@ def get_step_fn(
                 eps_factor=eps_factor,
                 device=device,
                 full=full,
+                time_sampler=time_sampler,
             )
     else:
         # should not use these (yet)
@@ -406,7 +446,8 @@ def get_step_fn(
         #     loss_dict = {
         #         "loss": loss.item(),
         #     }
-        loss_dict = {"loss": loss.item()}
+        # keep the loss on device, the metrics logger aggregates it without syncing
+        loss_dict = {"loss": loss.detach()}
         # ugh
         # if joint:
         #   loss_dict['loss4'] = loss4.item()
@@ -11,28 +11,40 @@ import logging
 import sde_lib
 from models.toy_networks import *
 import toy_losses, toy_mi_losses
+import couplings
 from models import utils as mutils
 from models.ema import ExponentialMovingAverage
 import toy_datasets
 import density_ratios
+import profiling
+import ratio_cache
 from absl import flags
 import torch
 import torch.autograd as autograd
 from utils import save_checkpoint, restore_checkpoint, get_prob_path
+from metrics import get_metrics_logger
 import torch.optim as optim
 
-import matplotlib
+FLAGS = flags.FLAGS
 
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import seaborn as sns
+# plotting libraries are only imported when a figure is first drawn
+plt = None
+sns = None
 
-sns.set_context("poster")
-sns.set_style("white")
 
-import wandb
+def _setup_plotting():
+    global plt, sns
+    if plt is not None:
+        return
+    import matplotlib
 
-FLAGS = flags.FLAGS
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as _plt
+    import seaborn as _sns
+
+    _sns.set_context("poster")
+    _sns.set_style("white")
+    plt, sns = _plt, _sns
 
 
 # def seed_all(seed):
@@ -44,13 +56,19 @@ FLAGS = flags.FLAGS
 #         torch.backends.cudnn.benchmark = False
 
 
-def train(config, workdir):
+def train(config, workdir, stop_step=None):
     """Runs the training pipeline.
 
     Args:
       config: Configuration to use.
       workdir: Working directory for checkpoints and TF summaries. If this
         contains checkpoint training will be resumed from the latest checkpoint.
+      stop_step: If given and smaller than `config.training.n_iters`, training
+        pauses after this step. The state, evaluation history and random state
+        are saved to the intermediate checkpoint, which a later call resumes.
+
+    Returns:
+      The evaluation history, the contents of metrics/metrics.p.
     """
     # Initialize model.
     score_model = mutils.create_model(config, name=config.model.name)
@@ -79,6 +97,9 @@ def train(config, workdir):
     # Build data iterators
     train_ds = toy_datasets.get_dataset(config)
 
+    metrics = get_metrics_logger(config, workdir)
+    profiling.init_profiler(config, workdir, metrics)
+
     # Build one-step training and evaluation functions
     optimize_fn = toy_losses.toy_optimization_manager(config)
     joint = config.training.joint
@@ -111,6 +132,7 @@ def train(config, workdir):
 
     # get appropriate functions
     eps_factor = 1.0 - eps1 - eps2
+    couple = None
 
     if data_dataset == "GaussiansforMI":
         train_step_fn = toy_mi_losses.get_step_fn(
@@ -128,6 +150,7 @@ def train(config, workdir):
             device=config.device,
             batch_size=batch_size,
             full=config.training.full,
+            time_sampler=config.training.time_sampler,
         )
     else:
         if not one_sided and config.training.use_two_sb:
@@ -137,6 +160,19 @@ def train(config, workdir):
                 interpolate_fn = train_ds.sample_sequence_on_the_fly_sb
         else:
             interpolate_fn = train_ds.sample_sequence_on_the_fly
+        if config.training.coupling != "independent":
+            if one_sided:
+                raise NotImplementedError("Couplings need a two-sided path!")
+            couple = couplings.get_coupling_fn(
+                config.training.coupling,
+                reg=config.training.coupling_reg,
+                num_iters=config.training.coupling_iters,
+                max_exact=config.training.coupling_max_exact,
+            )
+            if not conditional:
+                interpolate_fn = couplings.get_coupled_interpolate_fn(
+                    interpolate_fn, couple
+                )
         train_step_fn = toy_losses.get_step_fn(
             sde=sde,
             train=True,
@@ -154,6 +190,7 @@ def train(config, workdir):
             batch_size=batch_size,
             full=config.training.full,
             interpolate_fn=interpolate_fn,
+            time_sampler=config.training.time_sampler,
         )
     num_train_steps = config.training.n_iters
 
@@ -187,6 +224,8 @@ def train(config, workdir):
             batch_fn = train_ds.one_sample
         else:
             batch_fn = train_ds.two_sample
+            if conditional and couple is not None:
+                batch_fn = couplings.get_coupled_batch_fn(batch_fn, couple)
 
     if data_dataset != "GaussiansforMI":
         val_evaluate_fn = get_toy_val_evaluate_fn(
@@ -197,11 +236,49 @@ def train(config, workdir):
             config, teacher=train_ds, device=config.device
         )
 
+    # multi-fidelity evaluation: every evaluation computes a cheap val MSE, the
+    # full-precision evaluations only run for checkpoints whose cheap val MSE is
+    # within a factor 1 + promote_margin of the best one so far, and at the end
+    multi_fidelity = config.eval.multi_fidelity
+    best_cheap = np.inf
+    if multi_fidelity:
+        if data_dataset != "GaussiansforMI":
+            cheap_val_evaluate_fn = get_toy_val_evaluate_fn(
+                config, dataset=train_ds, device=config.device, cheap=True
+            )
+        else:
+            cheap_val_evaluate_fn = get_mi_val_evaluate_fn(
+                config, teacher=train_ds, device=config.device, cheap=True
+            )
+
     all_times = []
-    for step in range(initial_step, num_train_steps + 1):
+    # a paused run continues with its evaluation history and random state
+    if "toy_history" in state:
+        toy_history = pickle.loads(state["toy_history"])
+        scheduler.load_state_dict(toy_history["scheduler"])
+        mse_errors = toy_history["mse_errors"]
+        best_diff, best_step = toy_history["best_diff"], toy_history["best_step"]
+        best_cheap = toy_history.get("best_cheap", np.inf)
+        all_times = toy_history["all_times"]
+        if data_dataset == "GaussiansforMI":
+            mi_metrics = toy_history["mi_metrics"]
+            mi_db = toy_history["mi_db"]
+            val_mse_errors = toy_history["val_mse_errors"]
+            nfes = toy_history["nfes"]
+        torch.set_rng_state(toy_history["torch_rng"])
+        np.random.set_state(toy_history["numpy_rng"])
+        if torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(toy_history["cuda_rng"])
+
+    last_step = num_train_steps
+    if stop_step is not None:
+        last_step = min(stop_step, num_train_steps)
+    for step in range(initial_step, last_step + 1):
+        profiling.step(step)
         # n = config.training.batch_size
         if data_dataset == "GaussiansforMI":
-            batch = batch_fn(n_samples=batch_size)
+            with profiling.phase("data"):
+                batch = batch_fn(n_samples=batch_size)
 
             t1 = time.perf_counter()
             loss_dict = train_step_fn(state, batch)
@@ -209,7 +286,8 @@ def train(config, workdir):
         else:
             # TODO: what is going on??
             # fix here
-            batch = batch_fn(n=batch_size)
+            with profiling.phase("data"):
+                batch = batch_fn(n=batch_size)
             # TODO: there are also some differences. right now timewise should work, but not joint
 
             t1 = time.perf_counter()
@@ -218,86 +296,171 @@ def train(config, workdir):
 
         # Execute one training step
         # loss_dict = train_step_fn(state, batch.detach())
-        loss_dict["step"] = step
-        wandb.log(loss_dict)
-        if step % config.training.log_freq == 0:
-            logging.info("step: %d, training_loss: %.4f" % (step, loss_dict["loss"]))
+        with profiling.phase("logging"):
+            metrics.log(loss_dict, step)
 
         # Report the loss on an evaluation dataset periodically
         if step % config.training.eval_freq == 0 and step > 0:
-            if data_dataset != "GaussiansforMI":
-
-                val_mse_error = val_evaluate_fn(score_model)
-                mse_error, nfe = visualize(
-                    config,
-                    train_ds,
-                    score_model,
-                    savefig=figures_dir,
-                    step=step,
-                    device=config.device,
-                )
-                mse_errors["step"].append(step)
-                mse_errors["mse"].append(mse_error)
-                # let's add this here
-                mse_errors["val_mse"].append(val_mse_error)
-                mse_errors["nfe"].append(nfe)
-
-                with open(os.path.join(metrics_dir, "metrics.p"), "wb") as fp:
-                    pickle.dump(mse_errors, fp)
-            else:
-
-                val_mse_error = val_evaluate_fn(score_model)
-                val_mse_errors.append(val_mse_error)
-                est_mi, nfe = estimate_mi(
-                    config, score_model, train_ds, device=config.device
-                )
-                mi_db.append(est_mi)
-                nfes.append(nfe)
-
-                mse_errors.append(np.square(est_mi - train_ds.true_mutual_info))
-
-                visualize_mi(
-                    config, mi_db, train_ds.true_mutual_info, savefig=figures_dir
-                )
-                # also save metrics
-                mi_metrics["step"].append(step)
-                mi_metrics["mi"] = mi_db
-                # let's add this here
-                mi_metrics["val_mse_error"] = val_mse_errors
-                mi_metrics["nfe"] = nfes
-
-                mi_metrics["mse_error"] = mse_errors
-
-                # should you save checkpoints?
-                diff = np.abs(mi_db[-1] - train_ds.true_mutual_info)
-                if diff <= best_diff:
-                    best_diff = diff
-                    best_step = step
-                    mi_metrics["best_diff"] = best_diff
-                    mi_metrics["best_step"] = best_step
-                    fpath = os.path.join(checkpoint_dir, "best_ckpt.pth")
+            # with multi-fidelity evaluation, the promotions must not change the
+            # random numbers of training, which the evaluations also draw from
+            with profiling.phase("eval"), torch.random.fork_rng(
+                enabled=multi_fidelity
+            ):
+                promoted = True
+                if multi_fidelity:
+                    cheap_val_mse = cheap_val_evaluate_fn(score_model)
+                    promoted = (
+                        step == last_step
+                        or cheap_val_mse
+                        <= (1.0 + config.eval.promote_margin) * best_cheap
+                    )
+                    best_cheap = min(best_cheap, cheap_val_mse)
+                    print(
+                        f"Cheap val MSE {cheap_val_mse}, "
+                        + ("promoted" if promoted else "not promoted")
+                    )
+
+                if data_dataset != "GaussiansforMI":
+
+                    record = {}
+                    if promoted:
+                        val_mse_error = val_evaluate_fn(score_model)
+                        mse_error, nfe = visualize(
+                            config,
+                            train_ds,
+                            score_model,
+                            savefig=figures_dir,
+                            step=step,
+                            device=config.device,
+                        )
+                        record.update(mse=mse_error, val_mse=val_mse_error, nfe=nfe)
+                    else:
+                        val_mse_error = mse_error = nfe = np.nan
+                    mse_errors["step"].append(step)
+                    mse_errors["mse"].append(mse_error)
+                    # let's add this here
+                    mse_errors["val_mse"].append(val_mse_error)
+                    mse_errors["nfe"].append(nfe)
+                    if multi_fidelity:
+                        mse_errors.setdefault("cheap_val_mse", []).append(
+                            cheap_val_mse
+                        )
+                        record.update(
+                            cheap_val_mse=cheap_val_mse, promoted=float(promoted)
+                        )
+                    metrics.write(record, step)
+
+                    # the full-precision val MSE selects the best checkpoint
+                    if val_mse_error <= best_diff:
+                        best_diff = val_mse_error
+                        best_step = step
+                        torch.save(
+                            score_model.state_dict(),
+                            os.path.join(checkpoint_dir, "best_ckpt.pth"),
+                        )
+
+                    with open(os.path.join(metrics_dir, "metrics.p"), "wb") as fp:
+                        pickle.dump(mse_errors, fp)
                 else:
-                    fpath = os.path.join(checkpoint_dir, "ckpt.pth")
-                torch.save(score_model.state_dict(), fpath)
-
-                # save metrics
-                with open(os.path.join(metrics_dir, "metrics.p"), "wb") as fp:
-                    pickle.dump(mi_metrics, fp)
 
-                # take a scheduler step
-                if config.optim.scheduler:
-                    scheduler.step()
+                    record = {}
+                    if promoted:
+                        val_mse_error = val_evaluate_fn(score_model)
+                        est_mi, nfe = estimate_mi(
+                            config, score_model, train_ds, device=config.device
+                        )
+                        mse_error = np.square(est_mi - train_ds.true_mutual_info)
+                        record.update(
+                            mi=est_mi, val_mse=val_mse_error, mse=mse_error, nfe=nfe
+                        )
+                    else:
+                        val_mse_error = est_mi = nfe = mse_error = np.nan
+                    val_mse_errors.append(val_mse_error)
+                    mi_db.append(est_mi)
+                    nfes.append(nfe)
+
+                    mse_errors.append(mse_error)
+                    if multi_fidelity:
+                        mi_metrics.setdefault("cheap_val_mse_error", []).append(
+                            cheap_val_mse
+                        )
+                        record.update(
+                            cheap_val_mse=cheap_val_mse, promoted=float(promoted)
+                        )
+                    metrics.write(record, step)
+
+                    visualize_mi(
+                        config, mi_db, train_ds.true_mutual_info, savefig=figures_dir
+                    )
+                    # also save metrics
+                    mi_metrics["step"].append(step)
+                    mi_metrics["mi"] = mi_db
+                    # let's add this here
+                    mi_metrics["val_mse_error"] = val_mse_errors
+                    mi_metrics["nfe"] = nfes
+
+                    mi_metrics["mse_error"] = mse_errors
+
+                    # should you save checkpoints?
+                    diff = np.abs(mi_db[-1] - train_ds.true_mutual_info)
+                    if diff <= best_diff:
+                        best_diff = diff
+                        best_step = step
+                        mi_metrics["best_diff"] = best_diff
+                        mi_metrics["best_step"] = best_step
+                        fpath = os.path.join(checkpoint_dir, "best_ckpt.pth")
+                    else:
+                        fpath = os.path.join(checkpoint_dir, "ckpt.pth")
+                    torch.save(score_model.state_dict(), fpath)
+
+                    # save metrics
+                    with open(os.path.join(metrics_dir, "metrics.p"), "wb") as fp:
+                        pickle.dump(mi_metrics, fp)
+
+                    # take a scheduler step
+                    if config.optim.scheduler:
+                        scheduler.step()
+
+    profiling.close(last_step)
+    metrics.close()
+
+    if last_step < num_train_steps:
+        # pause: save everything needed to continue at last_step + 1
+        toy_history = dict(
+            scheduler=scheduler.state_dict(),
+            mse_errors=mse_errors,
+            best_diff=best_diff,
+            best_step=best_step,
+            best_cheap=best_cheap,
+            all_times=all_times,
+            torch_rng=torch.get_rng_state(),
+            numpy_rng=np.random.get_state(),
+        )
+        if torch.cuda.is_available():
+            toy_history["cuda_rng"] = torch.cuda.get_rng_state_all()
+        if data_dataset == "GaussiansforMI":
+            toy_history.update(
+                mi_metrics=mi_metrics,
+                mi_db=mi_db,
+                val_mse_errors=val_mse_errors,
+                nfes=nfes,
+            )
+        # pickled, the checkpoint only holds types that torch.load accepts
+        state["toy_history"] = pickle.dumps(toy_history)
+        save_checkpoint(checkpoint_meta_dir, state)
+        print(f"Paused after step {last_step}, saved to {checkpoint_meta_dir}")
+        return mi_metrics if data_dataset == "GaussiansforMI" else mse_errors
 
     if num_train_steps >= config.training.eval_freq:
         if data_dataset != "GaussiansforMI":
             temp = mse_errors["val_mse"]
-            index = np.argmin(temp)
+            index = np.nanargmin(temp)
             print(
                 f"Best MSE error on val set: {temp[index]} at {mse_errors['step'][index]}"
             )
         else:
             temp = mi_metrics["val_mse_error"]
-            index = np.argmin(temp)
+            index = np.nanargmin(temp)
             print(
                 f"Best MSE error on val set: {temp[index]} at {mi_metrics['step'][index]}"
             )
@@ -306,8 +469,50 @@ def train(config, workdir):
             pickle.dump(all_times, fp)
         print(f"Total training time: {np.sum(all_times)}")
 
+    return mi_metrics if data_dataset == "GaussiansforMI" else mse_errors
+
 
-def get_toy_val_evaluate_fn(config, dataset, device, prob_path=None):
+def _get_val_density_ratio_fn(config, cheap=False):
+    """The ratio function of the val evaluations.
+
+    The cheap one of multi-fidelity evaluation integrates with
+    config.eval.cheap_method, a fixed quadrature or a loosely tolerated solver.
+    """
+    if cheap:
+        rtol, atol = config.eval.cheap_rtol, config.eval.cheap_atol
+        method = config.eval.cheap_method
+    else:
+        rtol, atol = config.eval.rtol, config.eval.atol
+        method = config.eval.ratio_method
+    return density_ratios.get_toy_density_ratio_fn(
+        rtol=rtol,
+        atol=atol,
+        method=method,
+        eps1=config.data.eps1,
+        eps2=config.data.eps2,
+        cache=ratio_cache.get_ratio_cache(
+            config, tag=toy_datasets.val_set_name(config)
+        ),
+    )
+
+
+def _val_subsample(config, points):
+    """A fixed subsample of config.eval.cheap_n_val val points, <= 0 keeps all."""
+    n = config.eval.cheap_n_val
+    if n <= 0 or n >= points.shape[0]:
+        return points
+    # the same points at every evaluation, independent of the training seed
+    generator = torch.Generator().manual_seed(0)
+    index = torch.randperm(points.shape[0], generator=generator)[:n]
+    return points[index.to(points.device)]
+
+
+def get_toy_val_evaluate_fn(config, dataset, device, prob_path=None, cheap=False):
+    """Returns a function of the val MSE of the estimated log ratios.
+
+    With cheap=True, the routine estimate of multi-fidelity evaluation on a
+    subsample of the val set, see `_get_val_density_ratio_fn`.
+    """
     # seed_all(1)
     # qs = dataset.q.sample((5000,))
     # ps = dataset.p.sample((5000,))
@@ -316,32 +521,18 @@ def get_toy_val_evaluate_fn(config, dataset, device, prob_path=None):
     # os.makedirs(val_dir, exist_ok=True)
     # torch.save(mesh, os.path.join(val_dir, "val_mesh.pt"))
     # seed_all(config.seed)
-    if config.data.dataset != "GMMs":
-        mesh = torch.load(
-            os.path.join("val_sets", f"{config.data.dataset}_{config.data.dim}.pt"),
-            map_location=device,
-        )
-    else:
-        mesh = torch.load(
-            os.path.join(
-                "val_sets",
-                f"{config.data.dataset}_{config.data.dim}_{config.data.k}.pt",
-            ),
-            map_location=device,
-        )
+    mesh = torch.load(toy_datasets.val_set_path(config), map_location=device)
+
+    if cheap:
+        mesh = _val_subsample(config, mesh)
 
     logr_true = dataset.log_density_ratios(mesh.to(device)).squeeze().numpy()
 
-    density_ratio_fn = density_ratios.get_toy_density_ratio_fn(
-        rtol=config.eval.rtol,
-        atol=config.eval.atol,
-        eps1=config.data.eps1,
-        eps2=config.data.eps2,
-    )
+    density_ratio_fn = _get_val_density_ratio_fn(config, cheap)
 
     def val_evaluate(model):
         print("-----")
-        print("val set")
+        print("cheap val set" if cheap else "val set")
         est_logr, _ = density_ratio_fn(
             model.to(device), mesh, score_type=config.model.type
         )
@@ -355,7 +546,11 @@ def get_toy_val_evaluate_fn(config, dataset, device, prob_path=None):
     return val_evaluate
 
 
-def get_mi_val_evaluate_fn(config, teacher, device):
+def get_mi_val_evaluate_fn(config, teacher, device, cheap=False):
+    """Returns a function of the squared error of the estimated MI on the val set.
+
+    cheap=True as in `get_toy_val_evaluate_fn`.
+    """
     # mi_true = teacher.true_mutual_info
     # seed_all(1)
     # n = 10000
@@ -365,23 +560,18 @@ def get_mi_val_evaluate_fn(config, teacher, device):
     # torch.save(samples, os.path.join(val_dir, "val_samples.pt"))
     # seed_all(config.seed)
 
-    samples = torch.load(
-        f"val_sets/{config.data.dataset}_{config.data.dim}.pt", map_location=device
-    )
+    samples = torch.load(toy_datasets.val_set_path(config), map_location=device)
+    if cheap:
+        samples = _val_subsample(config, samples)
 
-    density_ratio_fn = density_ratios.get_toy_density_ratio_fn(
-        rtol=config.eval.rtol,
-        atol=config.eval.atol,
-        eps1=config.data.eps1,
-        eps2=config.data.eps2,
-    )
+    density_ratio_fn = _get_val_density_ratio_fn(config, cheap)
 
     emp_mi = teacher.empirical_mutual_info(samples)
     score_type = config.model.type
 
     def val_evaluate(model):
         print("-----")
-        print("val set")
+        print("cheap val set" if cheap else "val set")
         est_mi, _ = density_ratio_fn(model.to(device), samples, score_type=score_type)
         est_mi = np.mean(est_mi)
         val_mse = np.square(emp_mi - est_mi)
@@ -398,6 +588,7 @@ def get_mi_val_evaluate_fn(config, teacher, device):
 
 
 def visualize(config, dataset, model, savefig=None, step=None, device=None):
+    _setup_plotting()
     model.eval()
     data_dataset = config.data.dataset
 
@@ -406,8 +597,12 @@ def visualize(config, dataset, model, savefig=None, step=None, device=None):
         density_ratio_fn = density_ratios.get_toy_density_ratio_fn(
             rtol=config.eval.rtol,
             atol=config.eval.atol,
+            method=config.eval.ratio_method,
             eps1=config.data.eps1,
             eps2=config.data.eps2,
+            cache=ratio_cache.get_ratio_cache(
+                config, tag=toy_datasets.val_set_name(config)
+            ),
         )
 
         if data_dataset == "PeakedGaussians":
@@ -497,8 +692,12 @@ def estimate_mi(config, model, teacher, device):
     density_ratio_fn = density_ratios.get_toy_density_ratio_fn(
         rtol=config.eval.rtol,
         atol=config.eval.atol,
+        method=config.eval.ratio_method,
         eps1=config.data.eps1,
         eps2=config.data.eps2,
+        cache=ratio_cache.get_ratio_cache(
+            config, tag=toy_datasets.val_set_name(config)
+        ),
     )
 
     model.eval()
@@ -524,7 +723,7 @@ def estimate_mi(config, model, teacher, device):
 
 
 def visualize_mi(config, mi_db, mi_true, savefig=None):
-
+    _setup_plotting()
     plt.figure(figsize=(12, 5))
     plt.plot(
         range(0, len(mi_db) * config.training.eval_freq, config.training.eval_freq),
@@ -0,0 +1,295 @@
+"""Hyperparameter sweeps of the toy experiments with asynchronous successive halving.
+
+Runs the grid of overrides given by --grid on top of a toy config (from
+configs/gaussians, configs/gmms or configs/gmm_mutual_info) with ASHA on the
+validation MSE. Every trial is first trained for `min_budget` steps; a trial
+is promoted to the next rung, eta times the budget, as soon as it is in the
+top 1 / eta of the trials that finished its current rung. Promoted trials
+resume from their intermediate toy checkpoint. Every worker process trains
+one trial at a time and many trials over its lifetime. Everything is local:
+the trials live in <workdir>/trials, every finished rung is appended to
+<workdir>/results.jsonl, from which an interrupted sweep resumes, and a
+leaderboard is written to <workdir>/leaderboard.csv at the end.
+
+    python toy_sweep.py --config configs/gaussians/time/mlp.py \\
+      --workdir=../results/sweeps/gaussians_2_mlp --config.data.dim=2 \\
+      --grid=seed=1,2,3 --grid=optim.lr=0.002,0.001 --grid=model.z_dim=128,256 \\
+      --grid=training.reweight=path_var,none --grid=training.unit_factor=True,False
+"""
+
+import ast
+import copy
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+from ml_collections.config_flags import config_flags
+
+FLAGS = flags.FLAGS
+
+config_flags.DEFINE_config_file("config", None, "Base toy configuration.")
+flags.DEFINE_string("workdir", None, "Work directory of the sweep.")
+flags.DEFINE_multi_string(
+    "grid",
+    [],
+    "key=v1,v2,... with key a dotted config field, e.g. optim.lr=0.002,0.001. "
+    "The sweep runs the product of all values.",
+)
+flags.DEFINE_integer(
+    "min_budget",
+    0,
+    "training steps of the first rung; 0 for a tenth of training.n_iters. "
+    "All budgets are rounded up to multiples of training.eval_freq.",
+)
+flags.DEFINE_integer("eta", 3, "reduction factor between rungs")
+flags.DEFINE_integer("num_workers", 1, "trials trained in parallel processes")
+flags.DEFINE_integer(
+    "threads_per_worker", 0, "torch threads of every worker, 0 to leave as is"
+)
+flags.DEFINE_string("sinks", "jsonl", "metrics sinks of the trials")
+flags.mark_flags_as_required(["workdir", "config"])
+
+
+def parse_grid(grid):
+    """Returns a list of (key, values) from the --grid flags."""
+    axes = []
+    for entry in grid:
+        key, values = entry.split("=", 1)
+        parsed = []
+        for value in values.split(","):
+            try:
+                parsed.append(ast.literal_eval(value))
+            except (ValueError, SyntaxError):
+                parsed.append(value)
+        axes.append((key, parsed))
+    return axes
+
+
+def get_trials(config, axes):
+    """Returns the configs and overrides of all points of the grid."""
+    keys = [key for key, _ in axes]
+    trials = []
+    for values in itertools.product(*[values for _, values in axes]):
+        overrides = dict(zip(keys, values))
+        trial_config = copy.deepcopy(config)
+        trial_config.unlock()
+        trial_config.update_from_flattened_dict(overrides)
+        trials.append((trial_config, overrides))
+    return trials
+
+
+def get_rungs(n_iters, eval_freq, min_budget, eta):
+    """Budgets of the rungs, multiples of eval_freq up to the full n_iters."""
+    if min_budget <= 0:
+        min_budget = n_iters // 10
+    rungs = []
+    budget = min_budget
+    while budget < n_iters:
+        rung = int(np.ceil(budget / eval_freq)) * eval_freq
+        if rung >= n_iters:
+            break
+        if not rungs or rung > rungs[-1]:
+            rungs.append(rung)
+        budget *= eta
+    return rungs + [n_iters]
+
+
+def ensure_val_set(config):
+    """Creates the validation set, as the n_iters=-1 run of the README does."""
+    import toy_datasets
+
+    if os.path.exists(toy_datasets.val_set_path(config)):
+        return
+    config = copy.deepcopy(config)
+    config.unlock()
+    config.training.n_iters = -1
+    logging.info("Creating validation set %s" % toy_datasets.val_set_path(config))
+    toy_datasets.get_dataset(config)
+
+
+class ASHA(object):
+    """Asynchronous successive halving over a fixed number of trials.
+
+    `next_job` promotes the best trial of the highest rung that has one in its
+    top 1 / eta, and otherwise starts a new trial. Trials that finished a rung
+    and are not in its top 1 / eta stay there, unless enough worse trials
+    finish the rung after them.
+    """
+
+    def __init__(self, num_trials, rungs, eta):
+        self.rungs = rungs
+        self.eta = eta
+        self.pending = list(range(num_trials))
+        # val MSE of every trial that finished a rung
+        self.results = [dict() for _ in rungs]
+        self.promoted = [set() for _ in rungs]
+
+    def next_job(self):
+        """Returns (trial, rung) to run next, or None if there is nothing to run."""
+        for k in reversed(range(len(self.rungs) - 1)):
+            done = self.results[k]
+            top = sorted(done, key=done.get)[: len(done) // self.eta]
+            for trial in top:
+                if trial not in self.promoted[k]:
+                    self.promoted[k].add(trial)
+                    return trial, k + 1
+        if self.pending:
+            return self.pending.pop(0), 0
+        return None
+
+    def report(self, trial, rung, val_mse):
+        if trial in self.pending:
+            self.pending.remove(trial)
+        self.results[rung][trial] = val_mse
+        # a result at a rung implies the promotion from the one below
+        if rung > 0:
+            self.promoted[rung - 1].add(trial)
+
+    def leaderboard(self):
+        """Trials ordered by the highest rung they finished, then by val MSE."""
+        best = {}
+        for k, done in enumerate(self.results):
+            for trial, val_mse in done.items():
+                best[trial] = (k, val_mse)
+        return sorted(best.items(), key=lambda item: (-item[1][0], item[1][1]))
+
+
+def _init_worker(threads_per_worker):
+    if threads_per_worker > 0:
+        torch.set_num_threads(threads_per_worker)
+
+
+def run_trial(config, workdir, budget):
+    """Trains a trial up to `budget` steps and returns its latest val MSE."""
+    import toy_run_lib
+
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, "config.txt"), "w") as f:
+        print(config, file=f)
+    # as in main.py; a resumed trial restores its random state from the checkpoint
+    torch.manual_seed(config.seed)
+    np.random.seed(config.seed)
+    try:
+        history = toy_run_lib.train(config, workdir, stop_step=budget)
+    except Exception as e:
+        # e.g. a diverged MI estimate, the trial is not promoted
+        logging.warning("Trial %s failed: %s" % (workdir, e))
+        return float("inf")
+    if config.data.dataset == "GaussiansforMI":
+        val_mse = history["val_mse_error"][-1]
+    else:
+        val_mse = history["val_mse"][-1]
+    # NaN would never lose a comparison
+    return float(val_mse) if np.isfinite(val_mse) else float("inf")
+
+
+def main(argv):
+    config = FLAGS.config
+    config.unlock()
+    config.metrics.sinks = FLAGS.sinks
+    axes = parse_grid(FLAGS.grid)
+    trials = get_trials(config, axes)
+    rungs = get_rungs(
+        config.training.n_iters, config.training.eval_freq, FLAGS.min_budget, FLAGS.eta
+    )
+    logging.info("%d trials, rungs %s" % (len(trials), rungs))
+    for trial_config, _ in trials:
+        ensure_val_set(trial_config)
+
+    os.makedirs(FLAGS.workdir, exist_ok=True)
+    trial_dirs = [
+        os.path.join(FLAGS.workdir, "trials", "%04d" % i) for i in range(len(trials))
+    ]
+    asha = ASHA(len(trials), rungs, FLAGS.eta)
+
+    # pick up the finished rungs of an interrupted sweep
+    results_path = os.path.join(FLAGS.workdir, "results.jsonl")
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                record = json.loads(line)
+                asha.report(record["trial"], record["rung"], record["val_mse"])
+        logging.info("Resumed the sweep from %s" % results_path)
+
+    def report(trial, rung, val_mse):
+        asha.report(trial, rung, val_mse)
+        record = dict(trial=trial, rung=rung, budget=rungs[rung], val_mse=val_mse)
+        record.update(trials[trial][1])
+        with open(results_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        logging.info(
+            "trial %d finished rung %d (%d steps): val_mse %.5e"
+            % (trial, rung, rungs[rung], val_mse)
+        )
+
+    start = time.perf_counter()
+    if FLAGS.num_workers == 1:
+        _init_worker(FLAGS.threads_per_worker)
+        job = asha.next_job()
+        while job is not None:
+            trial, rung = job
+            val_mse = run_trial(trials[trial][0], trial_dirs[trial], rungs[rung])
+            report(trial, rung, val_mse)
+            job = asha.next_job()
+    else:
+        # spawn, so that the workers do not inherit torch threads and CUDA state
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(
+            FLAGS.num_workers,
+            initializer=_init_worker,
+            initargs=(FLAGS.threads_per_worker,),
+        ) as pool:
+            running = {}
+            while True:
+                while len(running) < FLAGS.num_workers:
+                    job = asha.next_job()
+                    if job is None:
+                        break
+                    trial, rung = job
+                    running[job] = pool.apply_async(
+                        run_trial,
+                        (trials[trial][0], trial_dirs[trial], rungs[rung]),
+                    )
+                if not running:
+                    break
+                finished = [job for job, result in running.items() if result.ready()]
+                if not finished:
+                    time.sleep(1.0)
+                for job in finished:
+                    report(*job, running.pop(job).get())
+
+    leaderboard_path = os.path.join(FLAGS.workdir, "leaderboard.csv")
+    keys = [key for key, _ in axes]
+    with open(leaderboard_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["rank", "trial", "steps", "val_mse"] + keys)
+        for rank, (trial, (rung, val_mse)) in enumerate(asha.leaderboard()):
+            overrides = trials[trial][1]
+            writer.writerow(
+                [rank, trial, rungs[rung], val_mse] + [overrides[k] for k in keys]
+            )
+    # a trial promoted to rung k has trained for rungs[k] steps in total
+    steps = sum(
+        rungs[k] - (rungs[k - 1] if k > 0 else 0)
+        for k, done in enumerate(asha.results)
+        for _ in done
+    )
+    print(
+        f"Sweep took {time.perf_counter() - start:.1f}s and {steps} training steps, "
+        f"full runs of all trials would take {len(trials) * rungs[-1]}"
+    )
+    print(f"Leaderboard written to {leaderboard_path}")
+    with open(leaderboard_path) as f:
+        print("".join(f.readlines()[:11]))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -1,6 +1,10 @@
 import torch
 import os
+import re
+import glob
+import queue
 import logging
+import threading
 import numpy as np
 from prob_path_lib import OneVP, TwoSB, OneRQNSFVP
 
@@ -19,12 +23,15 @@ def restore_checkpoint(ckpt_dir, state, device, test=False):
             state["optimizer"].load_state_dict(loaded_state["optimizer"])
         state["model"].load_state_dict(loaded_state["model"], strict=True)
         print("Loaded model")
-        state["ema"].load_state_dict(loaded_state["ema"])
+        if state["ema"] is not None:
+            state["ema"].load_state_dict(loaded_state["ema"])
         state["step"] = loaded_state["step"]
         try:
             state["scheduler"] = loaded_state["scheduler"]
         except:
             pass
+        if "toy_history" in loaded_state:
+            state["toy_history"] = loaded_state["toy_history"]
         return state
 
 
@@ -56,15 +63,198 @@ def load_history(file_path, history, interpolate=False):
     return history
 
 
-def save_checkpoint(ckpt_dir, state):
+def restore_ema_checkpoint(ckpt_dir, state, device):
+    """Loads only what evaluation needs: the EMA weights and the frozen state.
+
+    Uses the lightweight artifact written next to `ckpt_dir` by `AsyncCheckpointer`
+    when it exists, and falls back to the full checkpoint otherwise. The frozen
+    parameters and buffers of the model, which the EMA does not cover, are
+    loaded from the artifact; artifacts written without them are only used for
+    models that have no such state.
+    """
+    ema_path = ema_checkpoint_path(ckpt_dir)
+    if not os.path.exists(ema_path):
+        return restore_checkpoint(ckpt_dir, state, device, test=True)
+    loaded_state = torch.load(ema_path, map_location=device)
+    if "model" not in loaded_state:
+        if _frozen_state(state["model"]):
+            return restore_checkpoint(ckpt_dir, state, device, test=True)
+    else:
+        result = state["model"].load_state_dict(loaded_state["model"], strict=False)
+        trainable = _trainable_names(state["model"])
+        missing = [k for k in result.missing_keys if k not in trainable]
+        if missing or result.unexpected_keys:
+            raise RuntimeError(
+                f"{ema_path} does not match the model, missing {missing}, "
+                f"unexpected {result.unexpected_keys}"
+            )
+    state["ema"].load_state_dict(loaded_state["ema"])
+    state["step"] = loaded_state["step"]
+    return state
+
+
+def ema_checkpoint_path(ckpt_dir):
+    """checkpoints/checkpoint_5.pth -> checkpoints/checkpoint_5_ema.pth"""
+    root, ext = os.path.splitext(ckpt_dir)
+    return root + "_ema" + ext
+
+
+def _trainable_names(model):
+    return {name for name, p in model.named_parameters() if p.requires_grad}
+
+
+def _frozen_state(model):
+    """The entries of `model.state_dict()` that the EMA does not cover."""
+    trainable = _trainable_names(model)
+    return {k: v for k, v in model.state_dict().items() if k not in trainable}
+
+
+def _to_host(obj):
+    """Copies all tensors in a (nested) state dict to host memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {k: _to_host(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_host(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path, save_fn=torch.save):
+    """Writes to a temporary file and renames it, so `path` is never half-written.
+
+    `save_fn(obj, f)` writes `obj` to the open file `f`. The temporary file is
+    per process, so concurrent writers of the same path do not collide.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        save_fn(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_savez(path, **arrays):
+    """`np.savez` through `atomic_save`; `path` is used as is, without ".npz"."""
+    atomic_save(arrays, path, save_fn=lambda arrays, f: np.savez(f, **arrays))
+
+
+def _get_saved_state(state):
     saved_state = {
         "optimizer": state["optimizer"].state_dict(),
         "model": state["model"].state_dict(),
-        "ema": state["ema"].state_dict(),
+        # the toy models are trained without an EMA
+        "ema": state["ema"].state_dict() if state["ema"] is not None else None,
         "step": state["step"],
         # 'scheduler': state['scheduler']
     }
-    torch.save(saved_state, ckpt_dir)
+    # evaluation history and random state of a paused toy run
+    if "toy_history" in state:
+        saved_state["toy_history"] = state["toy_history"]
+    return saved_state
+
+
+def save_checkpoint(ckpt_dir, state):
+    atomic_save(_get_saved_state(state), ckpt_dir)
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints from a background thread.
+
+    `save` copies the state to host memory (so training can keep updating the
+    parameters in place) and returns; a worker thread then writes the full
+    checkpoint and, optionally, an artifact for evaluation with the EMA weights
+    and the frozen parameters and buffers of the model, each via
+    a temporary file and an atomic rename. After every snapshot written to
+    `checkpoint_dir`, all but the `keep` most recent `checkpoint_<n>.pth` files
+    are deleted (`keep <= 0` keeps everything).
+    """
+
+    def __init__(self, checkpoint_dir=None, keep=0, blocking=False):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.blocking = blocking
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = None
+        if not blocking:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def save(self, ckpt_dir, state, ema_artifact=False):
+        self._raise_error()
+        saved_state = _to_host(_get_saved_state(state))
+        frozen_state = None
+        if ema_artifact:
+            # frozen parameters and buffers, e.g. Fourier features, and the
+            # running statistics of normalization layers
+            frozen_state = _to_host(_frozen_state(state["model"]))
+        if self.blocking:
+            self._write(ckpt_dir, saved_state, frozen_state)
+        else:
+            self._queue.put((ckpt_dir, saved_state, frozen_state))
+
+    def wait(self):
+        """Blocks until all pending checkpoints are on disk."""
+        if not self.blocking:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*job)
+            except Exception as e:
+                logging.error(f"Failed to write checkpoint {job[0]}: {e}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, ckpt_dir, saved_state, frozen_state=None):
+        atomic_save(saved_state, ckpt_dir)
+        if frozen_state is not None:
+            atomic_save(
+                {
+                    "ema": saved_state["ema"],
+                    "model": frozen_state,
+                    "step": saved_state["step"],
+                },
+                ema_checkpoint_path(ckpt_dir),
+            )
+        if (
+            self.keep > 0
+            and self.checkpoint_dir is not None
+            and os.path.dirname(ckpt_dir) == self.checkpoint_dir
+        ):
+            self._prune()
+
+    def _prune(self):
+        ckpts = []
+        for path in glob.glob(os.path.join(self.checkpoint_dir, "checkpoint_*.pth")):
+            match = re.fullmatch(r"checkpoint_(\d+)\.pth", os.path.basename(path))
+            if match:
+                ckpts.append((int(match.group(1)), path))
+        for _, path in sorted(ckpts)[: -self.keep]:
+            logging.info(f"Removing old checkpoint {path}")
+            for p in [path, ema_checkpoint_path(path)]:
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
 
 
 def get_prob_path(dim, prob_path, config):